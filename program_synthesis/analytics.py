@@ -0,0 +1,259 @@
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+
+DEFAULT_LOG_DIRS = ["logs", os.path.join("user_study", "logs")]
+
+SYMPTOMS = ["Pain", "Fatigue", "Dizziness"]
+
+_PARTICIPANT = re.compile(r"^participant\d+$")
+
+
+def session_labels(path):
+    """
+    Return (exercise, patient) for a session log path.
+
+    The exercise is the file name without extension. The patient is the nearest `participantN`
+    directory on the path, or otherwise the directory that holds the logs folder
+    (e.g. "user_study"), so that sessions from different studies are not pooled as one patient.
+    """
+    parts = os.path.normpath(os.path.abspath(path)).split(os.sep)
+    exercise = os.path.splitext(parts[-1])[0]
+    for part in reversed(parts[:-1]):
+        if _PARTICIPANT.match(part):
+            return exercise, part
+    parent = parts[-2] if len(parts) > 1 else ""
+    patient = parts[-3] if parent == "logs" and len(parts) > 2 else parent
+    return exercise, patient
+
+
+def _flag(value):
+    # Pain is logged as [detected, ...], Fatigue/Dizziness as [detected, note]
+    if isinstance(value, (list, tuple)):
+        return bool(value[0]) if value else False
+    return bool(value)
+
+
+class SessionTable:
+    """
+    Columnar view of many session logs.
+
+    Step columns (one entry per logged instruction step, all sessions concatenated):
+    1. session (int): index of the session the step belongs to
+    2. step (int): index of the step within its session
+    3. duration (float): Time_Taken in seconds
+    4. complete / failed / omitted (bool): outcome of the step, defined exactly as in
+       summarize.summarize_logs (failed: not complete and int(Time_Taken) != 0, omitted: otherwise)
+
+    Session columns (one entry per session):
+    1. exercise, patient (str): labels from session_labels
+    2. pain, fatigue, dizziness (bool): whether the symptom was detected
+    3. paths (list): source file of each session, if loaded from disk
+    """
+
+    def __init__(self, session, step, duration, complete, exercise, patient, symptoms, paths=None):
+        self.session = session
+        self.step = step
+        self.duration = duration
+        self.complete = complete
+        truncated = np.trunc(duration) != 0
+        self.failed = ~complete & truncated
+        self.omitted = ~complete & ~truncated
+        self.exercise = exercise
+        self.patient = patient
+        self.pain, self.fatigue, self.dizziness = symptoms
+        self.paths = paths or []
+        self._session_codes = {}
+
+    def __len__(self):
+        return len(self.exercise)
+
+    @classmethod
+    def from_logs(cls, logs_dicts, exercises, patients, paths=None):
+        """
+        Build the table from already parsed session logs.
+
+        Inputs:
+        1. logs_dicts (list): session log dictionaries as written by the generated programs
+        2. exercises (list): exercise label of each session
+        3. patients (list): patient label of each session
+        """
+        session, step, duration, complete = [], [], [], []
+        symptoms = [[], [], []]
+        for s, logs_dict in enumerate(logs_dicts):
+            # Step order within a session does not matter for the aggregates, so no sorting here
+            for k, rec in logs_dict.items():
+                if not k.isdigit():
+                    continue
+                session.append(s)
+                step.append(int(k))
+                duration.append(rec.get("Time_Taken", 0) or 0)
+                complete.append(bool(rec.get("Completeness", False)))
+            for column, name in zip(symptoms, SYMPTOMS):
+                column.append(_flag(logs_dict.get(name, False)))
+        return cls(np.asarray(session, dtype=np.int32),
+                   np.asarray(step, dtype=np.int32),
+                   np.asarray(duration, dtype=np.float64),
+                   np.asarray(complete, dtype=bool),
+                   np.asarray(exercises, dtype=object),
+                   np.asarray(patients, dtype=object),
+                   [np.asarray(column, dtype=bool) for column in symptoms],
+                   paths)
+
+    def session_groups(self, by):
+        """
+        Return (labels, code of each session) for grouping sessions by "exercise" or "patient".
+        """
+        if by not in ("exercise", "patient"):
+            raise ValueError(f"Unknown grouping {by!r}; expected 'exercise' or 'patient'")
+        if by not in self._session_codes:
+            self._session_codes[by] = np.unique(getattr(self, by).astype(str), return_inverse=True)
+        return self._session_codes[by]
+
+    def groups(self, by):
+        """
+        Return (labels, code of each step) for grouping steps by "exercise" or "patient".
+        """
+        labels, session_codes = self.session_groups(by)
+        return labels, session_codes[self.session]
+
+    def outcome_rates(self, by="exercise"):
+        """
+        Per group: number of sessions and steps, and the fraction of steps that were
+        successful, failed and omitted.
+
+        Return:
+        dictionary: (key: group label, value: dictionary of the aggregates)
+        """
+        labels, codes = self.groups(by)
+        n = len(labels)
+        steps = np.bincount(codes, minlength=n)
+        sessions = np.bincount(self.session_groups(by)[1], minlength=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rates = {name: np.bincount(codes, weights=column, minlength=n) / steps
+                     for name, column in (("success_rate", self.complete),
+                                          ("failed_rate", self.failed),
+                                          ("omitted_rate", self.omitted))}
+        return {label: {"sessions": int(sessions[g]), "steps": int(steps[g]),
+                        **{name: float(rate[g]) for name, rate in rates.items()}}
+                for g, label in enumerate(labels)}
+
+    def step_completion_rates(self, by="exercise"):
+        """
+        Per group: completion rate of each step index across the group's sessions.
+
+        Return:
+        dictionary: (key: group label, value: list of rates, index i is step i; None where no
+        session of the group has step i)
+        """
+        labels, codes = self.groups(by)
+        width = int(self.step.max()) + 1 if len(self.step) else 0
+        cell = codes * width + self.step
+        size = len(labels) * width
+        attempts = np.bincount(cell, minlength=size).reshape(len(labels), width)
+        completed = np.bincount(cell, weights=self.complete, minlength=size).reshape(len(labels), width)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rates = completed / attempts
+        out = {}
+        for g, label in enumerate(labels):
+            last = np.flatnonzero(attempts[g])
+            row = rates[g, :last[-1] + 1] if len(last) else []
+            out[label] = [None if np.isnan(r) else float(r) for r in row]
+        return out
+
+    def duration_percentiles(self, by="exercise", q=(50, 90, 95), attempted_only=True):
+        """
+        Per group: percentiles of the step durations in seconds.
+
+        Inputs:
+        1. by (str): "exercise" or "patient"
+        2. q (tuple): percentiles to compute
+        3. attempted_only (bool): ignore omitted steps (whose duration is 0)
+
+        Return:
+        dictionary: (key: group label, value: dictionary "p<q>" -> seconds)
+        """
+        labels, codes = self.groups(by)
+        mask = ~self.omitted if attempted_only else np.ones(len(codes), dtype=bool)
+        codes, durations = codes[mask], self.duration[mask]
+        order = np.lexsort((durations, codes))
+        codes, durations = codes[order], durations[order]
+        bounds = np.searchsorted(codes, np.arange(len(labels) + 1))
+        out = {}
+        for g, label in enumerate(labels):
+            values = durations[bounds[g]:bounds[g + 1]]
+            if len(values):
+                out[label] = dict(zip((f"p{p}" for p in q), np.percentile(values, q).tolist()))
+            else:
+                out[label] = {f"p{p}": None for p in q}
+        return out
+
+    def symptom_rates(self, by="exercise"):
+        """Per group: fraction of sessions in which pain, fatigue and dizziness were detected."""
+        labels, codes = self.session_groups(by)
+        n = len(labels)
+        sessions = np.bincount(codes, minlength=n)
+        rates = {name.lower(): np.bincount(codes, weights=column, minlength=n) / np.maximum(sessions, 1)
+                 for name, column in zip(SYMPTOMS, (self.pain, self.fatigue, self.dizziness))}
+        return {label: {name: float(rate[g]) for name, rate in rates.items()} for g, label in enumerate(labels)}
+
+    def report(self, by="exercise"):
+        """All aggregates for one grouping, in a JSON-serializable dictionary."""
+        outcomes = self.outcome_rates(by)
+        completion = self.step_completion_rates(by)
+        durations = self.duration_percentiles(by)
+        symptoms = self.symptom_rates(by)
+        return {label: {**outcomes[label],
+                        "step_completion_rate": completion[label],
+                        "duration_percentiles": durations[label],
+                        "symptoms": symptoms[label]}
+                for label in outcomes}
+
+
+def find_session_logs(log_dirs=None):
+    """Return the session log files under log_dirs (default: logs/ and user_study/logs/)."""
+    paths = []
+    for log_dir in log_dirs or DEFAULT_LOG_DIRS:
+        paths.extend(sorted(glob.glob(os.path.join(log_dir, "*.json"))))
+    return paths
+
+
+def load_sessions(paths=None, labeler=session_labels):
+    """
+    Load session logs into a SessionTable. Files that cannot be parsed are skipped with a message.
+
+    Inputs:
+    1. paths (list): session log files (default: find_session_logs())
+    2. labeler (function): path -> (exercise, patient)
+    """
+    paths = find_session_logs() if paths is None else paths
+    logs_dicts, exercises, patients, loaded = [], [], [], []
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                logs_dict = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Skipping session log {path}: {e}")
+            continue
+        exercise, patient = labeler(path)
+        logs_dicts.append(logs_dict)
+        exercises.append(exercise)
+        patients.append(patient)
+        loaded.append(path)
+    return SessionTable.from_logs(logs_dicts, exercises, patients, loaded)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Cohort-level statistics over many session logs")
+    parser.add_argument("log_dirs", nargs="*", help="directories with session logs (default: logs user_study/logs)")
+    parser.add_argument("--by", choices=["exercise", "patient"], default="exercise")
+    args = parser.parse_args()
+
+    table = load_sessions(find_session_logs(args.log_dirs))
+    print(json.dumps(table.report(args.by), indent=4))
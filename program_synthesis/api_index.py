@@ -0,0 +1,248 @@
+import ast
+import hashlib
+import math
+import re
+from collections import Counter
+
+from token_estimator import estimate_tokens
+
+
+# APIs every generated program needs regardless of the exercise (see example_scenic_program/)
+CORE_APIS = [
+    "SpeakAction",
+    "DoneAction",
+    "WaitForIntroduction",
+    "WaitForSpeakAction",
+    "SendImageAndTextRequestAction",
+    "RecordVideoAndEvaluateAction",
+    "RequestActionResult",
+    "DisposeQueriesAction",
+    "UpdateLogs",
+]
+
+VISUAL_APIS = {"SendImageAndTextRequestAction", "RecordVideoAndEvaluateAction", "RequestActionResult"}
+
+_VISUAL_WORDS = {"image", "video", "camera", "vision", "picture", "frame", "vlm", "snapshot"}
+_BPE_WORDS = {"joint", "elbow", "wrist", "finger", "fingers", "thumb", "shoulder", "hip", "knee",
+              "pose", "bpe", "flexion", "extension", "supination", "pronation", "abduction",
+              "adduction", "angle", "lean", "seated", "standing", "spread", "palm", "arm"}
+
+_STOPWORDS = {"the", "a", "an", "and", "or", "of", "to", "in", "on", "for", "with", "your", "you",
+              "is", "it", "be", "as", "at", "by", "this", "that", "then", "if", "from", "into",
+              "self", "return", "returns", "true", "false", "none", "args", "obj"}
+
+
+# Everyday words therapists use, mapped onto the vocabulary of the API names
+_SYNONYMS = {"sit": "seat", "sat": "seat", "grab": "grasp", "hold": "grasp", "pick": "grasp",
+             "straighten": "extension", "bend": "flexion", "toward": "towards"}
+
+
+def _stem(term):
+    term = _SYNONYMS.get(term, term)
+    for suffix in ("ing", "ed", "es", "s"):
+        if term.endswith(suffix) and len(term) - len(suffix) >= 3:
+            return term[:-len(suffix)]
+    return term
+
+
+def tokenize(text):
+    """Split text into lowercase, crudely stemmed terms, breaking CamelCase and snake_case apart."""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text)
+    return [_stem(t) for t in re.findall(r"[a-z]+", text.lower()) if t not in _STOPWORDS and len(t) > 1]
+
+
+class APIEntry:
+    def __init__(self, name, kind, signature, summary, category, source, order, references):
+        self.name = name
+        self.kind = kind              # "function" or "class"
+        self.signature = signature
+        self.summary = summary
+        self.category = category      # "visual", "bpe" or "other"
+        self.source = source
+        self.order = order            # position in actions.py
+        self.references = references  # other API names used in the body
+
+    def to_dict(self):
+        return {"name": self.name, "kind": self.kind, "signature": self.signature,
+                "summary": self.summary, "category": self.category}
+
+
+def _categorize(name, doc):
+    words = set(tokenize(name)) | set(tokenize(doc))
+    if name in VISUAL_APIS or words & set(tokenize(" ".join(_VISUAL_WORDS))):
+        return "visual"
+    if words & set(tokenize(" ".join(_BPE_WORDS))):
+        return "bpe"
+    return "other"
+
+
+def _signature(node):
+    if isinstance(node, ast.ClassDef):
+        init = next((n for n in node.body
+                     if isinstance(n, ast.FunctionDef) and n.name == "__init__"), None)
+        if init is None:
+            return f"{node.name}()"
+        args = ast.unparse(init.args)
+        args = re.sub(r"^self,?\s*", "", args)
+        return f"{node.name}({args})"
+    return f"{node.name}({ast.unparse(node.args)})"
+
+
+class APIIndex:
+    """
+    Index of the public APIs (top-level functions and classes) defined in actions.py, built with ast.
+
+    Each entry records its name, signature, docstring summary, category (BPE vs visual) and source.
+    retrieve() ranks the entries against free text (e.g. the instruction list) with BM25, so prompts
+    only need to inline the handful of APIs relevant to an exercise instead of the whole library.
+
+    Input Arguments:
+    1. source (str): contents of actions.py
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.entries = {}
+        self.imported_names = set()
+        try:
+            tree = ast.parse(source)
+        except SyntaxError as e:
+            print(f"api_index: could not parse the API library ({e}); falling back to the full library")
+            tree = ast.Module(body=[], type_ignores=[])
+        top_level = [node for node in tree.body
+                     if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+                     and not node.name.startswith("_")]
+        names = {node.name for node in top_level}
+        for node in tree.body:
+            if isinstance(node, (ast.Import, ast.ImportFrom)):
+                self.imported_names.update((alias.asname or alias.name).split(".")[0]
+                                           for alias in node.names if alias.name != "*")
+        for order, node in enumerate(top_level):
+            doc = ast.get_docstring(node) or ""
+            summary = doc.strip().split("\n\n")[0].replace("\n", " ") if doc else ""
+            references = sorted({n.id for n in ast.walk(node)
+                                 if isinstance(n, ast.Name) and n.id in names and n.id != node.name})
+            self.entries[node.name] = APIEntry(
+                name=node.name,
+                kind="class" if isinstance(node, ast.ClassDef) else "function",
+                signature=_signature(node),
+                summary=summary,
+                category=_categorize(node.name, doc),
+                source=ast.get_source_segment(source, node) or "",
+                order=order,
+                references=references,
+            )
+        self._build_bm25()
+
+    def _build_bm25(self, k1=1.5, b=0.75):
+        self._k1, self._b = k1, b
+        self._docs = {}
+        for name, entry in self.entries.items():
+            text = " ".join([name, name, entry.signature, entry.summary])
+            self._docs[name] = Counter(tokenize(text))
+        lengths = [sum(doc.values()) for doc in self._docs.values()]
+        self._avg_len = sum(lengths) / len(lengths) if lengths else 0.0
+        df = Counter(term for doc in self._docs.values() for term in doc)
+        n = len(self._docs)
+        self._idf = {term: math.log(1 + (n - freq + 0.5) / (freq + 0.5)) for term, freq in df.items()}
+
+    def score(self, query):
+        """Return {api name: BM25 score} for every API matching at least one query term."""
+        terms = tokenize(query)
+        scores = {}
+        for name, doc in self._docs.items():
+            length = sum(doc.values())
+            total = 0.0
+            for term in terms:
+                tf = doc.get(term, 0)
+                if not tf:
+                    continue
+                norm = tf + self._k1 * (1 - self._b + self._b * length / (self._avg_len or 1))
+                total += self._idf[term] * tf * (self._k1 + 1) / norm
+            if total > 0:
+                scores[name] = total
+        return scores
+
+    def retrieve(self, queries, per_query=3, core=CORE_APIS):
+        """
+        Select the APIs relevant to a list of queries (one per instruction step).
+
+        Inputs:
+        1. queries (list): free-text queries, e.g. the exercise's instruction list
+        2. per_query (int): number of top-ranked APIs kept for each query
+        3. core (list): APIs that are always included when defined in the library
+
+        Return:
+        list of API names in actions.py order, or None if nothing could be matched
+        (callers should then fall back to the full library)
+        """
+        selected = set()
+        for query in queries:
+            ranked = sorted(self.score(query).items(), key=lambda item: -item[1])
+            selected.update(name for name, _ in ranked[:per_query])
+        if not selected:
+            return None
+        selected.update(name for name in core if name in self.entries)
+        # Pull in helpers the selected APIs call so the inlined code stays self-contained
+        stack = list(selected)
+        while stack:
+            for ref in self.entries[stack.pop()].references:
+                if ref not in selected:
+                    selected.add(ref)
+                    stack.append(ref)
+        return sorted(selected, key=lambda name: self.entries[name].order)
+
+    def render(self, names):
+        return "\n\n".join(self.entries[name].source for name in names)
+
+    def names(self):
+        return set(self.entries)
+
+
+_indexes = {}
+
+
+def load_api_index(source):
+    """Return the APIIndex for the given actions.py contents, memoized by content hash."""
+    digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    if digest not in _indexes:
+        _indexes[digest] = APIIndex(source)
+    return _indexes[digest]
+
+
+def select_api_context(source, queries, per_query=3, label="prompt"):
+    """
+    Return the part of the API library to inline into a prompt for the given queries, and
+    print how many prompt tokens the subset saves over inlining the full library.
+
+    Inputs:
+    1. source (str): contents of actions.py
+    2. queries (list): free-text queries, e.g. the exercise's instruction list
+    3. per_query (int): number of top-ranked APIs kept per query
+    4. label (str): name of the calling stage, used in the printed report
+
+    Return:
+    tuple: (api text (str), stats (dict) with apis_selected, apis_total, tokens_full, tokens_subset, tokens_saved)
+    """
+    index = load_api_index(source)
+    names = index.retrieve([q for q in queries if isinstance(q, str) and q.strip()], per_query)
+    tokens_full = estimate_tokens(source)
+    if names is None:
+        text, tokens_subset = source, tokens_full
+    else:
+        text = index.render(names)
+        tokens_subset = estimate_tokens(text)
+    stats = {
+        "apis_selected": len(names) if names is not None else len(index.entries),
+        "apis_total": len(index.entries),
+        "tokens_full": tokens_full,
+        "tokens_subset": tokens_subset,
+        "tokens_saved": tokens_full - tokens_subset,
+    }
+    if names is None:
+        print(f"{label}: no API matched the instructions, inlining the full library ({tokens_full} tokens)")
+    else:
+        saved_pct = 100.0 * stats["tokens_saved"] / tokens_full if tokens_full else 0.0
+        print(f"{label}: inlining {stats['apis_selected']}/{stats['apis_total']} APIs, "
+              f"~{tokens_subset} tokens instead of ~{tokens_full} (saved {stats['tokens_saved']}, {saved_pct:.0f}%)")
+    return text, stats
@@ -0,0 +1,6 @@
+import random
+
+
+def decorrelated_jitter(previous, base=1.0, cap=300.0):
+    """Next backoff delay in seconds: uniform in [base, 3 * previous delay], capped at cap."""
+    return min(cap, random.uniform(base, max(base, previous * 3)))
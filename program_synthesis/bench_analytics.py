@@ -0,0 +1,101 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from analytics import SessionTable, find_session_logs, session_labels
+from summarize import summarize_logs
+
+
+def loop_aggregates(logs_dicts, exercises):
+    """The per-session approach: summarize_logs on every log, then aggregate in Python."""
+    totals = {}
+    for logs_dict, exercise in zip(logs_dicts, exercises):
+        summary = summarize_logs(logs_dict)
+        group = totals.setdefault(exercise, {"steps": 0, "success": 0, "failed": 0, "omitted": 0,
+                                             "durations": [], "per_step": {}})
+        for i, complete in enumerate(summary["Successful Instructions"]):
+            group["steps"] += 1
+            group["success"] += complete
+            group["failed"] += summary["Failed Instructions"][i]
+            group["omitted"] += summary["Omitted Instructions"][i]
+            if not summary["Omitted Instructions"][i]:
+                group["durations"].append(summary["Duration of Completion"][i])
+            attempts, done = group["per_step"].get(i, (0, 0))
+            group["per_step"][i] = (attempts + 1, done + complete)
+    out = {}
+    for exercise, group in totals.items():
+        durations = sorted(group["durations"])
+        out[exercise] = {
+            "success_rate": group["success"] / group["steps"],
+            "failed_rate": group["failed"] / group["steps"],
+            "omitted_rate": group["omitted"] / group["steps"],
+            "p50": durations[len(durations) // 2] if durations else None,
+            "step_completion_rate": [done / attempts for _, (attempts, done) in sorted(group["per_step"].items())],
+        }
+    return out
+
+
+def vectorized_aggregates(logs_dicts, exercises, patients):
+    table = SessionTable.from_logs(logs_dicts, exercises, patients)
+    return (table.outcome_rates(), table.step_completion_rates(), table.duration_percentiles(),
+            table.outcome_rates("patient"))
+
+
+def time_it(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(sessions, repeat, seed):
+    paths = find_session_logs()
+    templates = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            templates.append((json.load(f), *session_labels(path)))
+
+    # Synthetic cohort: the real session logs with jittered durations and outcomes
+    rng = np.random.default_rng(seed)
+    logs_dicts, exercises, patients = [], [], []
+    for i in range(sessions):
+        logs_dict, exercise, _ = templates[i % len(templates)]
+        jittered = {}
+        for k, rec in logs_dict.items():
+            if k.isdigit():
+                complete = bool(rng.random() < 0.7)
+                duration = 0 if rng.random() < 0.1 else float(rng.gamma(2.0, 5.0))
+                rec = {**rec, "Time_Taken": duration, "Completeness": complete}
+            jittered[k] = rec
+        logs_dicts.append(jittered)
+        exercises.append(exercise)
+        patients.append(f"patient{i % 50}")
+
+    expected = loop_aggregates(logs_dicts, exercises)
+    rates = SessionTable.from_logs(logs_dicts, exercises, patients).outcome_rates()
+    for exercise, group in expected.items():
+        assert abs(group["success_rate"] - rates[exercise]["success_rate"]) < 1e-9, exercise
+
+    loop = time_it(lambda: loop_aggregates(logs_dicts, exercises), repeat)
+    vectorized = time_it(lambda: vectorized_aggregates(logs_dicts, exercises, patients), repeat)
+    table = SessionTable.from_logs(logs_dicts, exercises, patients)
+    aggregates = time_it(lambda: (table.outcome_rates(), table.step_completion_rates(),
+                                  table.duration_percentiles(), table.outcome_rates("patient")), repeat)
+    print(f"{len(paths)} template logs, {sessions} sessions")
+    print(f"summarize_logs loop   {loop * 1000:8.1f} ms   {sessions / loop:10.0f} sessions/s")
+    print(f"SessionTable          {vectorized * 1000:8.1f} ms   {sessions / vectorized:10.0f} sessions/s")
+    print(f"  of which aggregates {aggregates * 1000:8.1f} ms   {sessions / aggregates:10.0f} sessions/s")
+    print(f"speedup {loop / vectorized:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput of cohort aggregates: summarize_logs loop vs SessionTable")
+    parser.add_argument("-n", "--sessions", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args.sessions, args.repeat, args.seed)
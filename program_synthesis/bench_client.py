@@ -0,0 +1,52 @@
+import argparse
+import statistics
+import time
+
+from openai import OpenAI
+from llm_client import ClientManager
+from llm_stub_server import StubLLMServer
+
+
+MESSAGES = [{"role": "system", "content": "You are a helpful coding assistant."},
+            {"role": "user", "content": "ping"}]
+
+
+def time_calls(get_client, n):
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        get_client().chat.completions.create(model="stub", messages=MESSAGES)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(label, latencies, connections):
+    latencies = sorted(latencies)
+    p95 = latencies[max(0, int(round(0.95 * len(latencies))) - 1)]
+    print(f"{label:<22} mean {statistics.mean(latencies) * 1000:7.2f} ms   "
+          f"p50 {statistics.median(latencies) * 1000:7.2f} ms   "
+          f"p95 {p95 * 1000:7.2f} ms   connections opened: {connections}")
+
+
+def main(n, latency):
+    with StubLLMServer(latency=latency) as server:
+        # Old behavior: a new client (and connection pool) for every call
+        time_calls(lambda: OpenAI(api_key="stub", base_url=server.base_url), 3)  # warm up
+        before = server.connections
+        fresh = time_calls(lambda: OpenAI(api_key="stub", base_url=server.base_url), n)
+        report("fresh client per call", fresh, server.connections - before)
+
+        manager = ClientManager("grok", base_url=server.base_url, api_key="stub")
+        time_calls(manager.client, 3)
+        before = server.connections
+        pooled = time_calls(manager.client, n)
+        report("shared pooled client", pooled, server.connections - before)
+        manager.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-call LLM latency with and without connection reuse")
+    parser.add_argument("-n", type=int, default=200, help="number of calls per configuration")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated server latency (s)")
+    args = parser.parse_args()
+    main(args.n, args.latency)
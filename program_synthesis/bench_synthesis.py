@@ -0,0 +1,231 @@
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import llm_client
+from llm_cache import ResponseCache, DEFAULT_CACHE_DIR, disable_cache
+from llm_stub_server import StubLLMServer
+from scenic_generator import Synth, merge_setup, scenic_program_paths
+from telemetry import JSONLSink, Tracer, span, tracer
+from token_estimator import estimate_tokens
+
+
+CORPORA = {
+    "json": "json/*.json",
+    "ucsf": "ucsf/json/*.json",
+    "user_study": "user_study/instructions/*.json",
+    "pilot_results": "pilot_results/*/instructions/*.json",
+}
+
+DEFAULT_BASELINE = "bench_synthesis_baseline.json"
+
+# Metrics checked against the baseline: (name, relative tolerance, absolute slack)
+# The absolute slack keeps millisecond-scale stages from failing on timer noise.
+CHECKED_METRICS = [
+    ("synthesize_mean_s", 0.20, 0.010),
+    ("overhead_mean_s", 0.20, 0.010),
+    ("prompt_build_mean_s", 0.25, 0.005),
+    ("write_mean_s", 0.50, 0.005),
+    ("prompt_chars_mean", 0.05, 0),
+]
+
+
+class RecordedResponder:
+    """
+    Stub responder that replays responses recorded in an LLM response cache (see llm_cache.py):
+    run the pipeline once against the real provider with LLM_CACHE_DIR set, then point the benchmark
+    at that directory. Requests that were never recorded get default_response.
+    """
+
+    def __init__(self, cache_dir, default_response):
+        self.cache = ResponseCache(cache_dir) if cache_dir and os.path.isdir(cache_dir) else None
+        self.default_response = default_response
+        self.hits = 0
+        self.misses = 0
+        self.prompt_tokens = 0
+
+    def __call__(self, request):
+        messages = {m["role"]: m["content"] for m in request.get("messages", [])}
+        self.prompt_tokens += sum(estimate_tokens(content) for content in messages.values())
+        if self.cache is not None:
+            # Recorded under the model each stage is routed to (see model_routing)
+            model, temperature = request.get("model"), request.get("temperature", 0)
+            for json_bool in (False, True):
+                key = self.cache.make_key(model, temperature, json_bool,
+                                          messages.get("system", ""), messages.get("user", ""))
+                output = self.cache.get(key)
+                if output is not None:
+                    self.hits += 1
+                    return output
+        self.misses += 1
+        return self.default_response
+
+
+def load_corpus(corpora):
+    """Return a list of (corpus, path, annotations) for every exercise JSON with an instruction list."""
+    exercises = []
+    for corpus in corpora:
+        for path in sorted(glob.glob(CORPORA[corpus])):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if not isinstance(data, dict) or not isinstance(data.get("instruction"), list):
+                continue
+            if not isinstance(data.get("setup"), dict):
+                data = merge_setup(data, None, False)
+            exercises.append((corpus, path, data))
+    return exercises
+
+
+def run(exercises, paths, out_dir, repeat, responder):
+    """Synthesize every exercise repeat times; return one record per synthesis."""
+    records = []
+    for _ in range(repeat):
+        for corpus, path, annotations in exercises:
+            tracer.reset()
+            tokens_before = responder.prompt_tokens
+            start = time.perf_counter()
+            with span("synthesize", exercise=path):
+                synth = Synth(json.loads(json.dumps(annotations)), paths["model_file_path"],
+                              paths["api_file_path"], paths["example_scenic_programs_path"])
+                program = synth.synthesize(max_attempts=1)
+                save_path = os.path.join(out_dir, os.path.basename(path).replace(".json", ".scenic"))
+                with span("write", chars=len(program)):
+                    with open(save_path, "w") as f:
+                        f.write(program)
+            seconds = time.perf_counter() - start
+            stages = tracer.summary()
+            prompt_chars = sum(s.attrs.get("prompt_chars", 0) for s in tracer.spans if s.name == "prompt_build")
+            records.append({
+                "corpus": corpus, "exercise": path, "seconds": seconds,
+                "stages": {name: stats["total"] for name, stats in stages.items()},
+                "llm_calls": stages.get("llm_wait", {}).get("count", 0),
+                "prompt_chars": prompt_chars,
+                "prompt_tokens": responder.prompt_tokens - tokens_before,
+                "program_chars": len(program),
+            })
+    return records
+
+
+def aggregate(records, latency):
+    def mean(values):
+        values = list(values)
+        return statistics.mean(values) if values else 0.0
+
+    seconds = [r["seconds"] for r in records]
+    llm_calls = mean(r["llm_calls"] for r in records)
+    stage_names = sorted({name for r in records for name in r["stages"]})
+    metrics = {
+        "exercises": len(records),
+        "synthesize_mean_s": mean(seconds),
+        "synthesize_p95_s": sorted(seconds)[min(len(seconds) - 1, int(0.95 * len(seconds)))] if seconds else 0.0,
+        # Time not explained by the simulated provider latency
+        "overhead_mean_s": mean(seconds) - llm_calls * latency,
+        "llm_calls_mean": llm_calls,
+        "prompt_chars_mean": mean(r["prompt_chars"] for r in records),
+        "prompt_tokens_mean": mean(r["prompt_tokens"] for r in records),
+        "throughput_per_min": 60 * len(records) / sum(seconds) if seconds else 0.0,
+    }
+    for name in stage_names:
+        metrics[f"{name}_mean_s"] = mean(r["stages"].get(name, 0.0) for r in records)
+    return metrics
+
+
+def compare(metrics, baseline):
+    """Return a list of (metric, baseline value, current value) that regressed."""
+    regressions = []
+    for name, rel, slack in CHECKED_METRICS:
+        if name not in baseline or name not in metrics:
+            continue
+        if metrics[name] > baseline[name] * (1 + rel) + slack:
+            regressions.append((name, baseline[name], metrics[name]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end synthesis benchmark against a stub LLM")
+    parser.add_argument("--corpus", nargs="+", choices=sorted(CORPORA), default=sorted(CORPORA))
+    parser.add_argument("--latency", type=float, default=0.5, help="simulated provider latency per call (s)")
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    parser.add_argument("--recorded", default=DEFAULT_CACHE_DIR,
+                        help="LLM response cache directory with recorded responses")
+    parser.add_argument("--default-response", default=os.path.join("scenic_output", "exercise1.scenic"),
+                        help="program returned for requests without a recorded response")
+    parser.add_argument("--api", help="path to actions.py (default: the Scenic checkout next to this repo)")
+    parser.add_argument("--model", help="path to model.scenic")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", help="write the per-exercise records and metrics to this JSON file")
+    parser.add_argument("--jsonl", help="append every span to this JSONL file")
+    parser.add_argument("--prometheus", help="write a Prometheus text snapshot of the run to this file")
+    args = parser.parse_args()
+
+    paths = scenic_program_paths("benchmark")
+    paths["api_file_path"] = args.api or paths["api_file_path"]
+    paths["model_file_path"] = args.model or paths["model_file_path"]
+    for key in ("api_file_path", "model_file_path"):
+        if not os.path.exists(paths[key]):
+            print(f"{paths[key]} not found; pass --api/--model")
+            return 2
+
+    with open(args.default_response, "r") as f:
+        responder = RecordedResponder(args.recorded, f.read())
+    exercises = load_corpus(args.corpus)
+    disable_cache()  # every request must reach the stub
+    if args.jsonl:
+        tracer.add_sink(JSONLSink(args.jsonl))
+    prometheus = Tracer()
+    tracer.add_sink(prometheus._finish)  # run() resets the tracer per exercise; keep run-wide totals here
+
+    with StubLLMServer(responder, latency=args.latency, chunk_delay=args.chunk_delay) as server, \
+            tempfile.TemporaryDirectory() as out_dir:
+        llm_client.configure("grok", base_url=server.base_url, api_key="stub")
+        start = time.perf_counter()
+        records = run(exercises, paths, out_dir, args.repeat, responder)
+        wall = time.perf_counter() - start
+
+    metrics = aggregate(records, args.latency)
+    if args.prometheus:
+        prometheus.write_prometheus(args.prometheus)
+    print(f"{len(exercises)} exercises x {args.repeat} in {wall:.2f}s "
+          f"(recorded responses: {responder.hits} hits, {responder.misses} misses)")
+    for corpus in args.corpus:
+        corpus_records = [r for r in records if r["corpus"] == corpus]
+        if corpus_records:
+            print(f"  {corpus:<14} {len(corpus_records):3d} runs   "
+                  f"mean {statistics.mean(r['seconds'] for r in corpus_records):6.3f}s   "
+                  f"prompt {statistics.mean(r['prompt_chars'] for r in corpus_records):9.0f} chars")
+    for name, value in metrics.items():
+        print(f"  {name:<24} {value:12.4f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"metrics": metrics, "records": records}, f, indent=4)
+
+    settings = {"latency": args.latency, "corpus": sorted(args.corpus), "repeat": args.repeat}
+    if args.update_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, "w") as f:
+            json.dump({"settings": settings, "metrics": metrics}, f, indent=4)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    if baseline.get("settings") != settings:
+        print(f"Baseline was recorded with {baseline.get('settings')}, not {settings}; not comparing")
+        return 0
+    regressions = compare(metrics, baseline["metrics"])
+    for name, before, after in regressions:
+        print(f"REGRESSION {name}: {before:.4f} -> {after:.4f}")
+    if not regressions:
+        print("No regressions against the baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,271 @@
+import re
+
+from api_index import VISUAL_APIS
+from scenic_checker import code_lines
+from wait_primitives import indent_unit, loop_multipliers, use_wait_primitives
+
+
+VIDEO_ACTION = "RecordVideoAndEvaluateAction"
+IMAGE_ACTION = "SendImageAndTextRequestAction"
+
+_VISUAL_TAKE = re.compile(rf"^(\s*)take\s+({IMAGE_ACTION}|{VIDEO_ACTION})\s*\(")
+_SPEAK = re.compile(r"take\s+SpeakAction\((.*)\)")
+_STRING = re.compile(r"""^\s*(["'])(.*)\1\s*$""")
+_CURRENT = re.compile(r"Current Instruction:\s*([^.]*)")
+_LOG_REFERENCE = re.compile(r"""^\{?\s*logs\[(\w+)\]\[["']Instruction["']\]\s*\}?$""")
+_LOG_ENTRY = re.compile(r'^\s*(\d+)\s*:\s*\{[^{}]*?["\']Instruction["\']\s*:\s*"((?:[^"\\]|\\.)*)"', re.MULTILINE)
+_WAIT_UNTIL = re.compile(r"^(\s*)do\s+WaitUntil\s*\(\s*lambda\s*:")
+_LIMIT = re.compile(r"\b(max_ticks|timeout_s)\s*=\s*([\d.]+)\s*(?=[,)])")
+_GATE = re.compile(r"^\s*if\s+(\w+)\[[\"']done[\"']\]\s*:\s*$")
+# Status entry of a WaitUntil that says how much of each limit it used
+_SPENT = {"max_ticks": "ticks", "timeout_s": "seconds"}
+
+# Wording that needs several frames to judge: motion, duration, repetition or a sequence of
+# actions. An instruction without any of these is judged on its end state, from one image.
+_TEMPORAL = re.compile(
+    r"\b(for \w+ (?:seconds?|minutes?)|seconds?|minutes?|hold|holding|keep|keeping|maintain|repeat\w*|"
+    r"times|twice|again|move|moving|motion|circular|circles?|back and forth|left and right|up and down|"
+    r"side to side|slowly|quickly|while|until|then|after|before|wipe|wiping|stir|stirring|scoop|"
+    r"scooping|pour|pouring|shake|shaking|wave|waving|swing|rotate|rotating|turn|turning|roll|rolling|"
+    r"squeeze|squeezing|tap|tapping|walk|walking|march|sequence|continuous\w*|throughout|during)\b",
+    re.IGNORECASE)
+
+
+def needs_video(instruction):
+    """Whether judging instruction takes a video rather than a single image (see _TEMPORAL)."""
+    return instruction is None or _TEMPORAL.search(instruction) is not None
+
+
+def _split_top_level(text, separator):
+    """Split text at separator (e.g. " and ") where it is outside brackets and strings."""
+    parts, depth, quote, start, i = [], 0, None, 0, 0
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            if ch == "\\":
+                i += 1
+            elif ch == quote:
+                quote = None
+        elif ch in "'\"":
+            quote = ch
+        elif ch in "([{":
+            depth += 1
+        elif ch in ")]}":
+            depth -= 1
+        elif depth == 0 and text.startswith(separator, i):
+            parts.append(text[start:i])
+            start = i + len(separator)
+            i = start
+            continue
+        i += 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts]
+
+
+def _is_visual(part):
+    return any(re.search(rf"\b{name}\s*\(", part) for name in VISUAL_APIS)
+
+
+def _resolve(text, instructions):
+    """Instruction text from a string literal or a logs[<n>]["Instruction"] reference, else None."""
+    literal = _STRING.match(text)
+    if literal:
+        return literal.group(2)
+    reference = _LOG_REFERENCE.match(text.strip())
+    if reference:
+        return instructions.get(reference.group(1))
+    return None
+
+
+def _instruction(raw, index, instructions):
+    """
+    Text of the instruction the visual query at raw[index] checks: the "Current Instruction" in the
+    query, or else the instruction spoken last. None if it cannot be told.
+    """
+    current = _CURRENT.search(raw[index])
+    if current:
+        text = current.group(1).strip()
+        if "{" not in text:
+            return text
+        resolved = _resolve(text, instructions)
+        if resolved is not None:
+            return resolved
+    for line in reversed(raw[:index]):
+        speak = _SPEAK.search(line)
+        if speak:
+            return _resolve(speak.group(1), instructions)
+    return None
+
+
+def optimize_visual_queries(program):
+    """
+    Make the vision language model (VLM) queries of a Scenic program cheaper.
+
+    1. A visual query whose wait is a conjunction of BPE checks and RequestActionResult(ego), e.g.
+
+           take SendImageAndTextRequestAction(...)
+           take DoneAction()
+           waited = {}
+           do WaitUntil(lambda: CheckStanding(ego) and RequestActionResult(ego), max_ticks=175, status=waited)
+
+       is only sent once the BPE checks hold:
+
+           waited = {}
+           do WaitUntil(lambda: CheckStanding(ego), max_ticks=175, status=waited)
+           if waited["done"]:
+               take SendImageAndTextRequestAction(...)
+               take DoneAction()
+               do WaitUntil(lambda: CheckStanding(ego) and RequestActionResult(ego), max_ticks=175 - waited["ticks"], status=waited)
+
+       so the query is skipped when the patient never gets into the position, and the image is taken
+       once they are in it. The original wait only gets the ticks (or seconds) the gate left over,
+       so the step keeps its time limit. The statements between the query and its wait must be plain statements
+       (no take, do or blocks), since they move before the gate.
+    2. RecordVideoAndEvaluateAction is replaced by SendImageAndTextRequestAction when the instruction
+       it checks has no temporal wording (see needs_video), i.e. when one frame shows whether it was done.
+
+    Waits must already be WaitUntil primitives (see wait_primitives.use_wait_primitives). Queries
+    that are already gated are left as they are, so the pass can run again on its own output.
+
+    Return:
+    tuple: (optimized program, dictionary with the per-session counts "queries" (visual queries),
+    "gated" (queries now skipped whenever their BPE checks fail) and "downgraded" (videos now images))
+    """
+    raw = program.split("\n")
+    code = code_lines(program)
+    multipliers = loop_multipliers(code)
+    unit = indent_unit(program)
+    # Instructions of the logs dictionary, by index
+    instructions = {index: text for index, text in _LOG_ENTRY.findall(program)}
+    report = {"queries": 0, "gated": 0, "downgraded": 0}
+    out = []
+    i = 0
+    while i < len(raw):
+        take = _VISUAL_TAKE.match(code[i])
+        if not take:
+            out.append(raw[i])
+            i += 1
+            continue
+        indent, action = take.group(1), take.group(2)
+        repeat = multipliers[i]
+        report["queries"] += repeat
+        query = raw[i]
+        if action == VIDEO_ACTION and not needs_video(_instruction(raw, i, instructions)):
+            query = query.replace(VIDEO_ACTION, IMAGE_ACTION, 1)
+            report["downgraded"] += repeat
+
+        if _gated(raw, code, i):
+            # Gated by an earlier pass (e.g. before resynthesize kept this step)
+            out.append(query)
+            report["gated"] += repeat
+            i += 1
+            continue
+        gate = _gate(raw, code, i, indent)
+        if gate is None:
+            out.append(query)
+            i += 1
+            continue
+        done_line, wait_line, cheap, keywords, status = gate
+        # Comments and the plain statements up to the wait move before the gate
+        out += [raw[j] for j in range(i + 1, wait_line) if j != done_line]
+        out.append(f"{indent}do WaitUntil(lambda: {cheap}{''.join(', ' + k for k in keywords)})")
+        out.append(f"{indent}if {status}[\"done\"]:")
+        # The gate and the original wait share the wait's limit
+        limited = _LIMIT.sub(lambda m: f"{m.group(1)}={m.group(2)} - {status}[\"{_SPENT[m.group(1)]}\"]",
+                             raw[wait_line])
+        out += [unit + query, unit + raw[done_line], unit + limited]
+        report["gated"] += repeat
+        i = wait_line + 1
+    return "\n".join(out), report
+
+
+def _gated(raw, code, index):
+    """Whether the visual query at line index already sits behind a gate (see optimize_visual_queries)."""
+    previous = [j for j in range(index) if code[j].strip()]
+    if len(previous) < 2:
+        return False
+    # Strings are blanked out in code, so the gate's "done" is matched in the raw line
+    gate = _GATE.match(raw[previous[-1]])
+    return (gate is not None and _WAIT_UNTIL.match(code[previous[-2]]) is not None
+            and re.search(rf"\bstatus\s*=\s*{gate.group(1)}\b", code[previous[-2]]) is not None)
+
+
+def _gate(raw, code, index, indent):
+    """
+    For the visual query at line index, return (line of its take DoneAction(), line of its wait, the
+    wait condition's BPE checks, the wait's keyword arguments for the gate, name of the status
+    dictionary), or None if the query cannot be gated.
+    """
+    following = [j for j in range(index + 1, len(code)) if code[j].strip()]
+    if not following or code[following[0]].strip() != "take DoneAction()":
+        return None
+    for j in following[1:]:
+        line = code[j]
+        if not line.startswith(indent) or line[len(indent):len(indent) + 1].isspace():
+            return None
+        if not _WAIT_UNTIL.match(line):
+            if re.match(r"^\s*(?:take|do|if|for|while|with|try|else|elif)\b", line) or line.rstrip().endswith(":"):
+                return None
+            continue
+        text = raw[j][:len(line.rstrip())]
+        if not text.endswith(")"):
+            return None
+        arguments = _split_top_level(text[text.index("(") + 1:-1], ",")
+        condition = arguments[0].split(":", 1)[1].strip()
+        parts = _split_top_level(condition, " and ")
+        if len(_split_top_level(condition, " or ")) > 1:
+            return None
+        cheap = [part for part in parts if not _is_visual(part)]
+        if not cheap or len(cheap) == len(parts):
+            return None
+        status = re.search(r"\bstatus\s*=\s*(\w+)", line)
+        if status is None:
+            return None
+        # The BPE checks are polled every tick, as in the original wait
+        keywords = [k for k in arguments[1:] if not k.startswith("poll_backoff")]
+        return following[0], j, " and ".join(cheap), keywords, status.group(1)
+    return None
+
+
+def optimize_program(program, label="synthesize"):
+    """
+    The optimization passes run on every generated program: polling loops become wait primitives
+    (wait_primitives) and visual queries are gated behind BPE checks or downgraded to images
+    (optimize_visual_queries). Prints what was changed.
+    """
+    program = use_wait_primitives(program, label=label)
+    program, report = optimize_visual_queries(program)
+    if report["gated"] or report["downgraded"]:
+        print(f"{label}: {report['gated']} of {report['queries']} VLM queries per session now wait for "
+              f"their BPE checks (skipped when those fail), {report['downgraded']} video evaluations "
+              f"downgraded to images")
+    return program
+
+
+if __name__ == "__main__":
+    import argparse
+    import glob
+    import os
+
+    parser = argparse.ArgumentParser(description="Report the VLM queries the optimizer gates or downgrades")
+    parser.add_argument("programs", nargs="*", help="Scenic programs (default: the example programs)")
+    args = parser.parse_args()
+
+    paths = args.programs or sorted(glob.glob(os.path.join("scenic_output", "example_scenic_program", "*.scenic")))
+    totals = {"queries": 0, "gated": 0, "downgraded": 0}
+    unstable = []
+    print(f"{'program':<28} {'queries':>7} {'gated':>5} {'video->image':>12}")
+    for path in paths:
+        with open(path, "r") as f:
+            program = use_wait_primitives(f.read(), label=os.path.basename(path))
+        optimized, report = optimize_visual_queries(program)
+        # resynthesize optimizes programs that were optimized before, which must not change them
+        if optimize_visual_queries(use_wait_primitives(optimized, label=os.path.basename(path)))[0] != optimized:
+            unstable.append(os.path.basename(path))
+        for key in totals:
+            totals[key] += report[key]
+        print(f"{os.path.basename(path):<28} {report['queries']:7d} {report['gated']:5d} {report['downgraded']:12d}")
+    print(f"{'total':<28} {totals['queries']:7d} {totals['gated']:5d} {totals['downgraded']:12d}")
+    if unstable:
+        print(f"Optimizing again changes: {', '.join(unstable)}")
+        raise SystemExit(1)
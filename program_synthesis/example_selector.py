@@ -0,0 +1,197 @@
+import math
+import os
+import re
+from collections import Counter
+
+from api_index import CORE_APIS, load_api_index, tokenize
+from prompt_library import library
+from scenic_checker import check_program
+from token_estimator import estimate_tokens
+
+
+DEFAULT_TOP_K = int(os.environ.get("EXAMPLE_TOP_K", 3))
+DEFAULT_TOKEN_BUDGET = int(os.environ.get("EXAMPLE_TOKEN_BUDGET", 8000))
+
+# Directories of previously generated programs that may serve as extra examples once they pass
+# the static checks (see validated_programs)
+VALIDATED_DIRS = ["scenic_output", os.path.join("ucsf", "scenic_output")]
+
+# Weights of the three similarity signals in an example's score
+WEIGHTS = {"instructions": 0.5, "apis": 0.3, "objects": 0.2}
+
+_LOG_INSTRUCTION = re.compile(r'"Instruction"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_SPEAK = re.compile(r'SpeakAction\(\s*"((?:[^"\\]|\\.)*)"')
+_CALL = re.compile(r"\b([A-Z][A-Za-z0-9_]*)\s*\(")
+_NEW = re.compile(r"^\s*(\w+)\s*=\s*new\s+([A-Za-z_]\w*)", re.MULTILINE)
+_HEADER_KEY = re.compile(r'^\s*"(\w+)"\s*:\s*\[\s*\[', re.MULTILINE)
+
+_NOT_OBJECTS = {"ego", "scenicavatar"}
+
+
+def _object_names(names):
+    """Normalize object and class names for comparison: lowercase, without trailing digits."""
+    return {re.sub(r"\d+$", "", name).lower() for name in names} - _NOT_OBJECTS - {""}
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+class ExampleProfile:
+    """What an example program is about: its instructions, the APIs it calls and the objects it sets up."""
+
+    def __init__(self, path, text):
+        self.path = path
+        self.tokens = estimate_tokens(text)
+        instructions = _LOG_INSTRUCTION.findall(text) or _SPEAK.findall(text)
+        self.terms = Counter(tokenize(" ".join(instructions)))
+        self.apis = set(_CALL.findall(text)) - set(CORE_APIS)
+        objects = [name for pair in _NEW.findall(text) for name in pair]
+        objects += _HEADER_KEY.findall(text)  # setup of the input dictionary shown in the example header
+        self.objects = _object_names(objects)
+
+
+class ExampleRanker:
+    """
+    Ranks example Scenic programs by how similar they are to an exercise.
+
+    Each example is scored as a weighted sum (see WEIGHTS) of
+    1. BM25 of the exercise's instructions against the example's instructions (normalized to the best example),
+    2. overlap (Jaccard) of the APIs the example calls with the APIs retrieved for the exercise, and
+    3. overlap of the objects the example sets up with the exercise's setup.
+
+    Input Arguments:
+    1. paths (list): candidate example programs
+    """
+
+    def __init__(self, paths, k1=1.5, b=0.75):
+        self.profiles = [ExampleProfile(path, library.read(path)) for path in paths]
+        self._k1, self._b = k1, b
+        lengths = [sum(p.terms.values()) for p in self.profiles]
+        self._avg_len = sum(lengths) / len(lengths) if lengths else 0.0
+        df = Counter(term for p in self.profiles for term in p.terms)
+        n = len(self.profiles)
+        self._idf = {term: math.log(1 + (n - freq + 0.5) / (freq + 0.5)) for term, freq in df.items()}
+
+    def _bm25(self, profile, terms):
+        length = sum(profile.terms.values())
+        total = 0.0
+        for term in terms:
+            tf = profile.terms.get(term, 0)
+            if not tf:
+                continue
+            norm = tf + self._k1 * (1 - self._b + self._b * length / (self._avg_len or 1))
+            total += self._idf[term] * tf * (self._k1 + 1) / norm
+        return total
+
+    def rank(self, instructions, apis=(), objects=()):
+        """
+        Return:
+        list of (ExampleProfile, score, {signal: value}), best first
+        """
+        terms = tokenize(" ".join(instructions))
+        apis = set(apis) - set(CORE_APIS)
+        objects = _object_names(objects)
+        text_scores = [self._bm25(p, terms) for p in self.profiles]
+        best = max(text_scores, default=0.0) or 1.0
+        ranked = []
+        for profile, text_score in zip(self.profiles, text_scores):
+            signals = {"instructions": text_score / best,
+                       "apis": _jaccard(profile.apis, apis),
+                       "objects": _jaccard(profile.objects, objects)}
+            score = sum(WEIGHTS[name] * value for name, value in signals.items())
+            ranked.append((profile, score, signals))
+        # Ties keep the original (file) order
+        ranked.sort(key=lambda item: -item[1])
+        return ranked
+
+
+_rankers = {}
+
+
+def load_ranker(paths):
+    """Return the ExampleRanker for paths, rebuilt only when one of the files changed content."""
+    paths = tuple(paths)
+    versions = tuple(library.version(path) for path in paths)
+    cached = _rankers.get(paths)
+    if cached is None or cached[0] != versions:
+        cached = (versions, ExampleRanker(paths))
+        _rankers[paths] = cached
+    return cached[1]
+
+
+def select_examples(annotations, example_files, api_source=None, top_k=None, token_budget=None,
+                    label="prompt"):
+    """
+    Pick the example programs to inline into a prompt for an exercise.
+
+    The candidates are ranked by ExampleRanker and taken best first, up to top_k of them and as long
+    as their estimated tokens fit token_budget; an example that does not fit is skipped in favor of
+    the next one. At least one example is always returned (the best one that fits, or else the smallest).
+
+    Inputs:
+    1. annotations (dict): the exercise JSON ("instruction" list and "setup" dictionary)
+    2. example_files (list): candidate example programs
+    3. api_source (str): contents of actions.py, used to retrieve the APIs the exercise likely needs
+    4. top_k (int), token_budget (int): default EXAMPLE_TOP_K (3) and EXAMPLE_TOKEN_BUDGET (8000)
+    5. label (str): name of the calling stage, used in the printed report
+
+    Return:
+    list of the selected paths, in ranking order
+    """
+    example_files = list(example_files)
+    if not example_files:
+        return []
+    top_k = DEFAULT_TOP_K if top_k is None else top_k
+    token_budget = DEFAULT_TOKEN_BUDGET if token_budget is None else token_budget
+
+    annotations = annotations if isinstance(annotations, dict) else {}
+    instructions = [q for q in annotations.get("instruction", []) if isinstance(q, str)]
+    setup = annotations.get("setup")
+    objects = list(setup) if isinstance(setup, dict) else []
+    apis = []
+    if api_source is not None and instructions:
+        apis = load_api_index(api_source).retrieve(instructions, core=()) or []
+
+    ranked = load_ranker(example_files).rank(instructions, apis, objects)
+    selected = []
+    used = 0
+    for profile, score, _ in ranked:
+        if len(selected) >= top_k:
+            break
+        if used + profile.tokens > token_budget:
+            continue
+        selected.append(profile)
+        used += profile.tokens
+    if not selected:
+        selected = [min((profile for profile, _, _ in ranked), key=lambda p: p.tokens)]
+        used = selected[0].tokens
+
+    total = sum(profile.tokens for profile, _, _ in ranked)
+    print(f"{label}: inlining {len(selected)}/{len(ranked)} example programs "
+          f"({', '.join(os.path.basename(p.path) for p in selected)}), "
+          f"~{used} tokens instead of ~{total}")
+    return [profile.path for profile in selected]
+
+
+_validated = {}
+
+
+def validated_programs(directories, api_names=None, model_classes=None):
+    """
+    Previously generated programs (*.scenic directly inside directories) that pass the static
+    checks of scenic_checker, for use as extra examples. Check results are cached by content hash.
+    """
+    paths = []
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        for path in library.list_files(directory):
+            if not path.endswith(".scenic"):
+                continue
+            key = (library.version(path), frozenset(api_names or ()), frozenset(model_classes or ()))
+            if key not in _validated:
+                _validated[key] = check_program(library.read(path), api_names, model_classes).ok
+            if _validated[key]:
+                paths.append(path)
+    return paths
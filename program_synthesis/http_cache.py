@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from telemetry import span
+
+
+class CachedResponse:
+    """
+    The parts of a requests.Response the download helpers use, for responses served from the cache.
+
+    Attributes:
+    1. status_code (int), content (bytes), headers (dict), url (str)
+    2. from_cache (bool): the body came from the on-disk store
+    3. revalidated (bool): the server was asked and answered 304 Not Modified
+    """
+
+    def __init__(self, url, status_code, content, headers, from_cache=False, revalidated=False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.from_cache = from_cache
+        self.revalidated = revalidated
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 300
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def _max_age(cache_control):
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        if name.lower() == "max-age" and value.isdigit():
+            return int(value)
+    return None
+
+
+class HTTPCache:
+    """
+    On-disk cache for GET requests with ETag / Last-Modified revalidation.
+
+    A stored response younger than its TTL is returned without touching the network. An older one
+    is revalidated with If-None-Match / If-Modified-Since: a 304 costs one round trip without a
+    body and refreshes the entry, a 200 replaces it. Only successful responses are stored, and
+    `Cache-Control: no-store` is honored; a `max-age` sent by the server overrides the default TTL,
+    but not a TTL passed to get() explicitly.
+
+    Input Arguments:
+    1. cache_dir (str): directory of the store (one .json metadata file and one .body file per URL)
+    2. ttl (float): seconds a stored response is used without revalidation; 0 always revalidates
+    3. timeout (float): request timeout in seconds
+    4. session (requests.Session): session to send requests on; a pooled one is created if None
+    """
+
+    def __init__(self, cache_dir="http_cache", ttl=60, timeout=30, session=None, pool_size=8):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.timeout = timeout
+        os.makedirs(cache_dir, exist_ok=True)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self.stats = {"fresh": 0, "revalidated": 0, "fetched": 0, "errors": 0}
+        self._lock = threading.Lock()
+        self._url_locks = {}
+
+    def _paths(self, url):
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir, digest)
+        return base + ".json", base + ".body"
+
+    def _url_lock(self, url):
+        # Concurrent requests for the same URL wait for one fetch instead of all going to the server
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def _load(self, url):
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+        if meta.get("url") != url or hashlib.sha256(body).hexdigest() != meta.get("sha256"):
+            return None, None
+        return meta, body
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _store(self, url, meta, body):
+        meta_path, body_path = self._paths(url)
+        meta["sha256"] = hashlib.sha256(body).hexdigest()
+        # Body first: a metadata file always describes a complete body
+        self._write(body_path, body)
+        self._write(meta_path, json.dumps(meta).encode("utf-8"))
+
+    def get(self, url, headers=None, ttl=None):
+        """
+        GET url through the cache.
+
+        Inputs:
+        1. url (str)
+        2. headers (dict): request headers (e.g. Accept)
+        3. ttl (float): overrides the cache's TTL and the server's max-age for this call (0 always
+           revalidates)
+
+        Return:
+        CachedResponse
+        """
+        with self._url_lock(url):
+            meta, body = self._load(url)
+            if ttl is not None:
+                lifetime = ttl
+            elif meta is not None and meta.get("max_age") is not None:
+                lifetime = meta["max_age"]
+            else:
+                lifetime = self.ttl
+            if meta is not None and time.time() - meta["stored_at"] < lifetime:
+                self.stats["fresh"] += 1
+                return CachedResponse(url, meta["status_code"], body, meta["headers"], from_cache=True)
+
+            request_headers = dict(headers or {})
+            if meta is not None:
+                if meta["headers"].get("ETag"):
+                    request_headers["If-None-Match"] = meta["headers"]["ETag"]
+                if meta["headers"].get("Last-Modified"):
+                    request_headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+            try:
+                with span("http_get", url=url, conditional=meta is not None) as http_span:
+                    response = self.session.get(url, headers=request_headers, timeout=self.timeout)
+                    http_span.set(status=response.status_code, bytes=len(response.content))
+            except requests.RequestException:
+                self.stats["errors"] += 1
+                raise
+
+            if response.status_code == 304 and meta is not None:
+                self.stats["revalidated"] += 1
+                meta["stored_at"] = time.time()
+                self._store(url, meta, body)
+                return CachedResponse(url, meta["status_code"], body, meta["headers"],
+                                      from_cache=True, revalidated=True)
+
+            kept_headers = {k: response.headers[k] for k in ("ETag", "Last-Modified", "Content-Type", "Cache-Control")
+                            if k in response.headers}
+            result = CachedResponse(url, response.status_code, response.content, kept_headers)
+            if response.status_code != 200:
+                self.stats["errors"] += 1
+                return result
+            self.stats["fetched"] += 1
+            cache_control = response.headers.get("Cache-Control", "")
+            if "no-store" not in cache_control.lower():
+                self._store(url, {"url": url, "status_code": 200, "headers": kept_headers,
+                                  "stored_at": time.time(), "max_age": _max_age(cache_control)},
+                            response.content)
+            return result
+
+    def clear(self):
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith((".json", ".body")):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_http_cache():
+    """Process-wide HTTPCache in $HTTP_CACHE_DIR (default ./http_cache) with TTL $HTTP_CACHE_TTL (default 60 s)."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = HTTPCache(os.environ.get("HTTP_CACHE_DIR", "http_cache"),
+                               ttl=float(os.environ.get("HTTP_CACHE_TTL", 60)))
+        return _cache
+
+
+def cached_get(url, headers=None, ttl=None):
+    """GET url through the process-wide HTTP cache. See HTTPCache.get."""
+    return get_http_cache().get(url, headers=headers, ttl=ttl)
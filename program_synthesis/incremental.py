@@ -0,0 +1,222 @@
+import difflib
+import json
+import os
+import re
+import time
+
+from condition_optimizer import optimize_program
+from model_index import load_model_classes
+from prompt_library import library
+from scenic_checker import check_program, known_api_names
+from scenic_writer import instruction_step_generator
+from stage_graph import StageGraph
+
+
+_STEP_MARKER = re.compile(r"^(\s*#\s*-{3,}\s*(?:INSTRUCTION STEP|Instruction Step|Instruction|Step)\s+)(\d+)\b(.*)$",
+                          re.IGNORECASE)
+_SECTION_MARKER = re.compile(r"^\s*#\s*-{3,}")
+_LOGS_START = re.compile(r"^logs\s*=\s*\{\s*$")
+
+
+def steps_path(save_file_path):
+    """Sidecar file that stores the annotations and step -> code block mapping of a program."""
+    return save_file_path + ".steps.json"
+
+
+def split_program(program):
+    """
+    Split a generated program at its step markers: `# ---------- Instruction n ----------`, or the
+    `Instruction Step n`, `Step n` and `STEP n` variants of the example programs.
+
+    Return:
+    tuple: (header (str), list of step blocks (str), footer (str)) or None if the program has no
+    step markers. Each step block starts with its marker line.
+    """
+    lines = program.splitlines(keepends=True)
+    starts = [i for i, line in enumerate(lines) if _STEP_MARKER.match(line)]
+    if not starts:
+        return None
+    end = len(lines)
+    for i in range(starts[-1] + 1, len(lines)):
+        if _SECTION_MARKER.match(lines[i]) and not _STEP_MARKER.match(lines[i]):
+            end = i
+            break
+    bounds = starts + [end]
+    header = "".join(lines[:starts[0]])
+    blocks = ["".join(lines[bounds[k]:bounds[k + 1]]) for k in range(len(starts))]
+    footer = "".join(lines[end:])
+    return header, blocks, footer
+
+
+def step_mapping(program, instruction_list):
+    """Return the per-step mapping stored next to a program: step index -> instruction and line range."""
+    parts = split_program(program)
+    if parts is None:
+        return []
+    header, blocks, _ = parts
+    line = header.count("\n") + 1
+    mapping = []
+    for i, block in enumerate(blocks):
+        n_lines = block.count("\n")
+        mapping.append({"index": i,
+                        "instruction": instruction_list[i] if i < len(instruction_list) else None,
+                        "start_line": line, "end_line": line + n_lines - 1})
+        line += n_lines
+    return mapping
+
+
+def save_steps(save_file_path, annotations, program):
+    instruction_list = annotations.get("instruction", [])
+    with open(steps_path(save_file_path), "w") as file:
+        json.dump({"annotations": annotations,
+                   "steps": step_mapping(program, instruction_list)}, file, indent=4)
+
+
+def _renumber(block, index, offset):
+    lines = block.splitlines(keepends=True)
+    match = _STEP_MARKER.match(lines[0])
+    lines[0] = f"{match.group(1)}{index + offset}{match.group(3)}" + ("\n" if lines[0].endswith("\n") else "")
+    return "".join(lines)
+
+
+def _render_logs(instruction_list):
+    entries = []
+    for i, instruction in enumerate(instruction_list):
+        entries.append(f'''    {i}: {{
+        "ActionAPI": "",
+        "Instruction": {json.dumps(instruction)},
+        "Time_Taken": 0,
+        "Completeness": False
+    }}''')
+    return "logs = {\n" + ",\n".join(entries) + "\n}\n"
+
+
+def _replace_logs(header, instruction_list):
+    lines = header.splitlines(keepends=True)
+    start = next((i for i, line in enumerate(lines) if _LOGS_START.match(line)), None)
+    if start is None:
+        return None
+    end = next((i for i in range(start + 1, len(lines)) if lines[i].rstrip() == "}"), None)
+    if end is None:
+        return None
+    return "".join(lines[:start]) + _render_logs(instruction_list) + "".join(lines[end + 1:])
+
+
+def _clean_block(text, marker):
+    text = re.sub(r"^\s*```\w*\s*\n|\n\s*```\s*$", "", text.strip("\n"))
+    lines = text.splitlines()
+    # Keep everything from the marker line on, in case the LLM added anything before it
+    start = next((i for i, line in enumerate(lines) if _STEP_MARKER.match(line)), None)
+    if start is None:
+        lines = [marker] + lines
+    else:
+        lines = lines[start:]
+    return "\n".join(lines).rstrip() + "\n\n"
+
+
+def plan_edit(old_annotations, new_annotations, program):
+    """
+    Decide whether new_annotations can be produced by editing program instead of re-synthesizing.
+
+    Return:
+    tuple: (plan, reason). plan is a list of ("keep", old block index) / ("new", new step index)
+    entries in the new step order, or None with the reason a full synthesis is needed.
+    """
+    others_old = {k: v for k, v in old_annotations.items() if k != "instruction"}
+    others_new = {k: v for k, v in new_annotations.items() if k != "instruction"}
+    if others_old != others_new:
+        return None, "fields other than the instructions changed"
+    parts = split_program(program)
+    if parts is None:
+        return None, "the program has no step markers"
+    _, blocks, _ = parts
+    old_steps, new_steps = old_annotations.get("instruction", []), new_annotations.get("instruction", [])
+    if len(blocks) != len(old_steps):
+        return None, "the program's steps do not line up with the previous instructions"
+
+    matcher = difflib.SequenceMatcher(a=old_steps, b=new_steps, autojunk=False)
+    plan = []
+    first_edit = None
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            plan.extend(("keep", i) for i in range(i1, i2))
+        else:
+            first_edit = i1 if first_edit is None else first_edit
+            plan.extend(("new", j) for j in range(j1, j2))
+    if first_edit is None:
+        return plan, None
+    for j in range(len(new_steps)):
+        if "repeat" in str(new_steps[j]).lower() and any(kind == "new" and idx == j for kind, idx in plan):
+            return None, "an edited step is a repeat step"
+    for kind, i in plan:
+        # Repeat loops replay the code of earlier steps, which would go stale after an edit before them
+        if kind == "keep" and i >= first_edit and re.search(r"^\s*for\b", blocks[i], re.MULTILINE):
+            return None, "a repeat loop follows an edited step"
+    return plan, None
+
+
+def resynthesize(synth, old_annotations, program):
+    """
+    Update an existing program after a therapist edited some of its instructions.
+
+    Only changed or inserted steps are sent to the LLM (in parallel); their blocks are spliced into
+    the existing program, steps are renumbered and the logs dictionary is rewritten.
+
+    Inputs:
+    1. synth (scenic_writer.Synth): synthesizer for the new annotations
+    2. old_annotations (dict): annotations the existing program was generated from
+    3. program (str): the existing program
+
+    Return:
+    the updated program (str), or None if a full synthesis is needed instead
+    """
+    start = time.perf_counter()
+    plan, reason = plan_edit(old_annotations, synth.annotations, program)
+    if plan is None:
+        print(f"Incremental synthesis not possible ({reason}); synthesizing from scratch")
+        return None
+    header, blocks, footer = split_program(program)
+    new_steps = synth.annotations["instruction"]
+    first = _STEP_MARKER.match(blocks[0].splitlines()[0]) if blocks else None
+    offset = int(first.group(2)) if first else 0
+    # New steps get the program's marker style without the first step's description
+    # (e.g. "# ---------- Step 0: Pick up the duster ----------")
+    marker_style = f"{first.group(1)}{offset} ----------" if first else "    # ---------- Instruction 0 ----------"
+
+    graph = StageGraph()
+    for kind, j in plan:
+        if kind == "new":
+            marker = _renumber(marker_style, j, offset).rstrip("\n")
+            graph.add_stage(j, lambda j=j, marker=marker: _clean_block(
+                instruction_step_generator(new_steps[j], marker, program, synth.api_file_path), marker))
+    generated = graph.run()
+
+    new_blocks = []
+    for position, (kind, j) in enumerate(plan):
+        block = blocks[j] if kind == "keep" else generated[j]
+        new_blocks.append(_renumber(block, position, offset))
+    new_header = _replace_logs(header, new_steps)
+    if new_header is None:
+        print("Incremental synthesis not possible (no logs dictionary in the program header)")
+        return None
+    updated = optimize_program(new_header + "".join(new_blocks) + footer, label="resynthesize")
+
+    result = check_program(updated, known_api_names(synth.api_file_path),
+                           load_model_classes(library.read(synth.model_file_path)))
+    if not result.ok:
+        print("Spliced program failed static checks; synthesizing from scratch")
+        print(result)
+        return None
+    print(f"Re-synthesized {len(generated)} of {len(new_steps)} steps in {time.perf_counter() - start:.2f}s")
+    return updated
+
+
+def load_previous(save_file_path):
+    """Return (previous annotations, previous program) for save_file_path, or (None, None)."""
+    if not (os.path.exists(save_file_path) and os.path.exists(steps_path(save_file_path))):
+        return None, None
+    with open(steps_path(save_file_path), "r") as file:
+        meta = json.load(file)
+    with open(save_file_path, "r") as file:
+        program = file.read()
+    return meta.get("annotations"), program
@@ -0,0 +1,234 @@
+import re
+
+
+_NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+                 "eight": 8, "nine": 9, "ten": 10, "once": 1, "twice": 2, "first": 1, "second": 2,
+                 "third": 3, "fourth": 4, "fifth": 5}
+
+_NUM = r"(\d+|" + "|".join(_NUMBER_WORDS) + r")"
+
+_STEP_PREFIX = re.compile(r"^\s*\d+\s*[.)]\s*")
+_REST = re.compile(r"\b(rest|relax|take an? (?:brief |short )?(?:break|rest)|pause)\b")
+_RANGE = r"\s*(?:[-\u2013\u2014]|to|through|and)\s*"   # "1-3", "1\u20133" (en dash), "1 to 3"
+_MORE = r"(?:more|additional|extra)\s+"
+_TIMES = r"(?:times?|reps?|repetitions?)\b"
+_REPEAT = re.compile(r"\brepeat\b(?:\s+(?:the\s+)?(?:steps?|instructions?)\s+" + _NUM
+                     + r"(?:" + _RANGE + _NUM + r")?)?.*?\b" + _NUM
+                     + r"\s+(" + _MORE + r")?" + _TIMES)
+# Every step reference and ordinal ("the first and second steps") of a repeat step, to check
+# that _REPEAT understood all of them
+_STEP_REFERENCE = re.compile(r"\b(?:steps?|instructions?)\s+" + _NUM + r"(?:" + _RANGE + _NUM + r")?"
+                             + r"\b(?!\s+(?:" + _MORE + r")?" + _TIMES + r")")
+_ORDINAL_STEPS = re.compile(r"\b((?:(?:first|second|third|fourth|fifth)(?:\s*,\s*|\s+and\s+|\s+)){1,5})steps?\b")
+_COUNT_RANGE = re.compile(_NUM + r"\s*(?:[-\u2013\u2014]|to)\s*$")
+# A second action after the one a rule matched ("grab fork1 and put it in the box"), or a pronoun
+# standing for an object: such steps are left to the LLM
+_COMPOUND = re.compile(r"(?:\band\b|\bthen\b|,)\s*(?:then\s+)?(?:\w+\s+)?(?:pick|grab|grasp|take|put|place|move|"
+                       r"bring|drop|transfer|walk|go|step|lift|hold|release|let|return|touch|reach|wipe|"
+                       r"open|close|turn|rotate|push|pull|raise|lower|set|carry|slide|stack|pour|rest|relax|"
+                       r"pause|sit|stand)\b"
+                       r"|\b(?:it|them)\b")
+# "... for placeholders 2-5", "with the other cup": a repeat that moves on to other objects
+_REPEAT_OBJECTS = re.compile(r"\b(?:for|with|using|on|at|to)\s+(?:the\s+)?(?:other\s+|remaining\s+|next\s+)?([\w -]+)")
+_WALK = re.compile(r"\b(?:walk|move|step|go)\s+(?:over\s+)?(?:to|toward|towards)\s+(?:the\s+)?([\w ]+)")
+_TOGETHER = re.compile(r"\bbring\s+(?:the\s+)?([\w ]+?)\s+and\s+(?:the\s+)?([\w ]+?)\s+together\b")
+_PLACE = re.compile(r"\b(?:move|place|put|bring|transfer|drop)\s+(?:the\s+)?([\w ]+?)\s+"
+                    r"(?:in|into|on|onto|to|toward|towards|inside|next to)\s+(?:the\s+)?([\w ]+)")
+_PICK = re.compile(r"\b(?:pick up|grab|grasp|take hold of)\s+(?:the\s+)?([\w ]+)")
+
+
+def _to_int(word):
+    return int(word) if word.isdigit() else _NUMBER_WORDS[word]
+
+
+class ObjectMatcher:
+    """Maps words in an instruction onto names in the scene's object list (e.g. 'spoon' -> 'spoon1')."""
+
+    def __init__(self, object_list):
+        self.names = {}
+        bases = {}
+        for obj in object_list:
+            if obj == "ego":
+                continue
+            self.names[obj.lower()] = obj
+            base = re.sub(r"\d+$", "", obj).lower()
+            bases.setdefault(base, []).append(obj)
+        for base, objs in bases.items():
+            if len(objs) == 1:  # only unambiguous base names
+                self.names.setdefault(base, objs[0])
+                self.names.setdefault(base.replace("_", " "), objs[0])
+
+    def find(self, phrase):
+        """Return the object named at the start of phrase, or None."""
+        words = phrase.lower().split()
+        for n in range(min(4, len(words)), 0, -1):
+            candidate = " ".join(words[:n])
+            for key in (candidate, candidate.replace(" ", "_")):
+                if key in self.names:
+                    return self.names[key]
+        # "the pair of chopsticks" -> "chopsticks"
+        for word in words[:4]:
+            if word in self.names:
+                return self.names[word]
+        return None
+
+    def mentions(self, phrase):
+        """Whether a word of phrase (singular or plural) is part of a scene object's name."""
+        parts = {part for name in self.names for part in re.split(r"[_\s\d]+", name) if part}
+        return any(word in parts or word.rstrip("s") in parts for word in re.findall(r"[a-z]+", phrase.lower()))
+
+
+class InstructionPlan:
+    """
+    Result of matching an exercise's instruction steps against the local rules.
+
+    Attributes:
+    1. resolved (dict): step index -> API call for steps matched by a rule
+    2. repeats (dict): step index -> (first step, last step, copies) for recognized repeat steps,
+       where copies is how many more times the steps run ("3 times" -> 2, "3 more times" -> 3)
+    3. unmatched (list): step indices that still need the LLM
+    4. needs_full_llm (bool): True when the steps cannot be split (e.g. a repeat step the rules
+       could not parse); the caller should then send every step to the LLM
+    """
+
+    def __init__(self, instruction_list):
+        self.instruction_list = list(instruction_list)
+        self.resolved = {}
+        self.repeats = {}
+        self.unmatched = []
+        self.needs_full_llm = False
+
+    @property
+    def local_fraction(self):
+        total = len(self.instruction_list)
+        return (len(self.resolved) + len(self.repeats)) / total if total else 1.0
+
+    @property
+    def complete(self):
+        return not self.unmatched and not self.needs_full_llm
+
+    def merge(self, llm_apis):
+        """
+        Combine the locally resolved steps with the LLM's answer for the unmatched steps.
+
+        Input:
+        llm_apis (dict): step index (int or str) -> API call, covering the unmatched steps
+
+        Return:
+        dictionary in the api_retriever format: contiguous str keys "0", "1", ... -> API call,
+        with repeat steps expanded into copies of the repeated steps' APIs
+        """
+        llm_apis = {int(k): v for k, v in (llm_apis or {}).items()}
+        per_step = {}
+        for i in range(len(self.instruction_list)):
+            if i in self.repeats:
+                first, last, copies = self.repeats[i]
+                block = [api for j in range(first, last + 1) for api in per_step.get(j, [])]
+                per_step[i] = block * copies
+            elif i in self.resolved:
+                per_step[i] = [self.resolved[i]]
+            elif i in llm_apis:
+                per_step[i] = [llm_apis[i]]
+            else:
+                per_step[i] = []
+        apis = [api for i in range(len(self.instruction_list)) for api in per_step[i]]
+        return {str(k): api for k, api in enumerate(apis)}
+
+
+def plan_instruction_apis(instruction_list, object_list, api_names=None):
+    """
+    Resolve stereotyped instruction steps to API calls locally, without an LLM call.
+
+    Recognized patterns:
+    - resting / taking a break                          -> Buffer()
+    - walking or moving towards a scene object          -> AvatarMoveOrWalkTowardsSomething(ego, obj)
+    - bringing two scene objects together, or placing
+      one scene object into/onto/towards another        -> CheckDistance(obj1, obj2)
+    - picking up / grabbing a scene object              -> ObjectGrasped(obj)
+    - "repeat steps a-b N times"                        -> the APIs of steps a..b, N - 1 more times
+      ("N more times": N more times); a repeat naming other objects ("for placeholders 2-5") is
+      left to the LLM, since the copies have to check those objects instead
+
+    Steps with a second action or a pronoun object ("grab fork1 and put it in the box"), and repeats
+    whose step range or count is only partly understood, are left to the LLM.
+
+    Inputs:
+    1. instruction_list (list): the exercise's instruction steps
+    2. object_list (list): names of the objects in the scene
+    3. api_names (set): APIs available in actions.py; rules whose API is missing are skipped
+
+    Return:
+    InstructionPlan
+    """
+    matcher = ObjectMatcher(object_list)
+    plan = InstructionPlan(instruction_list)
+
+    def allowed(api):
+        return api_names is None or api in api_names
+
+    for i, step in enumerate(plan.instruction_list):
+        text = _STEP_PREFIX.sub("", str(step)).lower().strip()
+
+        repeat = _REPEAT.search(text)
+        if repeat:
+            first, last, times, more = repeat.groups()
+            references = _STEP_REFERENCE.findall(text)
+            ordinals = [_to_int(w) for m in _ORDINAL_STEPS.finditer(text) for w in re.findall(r"[a-z]+", m.group(1))
+                        if w in _NUMBER_WORDS]
+            if first is not None:
+                first_step = _to_int(first) - 1
+                last_step = _to_int(last) - 1 if last else first_step
+            elif ordinals:
+                # "Repeat the first and second steps ..."
+                first_step, last_step = min(ordinals) - 1, max(ordinals) - 1
+            else:
+                # "Repeat these steps N times" repeats everything before this step
+                first_step, last_step = 0, i - 1
+            # A step reference _REPEAT did not take in whole (e.g. the end of an unusual range),
+            # gaps between ordinals, or a range of counts ("3-5 times") is left to the LLM
+            understood = (references == ([(first, last or "")] if first is not None else [])
+                          and (not ordinals or sorted(ordinals) == list(range(first_step + 1, last_step + 2)))
+                          and not _COUNT_RANGE.search(text[:repeat.start(3)]))
+            others = [m.group(1) for m in _REPEAT_OBJECTS.finditer(text) if matcher.mentions(m.group(1))]
+            copies = _to_int(times) if more else _to_int(times) - 1
+            if 0 <= first_step <= last_step < i and understood and not others:
+                plan.repeats[i] = (first_step, last_step, copies)
+                continue
+        if "repeat" in text:
+            # A repeat we cannot parse changes how many API calls the other steps expand to,
+            # so the LLM has to see the whole exercise
+            plan.unmatched.append(i)
+            plan.needs_full_llm = True
+            continue
+
+        api = None
+        together = _TOGETHER.search(text)
+        walk = _WALK.search(text)
+        place = _PLACE.search(text)
+        pick = _PICK.search(text)
+        if together and allowed("CheckDistance"):
+            a, b = matcher.find(together.group(1)), matcher.find(together.group(2))
+            if a and b:
+                api = f"CheckDistance({a}, {b})"
+        if api is None and place and allowed("CheckDistance"):
+            a, b = matcher.find(place.group(1)), matcher.find(place.group(2))
+            if a and b and a != b:
+                api = f"CheckDistance({a}, {b})"
+        if api is None and walk and allowed("AvatarMoveOrWalkTowardsSomething"):
+            target = matcher.find(walk.group(1))
+            if target:
+                api = f"AvatarMoveOrWalkTowardsSomething(ego, {target})"
+        if api is None and pick and allowed("ObjectGrasped"):
+            target = matcher.find(pick.group(1))
+            if target:
+                api = f"ObjectGrasped({target})"
+        if api is None and _REST.search(text) and not (place or pick) and allowed("Buffer"):
+            api = "Buffer()"
+
+        if api is not None and _COMPOUND.search(text):
+            api = None
+        if api is None:
+            plan.unmatched.append(i)
+        else:
+            plan.resolved[i] = api
+    return plan
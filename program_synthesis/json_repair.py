@@ -0,0 +1,199 @@
+import ast
+import json
+import re
+
+
+_FENCE = re.compile(r"```(?:json|JSON|python)?\s*\n?(.*?)```", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+_BARE_KEY = re.compile(r"([{,]\s*)(-?\d+|[A-Za-z_]\w*)(\s*:)")
+
+
+class JSONRepairError(ValueError):
+    pass
+
+
+def _outermost(text):
+    """Return the first balanced {...} or [...] in text (ignoring brackets inside strings), or None."""
+    start = None
+    depth = 0
+    quote = None
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            if ch == "\\":
+                i += 2
+                continue
+            if ch == quote:
+                quote = None
+        elif ch in "\"'" and start is not None:
+            quote = ch
+        elif ch in "{[":
+            if start is None:
+                start = i
+            depth += 1
+        elif ch in "}]" and start is not None:
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+        i += 1
+    return None
+
+
+def _literal(text):
+    """Parse Python-literal syntax (single quotes, True/False/None, int keys) with ast.literal_eval."""
+    text = re.sub(r"\btrue\b", "True", text)
+    text = re.sub(r"\bfalse\b", "False", text)
+    text = re.sub(r"\bnull\b", "None", text)
+    return ast.literal_eval(text)
+
+
+def _stringify_keys(obj):
+    if isinstance(obj, dict):
+        return {str(k): _stringify_keys(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_stringify_keys(v) for v in obj]
+    return obj
+
+
+def repair_json(text):
+    """
+    Parse LLM output that was supposed to be JSON, repairing the usual breakage locally:
+    markdown code fences, prose before or after the JSON, single-quoted strings, Python literals
+    (True/False/None), unquoted integer or identifier keys and trailing commas.
+
+    Return:
+    tuple: (parsed object, list of the repairs that were needed)
+
+    Raises JSONRepairError if the text cannot be repaired.
+    """
+    if text is None:
+        raise JSONRepairError("no output")
+    try:
+        return json.loads(text), []
+    except ValueError:
+        pass
+
+    repairs = []
+    candidate = text.strip()
+    fence = _FENCE.search(candidate)
+    if fence:
+        candidate = fence.group(1).strip()
+        repairs.append("code fence")
+    outer = _outermost(candidate)
+    if outer is None:
+        raise JSONRepairError("no JSON object or array in output")
+    if outer != candidate:
+        repairs.append("surrounding prose")
+    candidate = outer
+
+    attempts = [
+        ("trailing comma", lambda t: json.loads(_TRAILING_COMMA.sub(r"\1", t))),
+        ("unquoted keys", lambda t: json.loads(_BARE_KEY.sub(r'\1"\2"\3', _TRAILING_COMMA.sub(r"\1", t)))),
+        ("python literal", lambda t: _stringify_keys(_literal(t))),
+    ]
+    try:
+        return json.loads(candidate), repairs
+    except ValueError:
+        pass
+    for name, parse in attempts:
+        try:
+            return parse(candidate), repairs + [name]
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            continue
+    raise JSONRepairError("output is not valid JSON after repairs")
+
+
+class JSONSchema:
+    """
+    Expected shape of one LLM stage's JSON output: a dictionary with string keys.
+
+    Input Arguments:
+    1. name (str): stage name, used in messages
+    2. keys (list): keys that must be present (e.g. the object names given to obj_model_finder)
+    3. contiguous (bool): keys must be the integers 0..n-1 (as strings); with keys=None, n is taken
+       from the largest key present, so gaps are reported as missing
+    4. value_type (type): required type of every value
+    """
+
+    def __init__(self, name, keys=None, contiguous=False, value_type=str):
+        self.name = name
+        self.keys = [str(k) for k in keys] if keys is not None else None
+        self.contiguous = contiguous
+        self.value_type = value_type
+
+    def check(self, obj):
+        """
+        Return:
+        tuple: (valid entries (dict), missing keys (list), problems (list of str))
+        """
+        if not isinstance(obj, dict):
+            return {}, list(self.keys or []), [f"{self.name}: expected a JSON dictionary, got {type(obj).__name__}"]
+        problems = []
+        valid = {}
+        for key, value in obj.items():
+            key = str(key).strip()
+            if key.lstrip("-").isdigit():
+                key = str(int(key))  # "01" -> "1"
+            elif self.contiguous:
+                problems.append(f"{self.name}: key {key!r} is not a step index")
+                continue
+            if not isinstance(value, self.value_type) or (isinstance(value, str) and not value.strip()):
+                problems.append(f"{self.name}: value of {key!r} is not a non-empty {self.value_type.__name__}")
+                continue
+            valid[key] = value
+        if self.keys is not None:
+            expected = self.keys
+        elif self.contiguous and valid:
+            expected = [str(i) for i in range(max(int(k) for k in valid) + 1)]
+        else:
+            expected = []
+        missing = [k for k in expected if k not in valid]
+        extra = [k for k in valid if self.keys is not None and k not in self.keys]
+        if extra:
+            problems.append(f"{self.name}: unexpected keys {extra}")
+        return valid, missing, problems
+
+
+def complete_json(query, system_prompt, user_prompt, schema, describe=None, max_reasks=1):
+    """
+    Query a stage that answers with a JSON dictionary and make sure the answer matches schema.
+
+    The output is repaired locally by queryLLM (see repair_json). If entries are still missing or
+    invalid, a short follow-up asks only for those keys, up to max_reasks times, and the answers
+    are merged, so a partly valid answer never costs a re-run of the whole prompt.
+
+    Inputs:
+    1. query (function): queryLLM(system_prompt, user_prompt, json_bool=True) of the calling module
+    2. system_prompt, user_prompt (str): the stage's prompts
+    3. schema (JSONSchema): expected output
+    4. describe (function): key -> text shown next to a missing key in the follow-up (e.g. the instruction)
+    5. max_reasks (int): maximum number of follow-up queries
+
+    Return:
+    dictionary with the valid entries (missing keys are left out if the follow-ups did not supply them)
+    """
+    result, missing, problems = schema.check(query(system_prompt, user_prompt, json_bool=True))
+    for _ in range(max_reasks):
+        if not missing:
+            break
+        print(f"{schema.name}: re-asking for {len(missing)} missing entries {missing}")
+        for problem in problems:
+            print(problem)
+        listing = "\n".join(f"- {k}: {describe(k)}" if describe else f"- {k}" for k in missing)
+        follow_up = f'''{user_prompt}
+
+    Your previous answer was: {json.dumps(result)}
+    It is missing valid entries for these keys:
+    {listing}
+    Return a JSON dictionary containing ONLY these keys, in the same format, without any other text.
+    '''
+        answer, _, problems = JSONSchema(schema.name, missing, False, schema.value_type).check(
+            query(system_prompt, follow_up, json_bool=True))
+        result.update(answer)
+        _, missing, _ = schema.check(result)
+    if missing:
+        print(f"{schema.name}: still missing {missing}")
+    if schema.contiguous:
+        result = dict(sorted(result.items(), key=lambda kv: int(kv[0])))
+    return result
@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+import time
+
+
+STEP_FIELDS = ["Exercise Step", "Successful Instructions", "Failed Instructions",
+               "Omitted Instructions", "Duration of Completion"]
+
+SYMPTOM_FIELDS = {"Pain": "Pain Detection", "Fatigue": "Fatigue", "Dizziness": "Dizziness"}
+
+
+def summarize_step(rec):
+    """Return the summary row (instruction, successful, failed, omitted, duration) of one log record."""
+    instr = rec.get("Instruction", "")
+    time_taken = rec.get("Time_Taken", 0)
+    complete = rec.get("Completeness", False)
+    return (instr, complete, not complete and int(time_taken) != 0,
+            not complete and int(time_taken) == 0, time_taken)
+
+
+class LiveSummarizer:
+    """
+    Follows a session log while the Scenic program is writing it and keeps its summary up to date,
+    so that the report is ready as soon as the exercise ends.
+
+    The generated programs rewrite the whole log file after every instruction step. The summarizer
+    polls the file's mtime and size, and re-reads it only when they change. A read that catches the
+    program in the middle of a write is not valid JSON; it is ignored and retried on the next poll.
+    Only the steps whose records changed since the last read update the summary rows.
+
+    summary() returns the same dictionary as scenic_generator.summarize_logs on the latest log.
+
+    Inputs:
+    1. log_path (str): the session log written by the Scenic program
+    2. poll_interval (float): seconds between checks of the file
+    """
+
+    def __init__(self, log_path, poll_interval=0.25):
+        self.log_path = log_path
+        self.poll_interval = poll_interval
+        self.records = {}   # step index -> log record
+        self.rows = {}      # step index -> summary row
+        self.extras = {}    # non-step keys of the log (Pain, Fatigue, ...)
+        self.reads = 0
+        self.partial_reads = 0
+        self.updated_steps = 0
+        self._signature = None
+        self._summary = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="LiveSummarizer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(self.poll_interval)
+
+    def poll(self):
+        """
+        Check the log once and apply any changes.
+
+        Return:
+        bool: whether the summary changed
+        """
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return False
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return False
+        try:
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                text = f.read()
+            logs_dict = json.loads(text)
+        except (OSError, ValueError):
+            # Caught the program mid-write; the signature is not recorded so the next poll retries
+            self.partial_reads += 1
+            return False
+        self.reads += 1
+        changed = self.apply(logs_dict)
+        self._signature = signature
+        return changed
+
+    def apply(self, logs_dict):
+        """Update the summary rows from a (complete) log dictionary. Return whether anything changed."""
+        if not isinstance(logs_dict, dict):
+            return False
+        steps = {int(k): rec for k, rec in logs_dict.items() if k.isdigit()}
+        extras = {k: v for k, v in logs_dict.items() if not k.isdigit()}
+        with self._lock:
+            changed = False
+            for step in list(self.records):
+                if step not in steps:
+                    # The program restarted and rewrote the log
+                    del self.records[step]
+                    del self.rows[step]
+                    changed = True
+            for step, rec in steps.items():
+                if self.records.get(step) != rec:
+                    self.records[step] = rec
+                    self.rows[step] = summarize_step(rec)
+                    self.updated_steps += 1
+                    changed = True
+            if extras != self.extras:
+                self.extras = extras
+                changed = True
+            if changed:
+                self._summary = None
+        return changed
+
+    def summary(self):
+        """The summary of the latest complete read of the log."""
+        with self._lock:
+            if self._summary is None:
+                summary = {field: [] for field in STEP_FIELDS}
+                for step in sorted(self.rows):
+                    for field, value in zip(STEP_FIELDS, self.rows[step]):
+                        summary[field].append(value)
+                for k, v in self.extras.items():
+                    summary[k] = v
+                for key, field in SYMPTOM_FIELDS.items():
+                    if key in self.extras:
+                        summary[field] = self.extras[key]
+                self._summary = summary
+            return json.loads(json.dumps(self._summary))
+
+    def finish(self, timeout=2.0):
+        """
+        Stop following the log and return the final summary.
+
+        The file is checked one last time; if the last write is still incomplete we keep polling
+        for up to timeout seconds before falling back to the last complete read.
+        """
+        self.stop()
+        deadline = time.monotonic() + timeout
+        before = self.partial_reads
+        self.poll()
+        while self.partial_reads > before and time.monotonic() < deadline:
+            time.sleep(min(self.poll_interval, 0.05))
+            before = self.partial_reads
+            self.poll()
+        return self.summary()
+
+
+def watch_session_log(json_id, log_dir="logs", poll_interval=0.25):
+    """Start a LiveSummarizer on logs/<json_id>.json, the log the exercise's Scenic program writes."""
+    return LiveSummarizer(os.path.join(log_dir, f"{json_id}.json"), poll_interval).start()
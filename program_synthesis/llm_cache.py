@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_cache")
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class ResponseCache:
+    """
+    Disk-backed, content-addressed cache of raw LLM completions.
+
+    Every entry is stored as <sha256>.json inside cache_dir. The key is a hash of everything that
+    determines the completion (model, temperature, json mode, system prompt, user prompt), so the
+    same request made by any stage in scenic_writer or scenic_translator is served from disk.
+    Entries are evicted in least-recently-used order (file mtime is bumped on every hit) once the
+    directory grows past max_bytes or max_entries.
+
+    Input Arguments:
+    1. cache_dir (str): directory holding the cache entries
+    2. max_bytes (int): size cap of the cache directory in bytes
+    3. max_entries (int): optional cap on the number of entries
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, max_entries=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(model, temperature, json_bool, system_prompt, user_prompt):
+        payload = json.dumps([model, temperature, bool(json_bool), system_prompt, user_prompt],
+                             ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """Return the cached completion for key, or None on a miss."""
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                os.utime(path, None)  # mark as most recently used
+            except (FileNotFoundError, json.JSONDecodeError, OSError):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["output"]
+
+    def put(self, key, output, **metadata):
+        """Store a completion under key and evict old entries if the cache is over its caps."""
+        entry = {"output": output, "created": time.time()}
+        entry.update(metadata)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self._lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        if total <= self.max_bytes and (self.max_entries is None or count <= self.max_entries):
+            return
+        # Oldest access first
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes and (self.max_entries is None or count <= self.max_entries):
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            count -= 1
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for _, _, name in self._entries():
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
+
+
+_cache = None
+
+
+def enable_cache(cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, max_entries=None):
+    """
+    Turn on the shared response cache used by every queryLLM call in this process.
+    """
+    global _cache
+    _cache = ResponseCache(cache_dir, max_bytes, max_entries)
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+
+def get_cache():
+    """Return the shared ResponseCache, or None if caching is off (the default)."""
+    return _cache
+
+
+# Opt in from the environment, e.g. LLM_CACHE_DIR=llm_cache jupyter notebook
+if os.environ.get("LLM_CACHE_DIR"):
+    enable_cache(os.environ["LLM_CACHE_DIR"],
+                 int(os.environ.get("LLM_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)))
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import threading
+import weakref
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+
+GROK_BASE_URL = "https://api.x.ai/v1"
+
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_POOL_SIZE = 10
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+
+
+def _grok_credentials():
+    import api_key as key
+    return key.GROK, GROK_BASE_URL
+
+
+def _openai_credentials():
+    # scenic_translator has always gone through the client configured in api_key.py
+    import api_key as key
+    return key.client.api_key, str(key.client.base_url)
+
+
+PROFILES = {
+    "grok": _grok_credentials,
+    "openai": _openai_credentials,
+}
+
+
+class ClientManager:
+    """
+    Owns one long-lived, keep-alive connection pool per provider profile.
+
+    Constructing OpenAI() per request opens a new connection pool (and a new TLS handshake) on every
+    call and every retry. The manager instead hands out a single OpenAI client per process, backed by
+    a pooled httpx.Client, and one AsyncOpenAI client per running event loop (httpx async pools are
+    bound to the loop that created them). All accessors are safe to call from multiple threads.
+
+    Input Arguments:
+    1. profile (str): key into PROFILES, used to look up the api key and default base_url
+    2. base_url (str): overrides the profile's base_url, e.g. to point at llm_stub_server
+    3. api_key (str): overrides the profile's api key
+    4. timeout (float): request timeout in seconds
+    5. pool_size (int): maximum number of pooled connections
+    6. keepalive_expiry (float): seconds an idle connection is kept open
+    """
+
+    def __init__(self, profile, base_url=None, api_key=None, timeout=DEFAULT_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE, keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY):
+        self.profile = profile
+        self.base_url = base_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.keepalive_expiry = keepalive_expiry
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _credentials(self):
+        api_key, base_url = self.api_key, self.base_url
+        if api_key is None or base_url is None:
+            default_key, default_url = PROFILES[self.profile]()
+            api_key = api_key if api_key is not None else default_key
+            base_url = base_url if base_url is not None else default_url
+        return api_key, base_url
+
+    def _limits(self):
+        return httpx.Limits(max_connections=self.pool_size,
+                            max_keepalive_connections=self.pool_size,
+                            keepalive_expiry=self.keepalive_expiry)
+
+    def configure(self, **settings):
+        """
+        Update base_url, api_key, timeout, pool_size or keepalive_expiry.
+        Existing clients are dropped and rebuilt lazily with the new settings.
+        """
+        with self._lock:
+            for name, value in settings.items():
+                if not hasattr(self, name) or name.startswith("_"):
+                    raise ValueError(f"Unknown client setting: {name}")
+                setattr(self, name, value)
+            old_client, self._client = self._client, None
+            self._async_clients = weakref.WeakKeyDictionary()
+        if old_client is not None:
+            old_client.close()
+
+    def client(self):
+        """Return the shared, pooled OpenAI client for this profile."""
+        with self._lock:
+            if self._client is None:
+                api_key, base_url = self._credentials()
+                http_client = httpx.Client(limits=self._limits(), timeout=self.timeout)
+                # Retries are left to llm_scheduler, which knows the synthesis deadline
+                self._client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0,
+                                      timeout=self.timeout, http_client=http_client)
+            return self._client
+
+    def async_client(self):
+        """Return the pooled AsyncOpenAI client bound to the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                api_key, base_url = self._credentials()
+                http_client = httpx.AsyncClient(limits=self._limits(), timeout=self.timeout)
+                client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0,
+                                     timeout=self.timeout, http_client=http_client)
+                self._async_clients[loop] = client
+            return client
+
+    def close(self):
+        with self._lock:
+            old_client, self._client = self._client, None
+            self._async_clients = weakref.WeakKeyDictionary()
+        if old_client is not None:
+            old_client.close()
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_manager(profile):
+    """
+    Return the process-wide ClientManager for profile. LLM_BASE_URL, LLM_TIMEOUT and
+    LLM_POOL_SIZE override the defaults of every profile (e.g. to use a local stand-in server).
+    """
+    with _managers_lock:
+        if profile not in _managers:
+            _managers[profile] = ClientManager(
+                profile,
+                base_url=os.environ.get("LLM_BASE_URL"),
+                timeout=float(os.environ.get("LLM_TIMEOUT", DEFAULT_TIMEOUT)),
+                pool_size=int(os.environ.get("LLM_POOL_SIZE", DEFAULT_POOL_SIZE)),
+            )
+        return _managers[profile]
+
+
+def configure(profile, **settings):
+    get_manager(profile).configure(**settings)
+
+
+def get_client(profile):
+    return get_manager(profile).client()
+
+
+def get_async_client(profile):
+    return get_manager(profile).async_client()
@@ -0,0 +1,484 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import email.utils
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import openai
+
+from backoff import decorrelated_jitter
+from rate_limiter import get_rate_limiter
+from telemetry import tracer
+
+
+DEFAULT_CALL_TIMEOUT = 120.0
+
+# Status codes worth another attempt that say nothing about the endpoint being down
+RETRY_STATUS = {408, 409, 425, 429}
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+_deadline = contextvars.ContextVar("llm_deadline", default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Give every LLM call made inside the block an overall deadline of seconds from now.
+
+    The deadline is kept in a context variable, so it follows the calls into asyncio tasks and into
+    StageGraph threads. Each request's timeout is cut to the time that is left, no retry or backoff
+    starts past it, and nested deadlines can only shorten the outer one. seconds=None keeps the
+    current deadline (if any).
+    """
+    if seconds is None:
+        yield remaining()
+        return
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        at = min(at, current)
+    token = _deadline.set(at)
+    try:
+        yield at - time.monotonic()
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left until the current deadline, or None without a deadline."""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def default_deadline():
+    """Synthesis deadline in seconds from $SYNTH_DEADLINE, or None when it is not set."""
+    value = os.environ.get("SYNTH_DEADLINE")
+    return float(value) if value else None
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast while an endpoint is down.
+
+    After failure_threshold consecutive endpoint failures (connection errors, timeouts, 5xx) the
+    breaker opens and every call raises CircuitOpenError without touching the network. Once
+    reset_timeout seconds have passed, a single trial call is let through (half-open): its success
+    closes the breaker, its failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"{self.name} endpoint is failing; circuit open for "
+                                           f"{self.reset_timeout - (time.monotonic() - self.opened_at):.1f}s more")
+                self.state = "half_open"
+                self._trial = False
+            if self.state == "half_open":
+                if self._trial:
+                    raise CircuitOpenError(f"{self.name} endpoint is failing; trial request in flight")
+                self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"Circuit for {self.name} opened after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+    def release(self):
+        """End a half-open trial that failed for reasons unrelated to the endpoint."""
+        with self._lock:
+            self._trial = False
+
+
+def retry_after(error):
+    """Seconds the provider asked to wait (Retry-After / retry-after-ms headers of a 429 or 503), or None."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify(error):
+    """
+    Return:
+    tuple: (retryable (bool), endpoint failure that counts against the circuit breaker (bool))
+    """
+    if isinstance(error, openai.APIConnectionError):  # includes APITimeoutError
+        return True, True
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code >= 500:
+            return True, True
+        # Any other 4xx means the request itself was rejected (bad request, auth, unknown model)
+        return error.status_code in RETRY_STATUS, False
+    # Unparseable JSON and unexpected errors have always been retried
+    return True, False
+
+
+class LLMScheduler:
+    """
+    Runs LLM requests with a per-synthesis deadline, retries, hedging and a circuit breaker.
+
+    A request is a function fn(timeout) that sends one request with the given timeout and returns
+    the parsed answer; it may raise to ask for a retry (e.g. on unparseable JSON). call() /
+    call_async() run it until it succeeds or max_attempts is reached, waiting a decorrelated-jitter
+    backoff between attempts. The timeout passed to fn is call_timeout cut to what is left of the
+    deadline (see deadline()).
+
+    When the endpoint has a rate limiter (see rate_limiter.get_rate_limiter), every request first
+    waits for its turn under the shared requests/tokens per minute budget. A 429 is not backed off
+    locally: its Retry-After is handed to the limiter, which holds back every process using the key.
+
+    With hedge=True, a request that is still waiting after the p95 latency of earlier successful
+    requests of the same stage gets a duplicate; the first answer wins. The async path cancels the
+    loser; the sync path abandons it (its answer is discarded when it arrives).
+
+    Input Arguments:
+    1. call_timeout (float): timeout of a single request when the deadline is further away
+    2. max_attempts (int): attempts per call
+    3. backoff_base, backoff_cap (float): decorrelated-jitter backoff bounds in seconds
+    4. hedge (bool): send a duplicate request after the stage's p95 latency
+    5. hedge_min_samples (int): successful requests of a stage needed before it is hedged
+    6. latency_window (int): recent latencies kept per stage for the p95
+    7. failure_threshold (int), reset_timeout (float): circuit breaker settings per endpoint
+    """
+
+    def __init__(self, call_timeout=DEFAULT_CALL_TIMEOUT, max_attempts=3, backoff_base=1.0,
+                 backoff_cap=30.0, hedge=False, hedge_min_samples=20, latency_window=200,
+                 failure_threshold=5, reset_timeout=30.0, max_workers=16):
+        self.call_timeout = call_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_window = latency_window
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_workers = max_workers
+        self.breakers = {}
+        self.latencies = {}
+        self.stats = collections.Counter()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    # ---------- state ----------
+
+    def breaker(self, endpoint):
+        with self._lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(endpoint, self.failure_threshold, self.reset_timeout)
+            return self.breakers[endpoint]
+
+    def p95(self, key):
+        """p95 latency of the recent successful requests for key, or None with too few samples."""
+        with self._lock:
+            samples = sorted(self.latencies.get(key, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+    def _record_latency(self, key, seconds):
+        with self._lock:
+            if key not in self.latencies:
+                self.latencies[key] = collections.deque(maxlen=self.latency_window)
+            self.latencies[key].append(seconds)
+
+    def timeout(self):
+        """Timeout for the next request: call_timeout, cut to the time left before the deadline."""
+        left = remaining()
+        if left is None:
+            return self.call_timeout
+        if left <= 0:
+            self.stats["deadline_exceeded"] += 1
+            raise DeadlineExceeded("synthesis deadline exceeded")
+        return min(self.call_timeout, left)
+
+    def _key(self, endpoint, stage):
+        if stage is None:
+            # The LLM stage whose span is open, e.g. obj_model_finder
+            current = tracer.current()
+            stage = current.name if current is not None else None
+        return endpoint, stage
+
+    def _failed(self, breaker, error):
+        """Record a failed attempt. Return whether it is worth another attempt."""
+        retryable, endpoint_failure = classify(error)
+        if endpoint_failure:
+            breaker.record_failure()
+        else:
+            breaker.release()
+        self.stats["failures"] += 1
+        if isinstance(error, ValueError):
+            print("Warning: JSON decoding failed, retrying...")
+        elif isinstance(error, openai.OpenAIError):
+            print(f"OpenAI API error: {error}, retrying...")
+        else:
+            print(f"Unexpected error: {error}, retrying...")
+        return retryable
+
+    def _backoff(self, previous, error, endpoint):
+        """Seconds to sleep before the next attempt; the decorrelated-jitter state is kept in previous."""
+        delay = None
+        if isinstance(error, openai.APIStatusError) and error.status_code in (429, 503):
+            delay = retry_after(error)
+            limiter = get_rate_limiter(endpoint)
+            if error.status_code == 429 and limiter is not None:
+                limiter.penalize(delay if delay is not None else self.backoff_base)
+                delay = 0.0  # the next acquire waits out the penalty
+        if delay is None:
+            delay = decorrelated_jitter(previous or self.backoff_base, self.backoff_base, self.backoff_cap)
+            previous = delay
+        left = remaining()
+        if left is not None and delay >= left:
+            self.stats["deadline_exceeded"] += 1
+            raise DeadlineExceeded(f"synthesis deadline leaves no time for a retry ({max(0.0, left):.1f}s left)")
+        self.stats["retries"] += 1
+        tracer.add(retries=1, backoff_seconds=delay)
+        return delay, previous
+
+    def admit(self, endpoint, tokens):
+        """Wait for the endpoint's rate limiter (if any) to admit a request of tokens prompt tokens."""
+        limiter = get_rate_limiter(endpoint)
+        if limiter is None:
+            return
+        waited = limiter.acquire(tokens, timeout=remaining())
+        self._admitted(waited)
+
+    async def _admit_async(self, endpoint, tokens):
+        limiter = get_rate_limiter(endpoint)
+        if limiter is None:
+            return
+        waited = await limiter.acquire_async(tokens, timeout=remaining())
+        self._admitted(waited)
+
+    def _admitted(self, waited):
+        if waited is None:
+            self.stats["deadline_exceeded"] += 1
+            raise DeadlineExceeded("synthesis deadline exceeded while waiting for the rate limit")
+        if waited > 0:
+            self.stats["rate_wait_seconds"] += waited
+            tracer.add(rate_wait_seconds=waited)
+
+    def charge(self, endpoint, tokens):
+        """Count tokens that are only known after the answer (the completion) against the endpoint's rate limit."""
+        limiter = get_rate_limiter(endpoint)
+        if limiter is not None:
+            limiter.charge(tokens)
+
+    # ---------- sync ----------
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="llm-hedge")
+            return self._pool
+
+    def _run(self, fn, key, tokens):
+        """Run one attempt (hedged if enabled). Return (answer, latency of the winning request)."""
+        self.admit(key[0], tokens)
+        timeout = self.timeout()
+        threshold = self.p95(key) if self.hedge else None
+        start = time.monotonic()
+        if threshold is None or threshold >= timeout:
+            return fn(timeout), time.monotonic() - start
+
+        pool = self._executor()
+        primary = pool.submit(contextvars.copy_context().run, fn, timeout)
+        started = {primary: start}
+        done, _ = wait([primary], timeout=threshold)
+        if not done:
+            self.admit(key[0], tokens)
+            hedge = pool.submit(contextvars.copy_context().run, fn, self.timeout())
+            started[hedge] = time.monotonic()
+            self.stats["hedges"] += 1
+            tracer.add(hedges=1)
+        pending = set(started)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        self.stats["hedge_wins"] += 1
+                    return future.result(), time.monotonic() - started[future]
+                error = error or future.exception()
+        raise error
+
+    def call(self, fn, endpoint, stage=None, max_attempts=None, tokens=0):
+        """
+        Run the request fn(timeout) against endpoint (a circuit breaker name, e.g. the client profile).
+
+        Inputs:
+        1. fn (function): sends one request with the given timeout and returns the answer
+        2. endpoint (str): endpoint name; requests to the same endpoint share a circuit breaker
+        3. stage (str): name the p95 latency is tracked under (default: the innermost open span)
+        4. max_attempts (int): overrides the scheduler's max_attempts
+        5. tokens (int): estimated prompt tokens, for the endpoint's tokens/minute limit
+
+        Return:
+        the answer of the first successful attempt
+
+        Raises CircuitOpenError while the endpoint is failing, DeadlineExceeded when the deadline
+        runs out, the error itself when it is not retryable, and RuntimeError when every attempt failed.
+        """
+        key = self._key(endpoint, stage)
+        breaker = self.breaker(endpoint)
+        attempts = max_attempts or self.max_attempts
+        self.stats["calls"] += 1
+        backoff = 0.0
+        for attempt in range(1, attempts + 1):
+            breaker.before_call()
+            try:
+                answer, seconds = self._run(fn, key, tokens)
+            except DeadlineExceeded:
+                breaker.release()
+                raise
+            except Exception as e:
+                if not self._failed(breaker, e):
+                    raise
+                if attempt == attempts:
+                    raise RuntimeError(f"LLM call failed after {attempts} attempts: {e}") from e
+                delay, backoff = self._backoff(backoff, e, endpoint)
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            self._record_latency(key, seconds)
+            return answer
+
+    # ---------- async ----------
+
+    async def _run_async(self, fn, key, tokens):
+        await self._admit_async(key[0], tokens)
+        timeout = self.timeout()
+        threshold = self.p95(key) if self.hedge else None
+        start = time.monotonic()
+        if threshold is None or threshold >= timeout:
+            return await fn(timeout), time.monotonic() - start
+
+        primary = asyncio.ensure_future(fn(timeout))
+        started = {primary: start}
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait([primary], timeout=threshold)
+            if not done:
+                await self._admit_async(key[0], tokens)
+                hedge = asyncio.ensure_future(fn(self.timeout()))
+                started[hedge] = time.monotonic()
+                pending.add(hedge)
+                self.stats["hedges"] += 1
+                tracer.add(hedges=1)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats["hedge_wins"] += 1
+                        return task.result(), time.monotonic() - started[task]
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()  # closes the loser's connection
+
+    async def call_async(self, fn, endpoint, stage=None, max_attempts=None, tokens=0):
+        """asyncio counterpart of call; fn(timeout) returns an awaitable."""
+        key = self._key(endpoint, stage)
+        breaker = self.breaker(endpoint)
+        attempts = max_attempts or self.max_attempts
+        self.stats["calls"] += 1
+        backoff = 0.0
+        for attempt in range(1, attempts + 1):
+            breaker.before_call()
+            try:
+                answer, seconds = await self._run_async(fn, key, tokens)
+            except DeadlineExceeded:
+                breaker.release()
+                raise
+            except Exception as e:
+                if not self._failed(breaker, e):
+                    raise
+                if attempt == attempts:
+                    raise RuntimeError(f"LLM call failed after {attempts} attempts: {e}") from e
+                delay, backoff = self._backoff(backoff, e, endpoint)
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            self._record_latency(key, seconds)
+            return answer
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Process-wide scheduler. LLM_CALL_TIMEOUT, LLM_MAX_ATTEMPTS, LLM_HEDGE=1,
+    LLM_BREAKER_THRESHOLD and LLM_BREAKER_RESET override the defaults.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler(
+                call_timeout=float(os.environ.get("LLM_CALL_TIMEOUT", DEFAULT_CALL_TIMEOUT)),
+                max_attempts=int(os.environ.get("LLM_MAX_ATTEMPTS", 3)),
+                hedge=os.environ.get("LLM_HEDGE", "0") == "1",
+                failure_threshold=int(os.environ.get("LLM_BREAKER_THRESHOLD", 5)),
+                reset_timeout=float(os.environ.get("LLM_BREAKER_RESET", 30.0)),
+            )
+        return _scheduler
+
+
+def configure(**settings):
+    """Update settings of the process-wide scheduler (e.g. hedge=True in a benchmark)."""
+    scheduler = get_scheduler()
+    for name, value in settings.items():
+        if not hasattr(scheduler, name) or name.startswith("_"):
+            raise ValueError(f"Unknown scheduler setting: {name}")
+        setattr(scheduler, name, value)
@@ -0,0 +1,236 @@
+import collections
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def echo_responder(request):
+    """Default responder: answers every chat completion with an empty JSON object."""
+    return "{}"
+
+
+class StubLLMServer:
+    """
+    Local stand-in for an OpenAI-compatible /chat/completions endpoint.
+
+    Point the pipeline at it with llm_client.configure(profile, base_url=server.base_url, api_key="stub").
+    Connections are kept alive (HTTP/1.1), and the server counts how many TCP connections
+    were opened, so connection reuse can be observed from the outside.
+
+    Input Arguments:
+    1. responder (callable): maps the decoded request body (dict) to the completion text
+    2. latency (float): seconds to sleep before answering each request (before the first token when streaming)
+       model_latency (dict): per-model latency (key: requested model) overriding latency, e.g. to
+       check model_routing offline
+    3. host (str), port (int): address to bind; port 0 picks a free port
+    4. chunk_chars (int): characters per streamed chunk when the request sets "stream": true
+    5. chunk_delay (float): seconds between streamed chunks
+    6. error_rate (float), error_status (int): fraction of requests answered with error_status
+       instead of a completion (fault injection, e.g. for the circuit breaker in llm_scheduler)
+    7. hang_rate (float), hang_seconds (float): fraction of requests that wait hang_seconds before
+       answering (tail latency, e.g. for request timeouts and hedging)
+    8. rate_limit (int), rate_window (float): answer 429 with a Retry-After header once more than
+       rate_limit requests arrived within the last rate_window seconds, like a provider's rate limit
+    9. seed (int): seed of the fault injection, for reproducible runs
+    """
+
+    def __init__(self, responder=echo_responder, latency=0.0, host="127.0.0.1", port=0,
+                 chunk_chars=16, chunk_delay=0.0, error_rate=0.0, error_status=500,
+                 hang_rate=0.0, hang_seconds=30.0, rate_limit=None, rate_window=60.0, seed=None,
+                 model_latency=None):
+        self.responder = responder
+        self.latency = latency
+        self.model_latency = dict(model_latency or {})
+        self.models = collections.Counter()
+        self.chunk_chars = chunk_chars
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.errors = 0
+        self.hangs = 0
+        self.throttled = 0
+        self._arrivals = collections.deque()
+        self._random = random.Random(seed)
+        self.cancelled_streams = 0
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                model = request.get("model", "stub")
+                with stub._lock:
+                    stub.requests += 1
+                    stub.models[model] += 1
+                    retry_after = stub._throttle()
+                    if retry_after is not None:
+                        stub.throttled += 1
+                if retry_after is not None:
+                    self._send_json(429, {"error": {"message": "rate limit exceeded", "type": "rate_limit_error"}},
+                                    {"Retry-After": f"{retry_after:.3f}"})
+                    return
+                with stub._lock:
+                    fail = stub._random.random() < stub.error_rate
+                    hang = not fail and stub._random.random() < stub.hang_rate
+                    if fail:
+                        stub.errors += 1
+                    if hang:
+                        stub.hangs += 1
+                latency = stub.model_latency.get(model, stub.latency)
+                if latency:
+                    time.sleep(latency)
+                if fail:
+                    self._send_json(stub.error_status, {"error": {"message": "injected fault",
+                                                                  "type": "server_error"}})
+                    return
+                if hang:
+                    time.sleep(stub.hang_seconds)
+                content = stub.responder(request)
+                if request.get("stream"):
+                    self._send_stream(request.get("model", "stub"), content)
+                    return
+                try:
+                    self._send_json(200, completion_body(request.get("model", "stub"), content))
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up (timed out, or a hedged duplicate won)
+                    self.close_connection = True
+
+            def _send_stream(self, model, content):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                pieces = [content[i:i + stub.chunk_chars]
+                          for i in range(0, len(content), stub.chunk_chars)]
+                events = [chunk_body(model, piece) for piece in pieces]
+                events.append(chunk_body(model, None, finish_reason="stop"))
+                try:
+                    for i, event in enumerate(events):
+                        if i and stub.chunk_delay:
+                            time.sleep(stub.chunk_delay)
+                        self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                    self._write_chunk(b"data: [DONE]\n\n")
+                    self._write_chunk(b"")
+                except (BrokenPipeError, ConnectionResetError):
+                    with stub._lock:
+                        stub.cancelled_streams += 1
+                    self.close_connection = True
+
+            def _write_chunk(self, data):
+                self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def _send_json(self, status, body, headers=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def _throttle(self):
+        """Sliding-window rate limit (call with _lock held). Return the Retry-After in seconds, or None."""
+        if not self.rate_limit:
+            return None
+        now = time.monotonic()
+        while self._arrivals and self._arrivals[0] <= now - self.rate_window:
+            self._arrivals.popleft()
+        if len(self._arrivals) >= self.rate_limit:
+            return self._arrivals[0] + self.rate_window - now
+        self._arrivals.append(now)
+        return None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def completion_body(model, content):
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+def chunk_body(model, content, finish_reason=None):
+    delta = {"content": content} if content is not None else {}
+    return {
+        "id": "chatcmpl-stream",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local stand-in LLM endpoint")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--hang-seconds", type=float, default=30.0)
+    args = parser.parse_args()
+
+    server = StubLLMServer(latency=args.latency, port=args.port, error_rate=args.error_rate,
+                           error_status=args.error_status, hang_rate=args.hang_rate,
+                           hang_seconds=args.hang_seconds)
+    print(f"Stub LLM server listening on {server.base_url}")
+    server._server.serve_forever()
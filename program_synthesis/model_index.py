@@ -0,0 +1,150 @@
+import difflib
+import hashlib
+import re
+
+
+_CLASS = re.compile(r"^class\s+([A-Za-z_]\w*)", re.MULTILINE)
+
+_classes = {}
+
+
+def load_model_classes(source):
+    """
+    Return the set of Scenic object classes defined in model.scenic, memoized by content hash.
+
+    Input:
+    source (str): contents of model.scenic
+    """
+    digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    if digest not in _classes:
+        _classes[digest] = set(_CLASS.findall(source))
+    return _classes[digest]
+
+
+_CLASS_BLOCK = re.compile(r"^class\s+([A-Za-z_]\w*)(?:\(([^)]*)\))?\s*:(.*?)(?=^\S|\Z)", re.MULTILINE | re.DOTALL)
+_ALIAS_COMMENT = re.compile(r"#\s*(?:alias|aliases|synonyms?)\s*:\s*(.+)", re.IGNORECASE)
+_LABEL = re.compile(r"""\b(?:name|label|alias|unityName|displayName)\s*[:=]\s*["']([A-Za-z][A-Za-z _-]{0,30})["']""")
+
+# Abstract bases that are never the class of a scene object
+_BASES = {"UnityObject", "Object", "Point", "OrientedPoint"}
+
+# The avatar the patient controls is always instantiated as ego
+EGO_CLASS = "Scenicavatar"
+
+# Everyday names for objects, mapped onto the (normalized) class names they usually mean;
+# only used when the target class exists in model.scenic
+SYNONYMS = {
+    "mug": "cup", "glass": "cup", "desk": "table", "bin": "basket", "tray": "plate",
+    "dish": "plate", "avatar": "scenicavatar", "patient": "scenicavatar", "user": "scenicavatar",
+    "ball": "sphere", "block": "cube", "container": "box", "rack": "shelf",
+}
+
+_ARTICLES = {"a", "an", "the", "my", "your"}
+
+# Similarity (difflib ratio) a fuzzy match needs, and its lead over the runner-up, to be trusted
+FUZZY_CUTOFF = 0.85
+FUZZY_MARGIN = 0.05
+
+
+def name_words(name):
+    """Split an object or class name into lowercase words: 'a_star_1' -> ['star'], 'TennisBall2' -> ['tennis', 'ball']."""
+    name = re.sub(r"([a-z])([A-Z])", r"\1 \2", name)
+    words = [w for w in re.split(r"[^A-Za-z]+", name.lower()) if w]
+    return [w for w in words if w not in _ARTICLES] or words
+
+
+def _singular(word):
+    for suffix, replacement in (("ies", "y"), ("ches", "ch"), ("shes", "sh"), ("xes", "x"), ("ses", "s"), ("s", "")):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 2 and not word.endswith("ss"):
+            return word[:-len(suffix)] + replacement
+    return word
+
+
+class ModelIndex:
+    """
+    Index of the object classes defined in model.scenic, used to resolve the names of setup objects
+    (e.g. 'orange1', 'a_star_1', 'ego') to classes without asking the LLM.
+
+    Every class is indexed under its normalized name (lowercase, words joined), the singular form,
+    labels or aliases given in its body (name: "...", or a '# aliases: a, b' comment) and the
+    SYNONYMS that point at it.
+
+    Input Arguments:
+    1. source (str): contents of model.scenic
+    """
+
+    def __init__(self, source):
+        self.classes = []
+        self.aliases = {}
+        for name, bases, body in _CLASS_BLOCK.findall(source):
+            if name in _BASES or name.startswith("_"):
+                continue
+            self.classes.append(name)
+            aliases = ["".join(name_words(name))]
+            for match in _ALIAS_COMMENT.findall(body):
+                aliases.extend(a.strip() for a in match.split(","))
+            aliases.extend(_LABEL.findall(body))
+            for alias in aliases:
+                key = "".join(name_words(alias))
+                if key:
+                    self.aliases.setdefault(key, name)
+                    self.aliases.setdefault(_singular(key), name)
+        for synonym, target in SYNONYMS.items():
+            if target in self.aliases:
+                self.aliases.setdefault(synonym, self.aliases[target])
+
+    def resolve(self, name):
+        """
+        Resolve an object name to a class.
+
+        Return:
+        tuple: (class name or None, confidence between 0 and 1, how it was matched)
+        """
+        if name == "ego" and EGO_CLASS in self.classes:
+            return EGO_CLASS, 1.0, "ego"
+        words = name_words(name)
+        if not words:
+            return None, 0.0, "unresolved"
+        key = "".join(words)
+        for candidate, confidence, method in ((key, 1.0, "exact"), (_singular(key), 0.95, "singular")):
+            if candidate in self.aliases:
+                return self.aliases[candidate], confidence, method
+        # A modified noun ('red_cup', 'small_plates') is usually named after its last word
+        if len(words) > 1:
+            head = _singular(words[-1])
+            if head in self.aliases:
+                return self.aliases[head], 0.9, "head noun"
+        scored = sorted(((difflib.SequenceMatcher(None, _singular(key), alias).ratio(), alias)
+                         for alias in self.aliases), reverse=True)
+        if scored and scored[0][0] >= FUZZY_CUTOFF:
+            runner_up = next((ratio for ratio, alias in scored[1:]
+                              if self.aliases[alias] != self.aliases[scored[0][1]]), 0.0)
+            if scored[0][0] - runner_up >= FUZZY_MARGIN:
+                return self.aliases[scored[0][1]], scored[0][0], "fuzzy"
+        return None, 0.0, "unresolved"
+
+    def resolve_all(self, names):
+        """
+        Return:
+        tuple: (resolved {name: class}, list of names that could not be resolved confidently)
+        """
+        resolved = {}
+        unresolved = []
+        for name in names:
+            cls, _, _ = self.resolve(name)
+            if cls is None:
+                unresolved.append(name)
+            else:
+                resolved[name] = cls
+        return resolved, unresolved
+
+
+_indexes = {}
+
+
+def load_model_index(source):
+    """Return the ModelIndex of model.scenic, memoized by content hash."""
+    digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    if digest not in _indexes:
+        _indexes[digest] = ModelIndex(source)
+    return _indexes[digest]
@@ -0,0 +1,258 @@
+import collections
+import json
+import os
+import threading
+import time
+
+from llm_scheduler import DeadlineExceeded, get_scheduler
+from telemetry import tracer
+from token_estimator import estimate_tokens
+
+
+class Route:
+    """
+    Which model serves a pipeline stage.
+
+    Input Arguments:
+    1. primary (str): model asked first
+    2. fallback (str): model asked when the primary fails or misses the SLO; None for no fallback
+    3. slo (float): seconds the primary has to answer (its request timeout) before the fallback is
+       asked; None leaves the primary the scheduler's full timeout
+    """
+
+    def __init__(self, primary, fallback=None, slo=None):
+        self.primary = primary
+        self.fallback = fallback
+        self.slo = slo
+
+    def models(self):
+        return [self.primary] + ([self.fallback] if self.fallback and self.fallback != self.primary else [])
+
+    def to_dict(self):
+        return {"primary": self.primary, "fallback": self.fallback, "slo": self.slo}
+
+    def __repr__(self):
+        return f"Route({self.primary!r}, fallback={self.fallback!r}, slo={self.slo!r})"
+
+
+# Routing table per client profile (see llm_client.PROFILES), keyed by stage (the name of the
+# traced function that queries the LLM). Mapping object names to model classes and rephrasing
+# instructions are small tasks, so they go to a small, fast model; program generation keeps
+# the large model. "default" serves every stage that is not listed.
+DEFAULT_ROUTES = {
+    "grok": {
+        "default": Route("grok-3-beta"),
+        "direct_scenic_generator": Route("grok-3-beta", "grok-3", slo=120.0),
+        "direct_scenic_generator_async": Route("grok-3-beta", "grok-3", slo=120.0),
+        "direct_scenic_generator_stream": Route("grok-3-beta"),
+        "instruction_step_generator": Route("grok-3-beta", "grok-3", slo=60.0),
+        "api_retriever": Route("grok-3-beta", "grok-3", slo=60.0),
+        "obj_model_finder": Route("grok-3-mini", "grok-3-beta", slo=10.0),
+        "instruction_generator": Route("grok-3-mini", "grok-3-beta", slo=15.0),
+    },
+    "openai": {
+        "default": Route("gpt-4"),
+        "api_retriever": Route("gpt-4"),
+        "obj_model_finder": Route("gpt-4o-mini", "gpt-4", slo=10.0),
+        "instruction_generator": Route("gpt-4o-mini", "gpt-4", slo=15.0),
+    },
+}
+
+
+def load_routes(path):
+    """
+    Read a routing table from a JSON file of the form
+    {"grok": {"obj_model_finder": {"primary": "...", "fallback": "...", "slo": 10}, ...}, ...}
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    return {profile: {stage: Route(**route) for stage, route in stages.items()}
+            for profile, stages in data.items()}
+
+
+def current_stage():
+    """Name of the innermost open span (the traced stage function), or None."""
+    current = tracer.current()
+    return current.name if current is not None else None
+
+
+class ModelRouter:
+    """
+    Sends each LLM request to the model its stage is routed to and records which model served it.
+
+    The primary model gets one attempt, bounded by the route's SLO; if it fails or runs over, the
+    fallback model gets the remaining attempts. Every request goes through llm_scheduler, with the
+    model as part of the endpoint name (e.g. "grok.grok-3-mini"), so each model has its own circuit
+    breaker, rate limit and latency history: a primary that keeps failing is skipped at once.
+
+    Input Arguments:
+    1. routes (dict): routing table (see DEFAULT_ROUTES); profiles or stages left out fall back to
+       DEFAULT_ROUTES
+    """
+
+    def __init__(self, routes=None, latency_window=200):
+        self.routes = {profile: dict(stages) for profile, stages in DEFAULT_ROUTES.items()}
+        for profile, stages in (routes or {}).items():
+            self.routes.setdefault(profile, {}).update(stages)
+        self.served = collections.Counter()
+        self.fallbacks = collections.Counter()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=latency_window))
+        self._lock = threading.Lock()
+
+    def route(self, profile, stage=None, model=None):
+        """Route for a request; an explicit model bypasses the table."""
+        if model:
+            return Route(model)
+        stages = self.routes.get(profile, {})
+        return stages.get(stage) or stages["default"]
+
+    def _plan(self, route, max_attempts):
+        """[(model, timeout cap, attempts)] in the order the models are tried."""
+        models = route.models()
+        if len(models) == 1:
+            return [(models[0], route.slo, max_attempts)]
+        return [(models[0], route.slo, 1), (models[1], None, max_attempts)]
+
+    def _served(self, profile, stage, model, seconds, fallback, output):
+        with self._lock:
+            self.served[(profile, stage, model)] += 1
+            if fallback:
+                self.fallbacks[(profile, stage, model)] += 1
+            self.latencies[(profile, stage, model)].append(seconds)
+        get_scheduler().charge(f"{profile}.{model}", estimate_tokens(output or ""))
+        current = tracer.current()
+        if current is not None:
+            current.set(served_model=model)
+
+    def _falling_back(self, stage, model, slo, error, fallback):
+        limit = f" within its {slo:g}s SLO" if slo else ""
+        print(f"{stage}: {model} did not answer{limit} ({error}); falling back to {fallback}")
+
+    def call(self, profile, send, model=None, max_attempts=3, tokens=0):
+        """
+        Inputs:
+        1. profile (str): client profile
+        2. send (function): send(model, timeout) sends one request and returns (answer, output text)
+        3. model (str): explicit model (bypasses the routing table)
+        4. max_attempts (int), tokens (int): passed on to the scheduler
+
+        Return:
+        tuple: (answer, output text, model that served it)
+        """
+        stage = current_stage()
+        plan = self._plan(self.route(profile, stage, model), max_attempts)
+        for i, (name, cap, attempts) in enumerate(plan):
+            start = time.monotonic()
+            try:
+                answer, output = get_scheduler().call(
+                    lambda timeout, name=name, cap=cap: send(name, min(timeout, cap) if cap else timeout),
+                    f"{profile}.{name}", stage=stage, max_attempts=attempts, tokens=tokens)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if i == len(plan) - 1:
+                    raise
+                self._falling_back(stage, name, cap, e, plan[i + 1][0])
+                continue
+            self._served(profile, stage, name, time.monotonic() - start, i > 0, output)
+            return answer, output, name
+
+    async def call_async(self, profile, send, model=None, max_attempts=3, tokens=0):
+        """asyncio counterpart of call; send(model, timeout) returns an awaitable."""
+        stage = current_stage()
+        plan = self._plan(self.route(profile, stage, model), max_attempts)
+        for i, (name, cap, attempts) in enumerate(plan):
+            start = time.monotonic()
+            try:
+                answer, output = await get_scheduler().call_async(
+                    lambda timeout, name=name, cap=cap: send(name, min(timeout, cap) if cap else timeout),
+                    f"{profile}.{name}", stage=stage, max_attempts=attempts, tokens=tokens)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if i == len(plan) - 1:
+                    raise
+                self._falling_back(stage, name, cap, e, plan[i + 1][0])
+                continue
+            self._served(profile, stage, name, time.monotonic() - start, i > 0, output)
+            return answer, output, name
+
+    def report(self):
+        """
+        Return:
+        list of dictionaries, one per (profile, stage, model) that served a request, with keys
+        "profile", "stage", "model", "calls", "fallbacks" (calls served as the fallback), "p50_s",
+        "p95_s" and "slo_s" (the SLO of the stage's primary)
+        """
+        rows = []
+        with self._lock:
+            for (profile, stage, model), calls in sorted(self.served.items(), key=lambda kv: tuple(map(str, kv[0]))):
+                seconds = sorted(self.latencies[(profile, stage, model)])
+                route = self.route(profile, stage)
+                rows.append({"profile": profile, "stage": stage, "model": model, "calls": calls,
+                             "fallbacks": self.fallbacks[(profile, stage, model)],
+                             "p50_s": seconds[len(seconds) // 2],
+                             "p95_s": seconds[min(len(seconds) - 1, int(0.95 * len(seconds)))],
+                             "slo_s": route.slo})
+        return rows
+
+    def print_report(self):
+        print(f"{'stage':<32} {'model':<14} {'calls':>5} {'fallback':>8} {'p50 s':>7} {'p95 s':>7} {'SLO s':>6}")
+        for row in self.report():
+            slo = f"{row['slo_s']:6g}" if row["slo_s"] else "     -"
+            print(f"{str(row['stage']):<32} {row['model']:<14} {row['calls']:5d} {row['fallbacks']:8d} "
+                  f"{row['p50_s']:7.3f} {row['p95_s']:7.3f} {slo}")
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """Process-wide router; $LLM_ROUTES names a JSON file that overrides DEFAULT_ROUTES (see load_routes)."""
+    global _router
+    with _router_lock:
+        if _router is None:
+            path = os.environ.get("LLM_ROUTES")
+            _router = ModelRouter(load_routes(path) if path else None)
+        return _router
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import llm_client
+    from llm_cache import disable_cache
+    from llm_stub_server import StubLLMServer
+    from telemetry import span
+    import scenic_writer
+
+    parser = argparse.ArgumentParser(
+        description="Check the routing table offline against a stub with per-model latency")
+    parser.add_argument("--latency", nargs="*", default=["grok-3-beta=1.0", "grok-3=1.0", "grok-3-mini=0.2"],
+                        help="simulated latency per model, as model=seconds")
+    parser.add_argument("--routes", help="JSON routing table to check instead of the default one")
+    parser.add_argument("--calls", type=int, default=3, help="requests per stage")
+    args = parser.parse_args()
+
+    model_latency = {}
+    for item in args.latency:
+        name, seconds = item.split("=")
+        model_latency[name] = float(seconds)
+    # scenic_writer routes through the imported module, not through __main__
+    import model_routing
+    if args.routes:
+        model_routing._router = model_routing.ModelRouter(model_routing.load_routes(args.routes))
+    router = model_routing.get_router()
+
+    disable_cache()
+    with StubLLMServer(lambda request: '{"0": "ok"}', model_latency=model_latency) as server:
+        llm_client.configure("grok", base_url=server.base_url, api_key="stub")
+        for stage in sorted(router.routes["grok"]):
+            if stage == "default":
+                continue
+            for _ in range(args.calls):
+                with span(stage, kind="stage"):
+                    scenic_writer.queryLLM("routing check", stage, json_bool=True)
+        print(f"Requests per model at the stub: {dict(server.models)}")
+    router.print_report()
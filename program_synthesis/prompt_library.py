@@ -0,0 +1,98 @@
+import hashlib
+import os
+import threading
+
+from telemetry import span
+
+
+class PromptLibrary:
+    """
+    Process-wide store for the static context that goes into every prompt: actions.py, model.scenic,
+    the example Scenic programs and JSONs.
+
+    Files are read once and served from memory afterwards. Every access costs one os.stat(); a file is
+    re-read only when its mtime or size changed, and dependent segments are rebuilt only when the
+    re-read contents actually hash differently. Strings derived from files (e.g. a rendered list of
+    example programs) are memoized with segment(), keyed on the versions of the files they came from.
+    """
+
+    def __init__(self):
+        self.disk_reads = 0
+        self.hits = 0
+        self._files = {}     # path -> (mtime_ns, size, sha256, text)
+        self._dirs = {}      # path -> (mtime_ns, list of file paths)
+        self._segments = {}  # key -> (versions, text)
+        self._lock = threading.RLock()
+
+    def _entry(self, path):
+        st = os.stat(path)
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                self.hits += 1
+                return cached
+            with span("file_read", path=os.path.basename(path)) as read_span:
+                with open(path, "r", encoding="utf-8") as file:
+                    text = file.read()
+                read_span.set(chars=len(text))
+            self.disk_reads += 1
+            digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            entry = (st.st_mtime_ns, st.st_size, digest, text)
+            self._files[path] = entry
+            return entry
+
+    def read(self, path):
+        """Return the contents of path, reading it from disk only if it changed."""
+        return self._entry(path)[3]
+
+    def version(self, path):
+        """Return the content hash of path."""
+        return self._entry(path)[2]
+
+    def list_files(self, directory):
+        """Return the sorted file paths directly inside directory, re-listing only when it changed."""
+        mtime = os.stat(directory).st_mtime_ns
+        with self._lock:
+            cached = self._dirs.get(directory)
+            if cached is not None and cached[0] == mtime:
+                return list(cached[1])
+            files = sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                           if os.path.isfile(os.path.join(directory, f)))
+            self._dirs[directory] = (mtime, files)
+            return list(files)
+
+    def read_all(self, paths):
+        return [self.read(path) for path in paths]
+
+    def segment(self, key, paths, builder):
+        """
+        Return a pre-rendered prompt segment built from the given files.
+
+        Inputs:
+        1. key (hashable): name of the segment
+        2. paths (list): files the segment is derived from
+        3. builder (callable): called with the list of file contents; returns the segment string
+
+        The builder only runs again when one of the files changed content.
+        """
+        paths = list(paths)
+        versions = tuple(self.version(path) for path in paths)
+        with self._lock:
+            cached = self._segments.get(key)
+            if cached is not None and cached[0] == versions:
+                return cached[1]
+        text = builder(self.read_all(paths))
+        with self._lock:
+            self._segments[key] = (versions, text)
+        return text
+
+    def stats(self):
+        return {"disk_reads": self.disk_reads, "hits": self.hits,
+                "files": len(self._files), "segments": len(self._segments)}
+
+
+library = PromptLibrary()
+
+
+def get_prompt_library():
+    return library
@@ -0,0 +1,246 @@
+import asyncio
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: the limits are only shared between the threads of one process
+    fcntl = None
+
+
+DEFAULT_STATE_DIR = ".llm_rate"
+
+
+class RateLimiter:
+    """
+    Client-side token buckets for requests/minute and tokens/minute, shared by every process that
+    uses the same name and state_dir.
+
+    The bucket levels live in <state_dir>/<name>.json and are only read and written under an
+    exclusive fcntl lock on <state_dir>/<name>.lock, so syntheses, notebooks and benchmarks running
+    side by side against the same API key pace themselves together instead of each discovering the
+    provider limit through 429s. Callers are served first come, first served: acquire() takes a
+    ticket in a queue kept in the same file, and only the caller at the head of the queue may take
+    from the buckets, so a large prompt is not starved by a stream of small ones.
+
+    A request is admitted once the token bucket holds its estimated prompt tokens (or is full, for
+    prompts larger than the bucket); the bucket may then go negative, which delays the next caller
+    by exactly the overdraft. charge() adds the completion tokens once they are known. A 429 from the
+    provider calls penalize(), which holds every process back until the Retry-After has passed.
+
+    Input Arguments:
+    1. name (str): endpoint name, e.g. "grok.grok-3-mini" (client profile and model)
+    2. rpm (float), tpm (float): provider limits per minute; None leaves that limit off
+    3. headroom (float): fraction of the limits actually used, to stay just under them
+    4. burst (float): bucket capacity in seconds of refill, i.e. how far a burst may run ahead of
+       steady pacing
+    5. state_dir (str): directory of the shared state
+    6. poll_interval (float): how often a queued caller looks at the queue again
+    7. stale_after (float): seconds after which a queued ticket whose owner stopped polling
+       (e.g. a killed process) is dropped
+    """
+
+    def __init__(self, name, rpm=None, tpm=None, headroom=0.95, burst=10.0, state_dir=DEFAULT_STATE_DIR,
+                 poll_interval=0.05, stale_after=5.0):
+        self.name = name
+        self.limits = {"requests": rpm, "tokens": tpm}
+        self.headroom = headroom
+        self.burst = burst
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_path = os.path.join(state_dir, f"{name}.json")
+        self.lock_path = os.path.join(state_dir, f"{name}.lock")
+        self.stats = {"admitted": 0, "waited_seconds": 0.0, "penalties": 0}
+        self._thread_lock = threading.Lock()
+
+    # ---------- shared state ----------
+
+    def _rate(self, bucket):
+        """Refill rate in units per second, or None without a limit."""
+        limit = self.limits[bucket]
+        return None if not limit else limit * self.headroom / 60.0
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Yield the shared state under the cross-process lock and write it back afterwards."""
+        with self._thread_lock:
+            with open(self.lock_path, "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    state = self._read()
+                    yield state
+                    self._write(state)
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+        now = time.time()
+        state.setdefault("queue", [])
+        state.setdefault("penalty_until", 0.0)
+        for bucket in self.limits:
+            rate = self._rate(bucket)
+            if rate is None:
+                continue
+            capacity = rate * self.burst
+            level, updated = state.get(bucket, (capacity, now))
+            state[bucket] = (min(capacity, level + max(0.0, now - updated) * rate), now)
+        return state
+
+    def _write(self, state):
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(self.state_path))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # ---------- admission ----------
+
+    def _step(self, ticket, tokens):
+        """Try to admit ticket. Return 0 once admitted, otherwise the seconds to wait before trying again."""
+        with self._locked() as state:
+            now = time.time()
+            queue = state["queue"]
+            for entry in queue:
+                if entry[0] == ticket:
+                    entry[1] = now
+                    break
+            else:
+                queue.append([ticket, now])
+            while queue[0][0] != ticket and queue[0][1] < now - self.stale_after:
+                queue.pop(0)
+            if queue[0][0] != ticket:
+                return self.poll_interval
+            if state["penalty_until"] > now:
+                return state["penalty_until"] - now
+
+            costs = {"requests": 1, "tokens": tokens}
+            wait = 0.0
+            for bucket, cost in costs.items():
+                rate = self._rate(bucket)
+                if rate is None:
+                    continue
+                level, _ = state[bucket]
+                need = min(cost, rate * self.burst)
+                if level < need:
+                    wait = max(wait, (need - level) / rate)
+            if wait > 0:
+                return wait
+            for bucket, cost in costs.items():
+                if self._rate(bucket) is not None:
+                    state[bucket] = (state[bucket][0] - cost, now)
+            queue.pop(0)
+            return 0.0
+
+    def _leave(self, ticket):
+        with self._locked() as state:
+            state["queue"] = [entry for entry in state["queue"] if entry[0] != ticket]
+
+    def acquire(self, tokens=0, timeout=None):
+        """
+        Block until a request of about tokens prompt tokens may be sent.
+
+        Return:
+        float: seconds waited, or None if the request could not be admitted within timeout
+        """
+        ticket = uuid.uuid4().hex
+        start = time.monotonic()
+        admitted = False
+        try:
+            while True:
+                wait = self._step(ticket, tokens)
+                waited = time.monotonic() - start
+                if wait == 0:
+                    admitted = True
+                    self._admitted(waited)
+                    return waited
+                if timeout is not None and waited >= timeout:
+                    return None
+                time.sleep(min(wait, 0.25, timeout - waited if timeout is not None else wait))
+        finally:
+            if not admitted:
+                self._leave(ticket)
+
+    async def acquire_async(self, tokens=0, timeout=None):
+        """asyncio counterpart of acquire. The file lock is only held for a few milliseconds per poll."""
+        ticket = uuid.uuid4().hex
+        start = time.monotonic()
+        admitted = False
+        try:
+            while True:
+                wait = self._step(ticket, tokens)
+                waited = time.monotonic() - start
+                if wait == 0:
+                    admitted = True
+                    self._admitted(waited)
+                    return waited
+                if timeout is not None and waited >= timeout:
+                    return None
+                await asyncio.sleep(min(wait, 0.25, timeout - waited if timeout is not None else wait))
+        finally:
+            if not admitted:
+                self._leave(ticket)
+
+    def _admitted(self, waited):
+        self.stats["admitted"] += 1
+        self.stats["waited_seconds"] += waited
+
+    def charge(self, tokens):
+        """Take tokens that only became known after the request (e.g. the completion) from the token bucket."""
+        if self._rate("tokens") is None or not tokens:
+            return
+        with self._locked() as state:
+            level, updated = state["tokens"]
+            state["tokens"] = (level - tokens, updated)
+
+    def penalize(self, seconds):
+        """The provider answered 429: hold back every process sharing the limits for seconds."""
+        self.stats["penalties"] += 1
+        with self._locked() as state:
+            state["penalty_until"] = max(state["penalty_until"], time.time() + seconds)
+            if self._rate("requests") is not None:
+                state["requests"] = (min(0.0, state["requests"][0]), state["requests"][1])
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name):
+    """
+    Process-wide limiter for endpoint name, built from $LLM_RPM and $LLM_TPM (state in
+    $LLM_RATE_DIR or ./.llm_rate). Return None when neither limit is set.
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            rpm = os.environ.get("LLM_RPM")
+            tpm = os.environ.get("LLM_TPM")
+            _limiters[name] = RateLimiter(
+                name, rpm=float(rpm) if rpm else None, tpm=float(tpm) if tpm else None,
+                state_dir=os.environ.get("LLM_RATE_DIR", DEFAULT_STATE_DIR)) if rpm or tpm else None
+        return _limiters[name]
+
+
+def configure(name, **settings):
+    """Set the limits of endpoint name for this process (rpm=None and tpm=None turn limiting off)."""
+    with _limiters_lock:
+        if not settings.get("rpm") and not settings.get("tpm"):
+            _limiters[name] = None
+        else:
+            _limiters[name] = RateLimiter(name, **settings)
+        return _limiters[name]
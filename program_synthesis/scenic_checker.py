@@ -0,0 +1,279 @@
+import re
+
+from api_index import load_api_index, CORE_APIS
+from model_index import load_model_classes
+from prompt_library import library
+
+
+VISUAL_QUERY_ACTIONS = {"SendImageAndTextRequestAction", "RecordVideoAndEvaluateAction"}
+
+# Capitalized names that are valid in a Scenic program without being defined in actions.py/model.scenic
+SCENIC_BUILTINS = {"Range", "DiscreteRange", "Uniform", "Normal", "TruncatedNormal", "Options",
+                   "Discrete", "Vector", "Point", "OrientedPoint", "Object", "Exception",
+                   "True", "False", "None"}
+
+_TAKE = re.compile(r"\btake\s+([A-Za-z_]\w*)\s*\(")
+_CALL = re.compile(r"(?<![\w.])([A-Z]\w*)\s*\(")
+_NEW = re.compile(r"\bnew\s+([A-Za-z_]\w*)")
+_DEFINITION = re.compile(r"^\s*(?:behavior|def|class|monitor)\s+([A-Za-z_]\w*)")
+# Places where the program waits; `do WaitUntil`/`do Pause` are the wait primitives (see wait_primitives.py)
+_LOOP = re.compile(r"^\s*(?:while|for|do\s+(?:WaitUntil|Pause))\b")
+
+
+class Diagnostic:
+    def __init__(self, line, severity, code, message):
+        self.line = line
+        self.severity = severity  # "error" or "warning"
+        self.code = code
+        self.message = message
+
+    def to_dict(self):
+        return {"line": self.line, "severity": self.severity, "code": self.code, "message": self.message}
+
+    def __repr__(self):
+        return f"{self.severity} line {self.line} [{self.code}]: {self.message}"
+
+
+class CheckResult:
+    def __init__(self, diagnostics):
+        self.diagnostics = sorted(diagnostics, key=lambda d: (d.line, d.code))
+
+    @property
+    def ok(self):
+        return not self.errors()
+
+    def errors(self):
+        return [d for d in self.diagnostics if d.severity == "error"]
+
+    def warnings(self):
+        return [d for d in self.diagnostics if d.severity == "warning"]
+
+    def to_dict(self):
+        return {"ok": self.ok, "diagnostics": [d.to_dict() for d in self.diagnostics]}
+
+    def __repr__(self):
+        return "\n".join(repr(d) for d in self.diagnostics) or "ok"
+
+
+def code_lines(source):
+    """
+    Return the program's lines with comments removed and the contents of string literals blanked out
+    (quotes are kept), so that the checks never match text inside instructions or comments.
+    """
+    out = []
+    i, n = 0, len(source)
+    quote = None
+    while i < n:
+        ch = source[i]
+        if quote is None:
+            if ch == "#":
+                while i < n and source[i] != "\n":
+                    i += 1
+                continue
+            if ch in "'\"":
+                quote = source[i:i + 3] if source[i:i + 3] in ("'''", '"""') else ch
+                out.append(quote)
+                i += len(quote)
+                continue
+            out.append(ch)
+            i += 1
+        else:
+            if ch == "\\" and i + 1 < n:
+                out.append("  " if source[i + 1] != "\n" else " \n")
+                i += 2
+                continue
+            if source.startswith(quote, i):
+                out.append(quote)
+                i += len(quote)
+                quote = None
+                continue
+            if ch == "\n" and len(quote) == 1:  # unterminated single-quoted string
+                quote = None
+            out.append("\n" if ch == "\n" else " ")
+            i += 1
+    return "".join(out).split("\n")
+
+
+def _indent_of(line):
+    return line[:len(line) - len(line.lstrip(" \t"))]
+
+
+def _check_indentation(lines, diagnostics):
+    stack = [0]
+    indent_char = None
+    depth = 0
+    continuation = False
+    expect_indent = False
+    for number, line in enumerate(lines, 1):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if depth == 0 and not continuation:
+            indent = _indent_of(line)
+            if indent:
+                chars = set(indent)
+                if len(chars) > 1:
+                    diagnostics.append(Diagnostic(number, "error", "mixed-indentation",
+                                                  "indentation mixes tabs and spaces"))
+                elif indent_char is None:
+                    indent_char = indent[0]
+                elif indent[0] != indent_char:
+                    diagnostics.append(Diagnostic(number, "error", "mixed-indentation",
+                                                  "indentation uses both tabs and spaces in this file"))
+            width = len(indent.expandtabs(4))
+            if expect_indent:
+                if width <= stack[-1]:
+                    diagnostics.append(Diagnostic(number, "error", "expected-indent",
+                                                  "expected an indented block"))
+                else:
+                    stack.append(width)
+            elif width > stack[-1]:
+                diagnostics.append(Diagnostic(number, "error", "unexpected-indent", "unexpected indentation"))
+            else:
+                while width < stack[-1]:
+                    stack.pop()
+                if width != stack[-1]:
+                    diagnostics.append(Diagnostic(number, "error", "unbalanced-dedent",
+                                                  "dedent does not match any outer indentation level"))
+                    stack.append(width)
+            expect_indent = False
+        depth += sum(stripped.count(c) for c in "([{") - sum(stripped.count(c) for c in ")]}")
+        depth = max(depth, 0)
+        # Scenic specifiers may continue on the next line after a trailing comma
+        continuation = stripped.endswith("\\") or (depth == 0 and stripped.endswith(","))
+        if depth == 0 and not continuation and stripped.endswith(":"):
+            expect_indent = True
+    if depth:
+        diagnostics.append(Diagnostic(len(lines), "error", "unbalanced-brackets", "unclosed bracket at end of file"))
+
+
+def _behavior_blocks(lines):
+    """Yield (name, list of (line number, line)) for every behavior defined in the program."""
+    current, body = None, []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        top_level = not line[:1].isspace()
+        if top_level:
+            if current is not None:
+                yield current, body
+                current, body = None, []
+            match = re.match(r"behavior\s+([A-Za-z_]\w*)", line)
+            if match:
+                current = match.group(1)
+        elif current is not None:
+            body.append((number, line))
+    if current is not None:
+        yield current, body
+
+
+def _check_behavior(body, diagnostics):
+    pending_take = None   # (line, action) of a take not yet followed by take DoneAction()
+    open_query = None     # (line, action) of a visual query not yet disposed
+    for number, line in body:
+        for action in _TAKE.findall(line):
+            if action == "DoneAction":
+                pending_take = None
+                continue
+            if action == "DisposeQueriesAction":
+                open_query = None
+            elif action in VISUAL_QUERY_ACTIONS:
+                if open_query is not None:
+                    diagnostics.append(Diagnostic(
+                        open_query[0], "error", "missing-dispose",
+                        f"{open_query[1]} is not followed by take DisposeQueriesAction() "
+                        f"before the next visual query (line {number})"))
+                open_query = (number, action)
+            pending_take = (number, action)
+        if _LOOP.match(line) and pending_take is not None:
+            diagnostics.append(Diagnostic(
+                number, "error", "missing-done-action",
+                f"take {pending_take[1]} (line {pending_take[0]}) must be followed by "
+                f"take DoneAction() before waiting"))
+            pending_take = None
+    if open_query is not None:
+        diagnostics.append(Diagnostic(open_query[0], "error", "missing-dispose",
+                                      f"{open_query[1]} is never followed by take DisposeQueriesAction()"))
+
+
+def check_program(source, api_names=None, model_classes=None):
+    """
+    Statically check a generated Scenic program in a few milliseconds, without running Scenic.
+
+    Inputs:
+    1. source (str): the Scenic program
+    2. api_names (set): APIs defined in actions.py; unknown API calls are only reported if given
+    3. model_classes (set): Scenic classes defined in model.scenic; unknown `new X` are only reported if given
+
+    Return:
+    CheckResult whose diagnostics carry the line, severity, code and message of each problem
+    """
+    diagnostics = []
+    lines = code_lines(source)
+    _check_indentation(lines, diagnostics)
+
+    behaviors = dict(_behavior_blocks(lines))
+    if "Instruction" not in behaviors:
+        diagnostics.append(Diagnostic(1, "error", "missing-behavior", "no `behavior Instruction` is defined"))
+    for body in behaviors.values():
+        _check_behavior(body, diagnostics)
+
+    ego_lines = [number for number, line in enumerate(lines, 1) if re.match(r"ego\s*=\s*new\b", line)]
+    if not ego_lines:
+        diagnostics.append(Diagnostic(len(lines), "error", "missing-ego",
+                                      "the program never instantiates ego with `ego = new ...`"))
+    elif "Instruction" in behaviors:
+        tail = " ".join(lines[ego_lines[-1] - 1:ego_lines[-1] + 2])
+        if not re.search(r"with\s+behavior\s+Instruction\b", tail):
+            diagnostics.append(Diagnostic(ego_lines[-1], "warning", "ego-behavior",
+                                          "ego is not instantiated `with behavior Instruction(...)`"))
+
+    defined = {m.group(1) for line in lines for m in [_DEFINITION.match(line)] if m}
+    if model_classes is not None:
+        for number, line in enumerate(lines, 1):
+            for cls in _NEW.findall(line):
+                if cls not in model_classes and cls not in defined:
+                    diagnostics.append(Diagnostic(number, "error", "unknown-class",
+                                                  f"{cls} is not a class defined in model.scenic"))
+    if api_names is not None:
+        known = set(api_names) | set(model_classes or ()) | defined | SCENIC_BUILTINS
+        for number, line in enumerate(lines, 1):
+            if _DEFINITION.match(line):
+                continue
+            for name in set(_CALL.findall(line)) - known:
+                diagnostics.append(Diagnostic(number, "error", "unknown-api",
+                                              f"{name} is not defined in actions.py"))
+    return CheckResult(diagnostics)
+
+
+def known_api_names(api_file_path):
+    """Names a program may call: APIs defined or imported in actions.py plus the core control APIs."""
+    index = load_api_index(library.read(api_file_path))
+    return index.names() | index.imported_names | set(CORE_APIS)
+
+
+def check_program_file(path, api_file_path=None, model_file_path=None):
+    """check_program on a .scenic file, taking API names and classes from actions.py and model.scenic."""
+    with open(path, "r") as file:
+        source = file.read()
+    api_names = known_api_names(api_file_path) if api_file_path else None
+    model_classes = load_model_classes(library.read(model_file_path)) if model_file_path else None
+    return check_program(source, api_names, model_classes)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Statically check generated Scenic programs")
+    parser.add_argument("programs", nargs="+")
+    parser.add_argument("--api", help="path to actions.py")
+    parser.add_argument("--model", help="path to model.scenic")
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.programs:
+        result = check_program_file(path, args.api, args.model)
+        failed = failed or not result.ok
+        print(json.dumps({"program": path, **result.to_dict()}, indent=4))
+    raise SystemExit(1 if failed else 0)
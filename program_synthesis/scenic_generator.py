@@ -1,8 +1,18 @@
+import asyncio
 import json
 import re         
-import requests 
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from scenic_writer import *
 from summarize import *
+from incremental import load_previous, resynthesize, save_steps
+# watch_session_log is started by the notebook when a session starts (see generate_and_upload_report)
+from live_summary import watch_session_log
+from upload_outbox import get_outbox
+from http_cache import cached_get
+from telemetry import span
+from llm_scheduler import default_deadline, deadline as synthesis_deadline
 
 def summarize_logs(logs_dict):
     summary = {
@@ -51,7 +61,9 @@ def download_and_merge_json(json_id, save_path, merge=False):
         "Accept": "application/json"
     }
 
-    response = requests.get(url, headers=headers)
+    # Exercises can be edited at any time, so the cached copy is always revalidated with a
+    # conditional GET (a 304 costs one round trip without a body)
+    response = cached_get(url, headers=headers, ttl=0)
     
     if response.status_code == 200:
         try:
@@ -73,47 +85,77 @@ def download_and_merge_json(json_id, save_path, merge=False):
         return False
     
 
+def download_object_info():
+    """
+    Download object_info.json (the scene's object setup) through the local HTTP cache.
+
+    Returns:
+        dict, or None if the download failed
+    """
+    # url = "https://caduceus-test-754616842718.us-west1.run.app/download/file/object_info.json/"
+    url = "https://api.reia-rehab.com/download/file/object_info.json/"
+    headers = {"Accept": "application/json"}
+
+    response = cached_get(url, headers=headers)
+    if response.status_code != 200:
+        print(f"Failed to download object_info. Status code: {response.status_code}")
+        return None
+    return response.json()
+
+
+def merge_setup(local_data, object_info, merge):
+    """
+    Return local_data with its "setup" replaced: object_info's setup if merge is True, otherwise
+    an empty setup. ego is always added at the origin. Neither input is modified.
+    """
+    if not merge:
+        setup_info = {"setup": {}}
+        setup_info["setup"]["ego"] = [[0, 0, 0],[0, 0, 0]]
+        return {**local_data, **setup_info}
+    if isinstance(object_info, dict) and isinstance(local_data, dict):
+        setup_info = {"setup": dict(object_info["setup"])}
+        setup_info["setup"]["ego"] = [[0, 0, 0],[0, 0, 0]]
+        return {**local_data, **setup_info}  # setup info takes precedence
+    raise ValueError("Both object_info and local file must contain dictionaries")
+
+
+def write_json_atomic(path, data):
+    """Write data as JSON to path via a temporary file and rename, so readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".json.tmp", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def merge_with_object_info(local_json_path, output_path, merge):
     """
     Download object_info from API and merge it with a local JSON file.
+    object_info is only downloaded when merge is True; otherwise only ego is set up.
     
     Args:
         local_json_path (str): Path to the local JSON file to merge with object_info
         output_path (str): Path where the merged JSON will be saved
     """
     try:
-        # First download object_info from API
-        # url = "https://caduceus-test-754616842718.us-west1.run.app/download/file/object_info.json/"
-        url = "https://api.reia-rehab.com/download/file/object_info.json/"
-        headers = {"Accept": "application/json"}
-        
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            print(f"Failed to download object_info. Status code: {response.status_code}")
-            return False
-            
-        object_info = response.json()
+        object_info = None
+        if merge:
+            # First download object_info from API (through the local HTTP cache)
+            object_info = download_object_info()
+            if object_info is None:
+                return False
         
         # Read local JSON file
         with open(local_json_path, 'r', encoding='utf-8') as f:
             local_data = json.load(f)
             
         # Merge the data
-        if not merge:
-            setup_info = {"setup": {}}
-            setup_info["setup"]["ego"] = [[0, 0, 0],[0, 0, 0]]
-            merged_data = {**local_data, **setup_info}
-        elif isinstance(object_info, dict) and isinstance(local_data, dict):
-            setup_info = {"setup": object_info["setup"]}
-            setup_info["setup"]["ego"] = [[0, 0, 0],[0, 0, 0]]
-            # Merge the data
-            if isinstance(local_data, dict):
-                merged_data = {**local_data, **setup_info}  # setup info takes precedence
-                print(f"Successfully merged object_info with {local_json_path} into {output_path}")
-            else:
-                raise ValueError("Local file must contain a dictionary")
-        else:
-            raise ValueError("Both object_info and local file must contain dictionaries")
+        merged_data = merge_setup(local_data, object_info, merge)
+        if merge:
+            print(f"Successfully merged object_info with {local_json_path} into {output_path}")
             
         # Save the merged data
         with open(output_path, 'w', encoding='utf-8') as f:
@@ -132,51 +174,229 @@ def merge_with_object_info(local_json_path, output_path, merge):
         print(f"Error during merge: {e}")
         return False
 
-def generate_scenic_program(file_name):
-    current_dir = current_dir = os.getcwd()
+
+def download_and_merge_jsons(json_ids, merge=False, max_workers=8, save_dir="json"):
+    """
+    Download many exercises concurrently and save each one, merged with the setup, to json/<json_id>.
+
+    object_info.json is downloaded once for the whole batch (and only if merge is True). The
+    exercises are fetched over a thread pool that shares the HTTP cache's pooled session, and each
+    merged JSON is written atomically.
+
+    Args:
+        json_ids (list): exercise IDs as used by download_and_merge_json (e.g. "exercise1.json")
+        merge (bool): merge object_info's setup into each exercise
+        max_workers (int): number of concurrent downloads
+        save_dir (str): directory to save the merged JSONs to
+
+    Returns:
+        list of dictionaries (one per ID, in input order) with keys
+        "json_id", "status" ("ok" or "error"), "save_path", "seconds", "from_cache" and "error"
+    """
+    object_info = None
+    if merge:
+        object_info = download_object_info()
+        if object_info is None:
+            return [{"json_id": json_id, "status": "error", "save_path": None, "seconds": 0.0,
+                     "from_cache": False, "error": "object_info download failed"} for json_id in json_ids]
+    os.makedirs(save_dir, exist_ok=True)
+
+    def download_one(json_id):
+        save_path = os.path.join(save_dir, json_id)
+        result = {"json_id": json_id, "status": "ok", "save_path": save_path, "seconds": 0.0,
+                  "from_cache": False, "error": None}
+        start = time.perf_counter()
+        try:
+            url = f"https://api.reia-rehab.com/download/file/{json_id}/"
+            response = cached_get(url, headers={"Accept": "application/json"}, ttl=0)
+            result["from_cache"] = getattr(response, "from_cache", False)
+            if response.status_code != 200:
+                raise ValueError(f"status code {response.status_code}")
+            write_json_atomic(save_path, merge_setup(response.json(), object_info, merge))
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = str(e)
+        result["seconds"] = time.perf_counter() - start
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(download_one, json_ids))
+
+    print(f"{'json_id':<32} {'status':<7} {'seconds':>8}  cache  error")
+    for r in results:
+        print(f"{r['json_id']:<32} {r['status']:<7} {r['seconds']:8.2f}  {'hit' if r['from_cache'] else '-':<5}  "
+              f"{r['error'] or ''}")
+    return results
+
+
+def scenic_program_paths(file_name):
+    """
+    Resolve the input/output paths used to synthesize json/<file_name>.json.
+
+    Return:
+    dictionary with json_file_path, model_file_path, api_file_path, save_file_path,
+    example_scenic_programs_path and log_file_path
+    """
+    current_dir = os.getcwd()
     parent_dir = os.path.dirname(current_dir)
-    json_name = f"json/{file_name}.json"
-    json_file_path = os.path.join(current_dir, json_name)
-    print("Generating Scenic program", json_file_path)
-    
-    with open(os.path.join(current_dir, json_name), 'r') as file:
-        annotations = json.load(file)
-        model_file_path = os.path.join(
-            parent_dir, "Scenic-main", "Scenic", "src", "scenic", "simulators", "unity", "model.scenic")
-        api_file_path = os.path.join(
-            parent_dir, "Scenic-main", "Scenic", "src", "scenic", "simulators", "unity", "actions.py")
-        save_file_path = os.path.join(current_dir, "scenic_output", f"{file_name}" + ".scenic")
-        example_scenic_programs_path = os.path.join(current_dir, "scenic_output", "example_scenic_program")
-        log_file_path = os.path.join(current_dir, "logs", f"{file_name}" + ".json")
+    unity_dir = os.path.join(parent_dir, "Scenic-main", "Scenic", "src", "scenic", "simulators", "unity")
+    return {
+        "json_file_path": os.path.join(current_dir, "json", f"{file_name}.json"),
+        "model_file_path": os.path.join(unity_dir, "model.scenic"),
+        "api_file_path": os.path.join(unity_dir, "actions.py"),
+        "save_file_path": os.path.join(current_dir, "scenic_output", f"{file_name}" + ".scenic"),
+        "example_scenic_programs_path": os.path.join(current_dir, "scenic_output", "example_scenic_program"),
+        "log_file_path": os.path.join(current_dir, "logs", f"{file_name}" + ".json"),
+    }
+
+
+def generate_scenic_program(file_name, stream=False, max_attempts=2, incremental=True, deadline=None):
+    """
+    Synthesize scenic_output/<file_name>.scenic from json/<file_name>.json.
+
+    With stream=True the program is written while it is generated, and a generation that is
+    recognizably broken (markdown fences, prose before the imports, no behavior Instruction) is
+    cancelled early and retried, up to max_attempts times.
+
+    With incremental=True and a program previously generated from an earlier version of the JSON,
+    only the edited instruction steps are re-synthesized and spliced into that program.
+
+    Programs that fail the static checks are regenerated, up to max_attempts times in either mode.
+
+    deadline (seconds, default $SYNTH_DEADLINE) bounds the whole synthesis: every LLM request's
+    timeout is cut to the time left, and no retry starts after it (see llm_scheduler).
+
+    Returns:
+        str: the program written to scenic_output/<file_name>.scenic
+    """
+    if max_attempts < 1:
+        raise ValueError(f"max_attempts must be at least 1, got {max_attempts}")
+    with synthesis_deadline(deadline if deadline is not None else default_deadline()):
+        return _generate_scenic_program(file_name, stream, max_attempts, incremental)
+
+
+def _generate_scenic_program(file_name, stream, max_attempts, incremental):
+    paths = scenic_program_paths(file_name)
+    print("Generating Scenic program", paths["json_file_path"])
     
-        synth = Synth(annotations, 
-                      model_file_path, 
-                      api_file_path,
-                      example_scenic_programs_path)
-        program = synth.synthesize()
+    with span("file_read", path=os.path.basename(paths["json_file_path"])):
+        with open(paths["json_file_path"], 'r') as file:
+            annotations = json.load(file)
     
-        with open(save_file_path, 'w') as scenic_file:
+    synth = Synth(annotations, 
+                  paths["model_file_path"], 
+                  paths["api_file_path"],
+                  paths["example_scenic_programs_path"])
+
+    if stream:
+        for attempt in range(max_attempts):
+            result = direct_scenic_generator_stream(
+                synth.annotations, synth.api_file_path, synth.scenic_files,
+                synth.model_file_path, paths["save_file_path"])
+            if result["ok"]:
+                save_steps(paths["save_file_path"], synth.annotations, result["program"])
+                print("Done generating Scenic program")
+                return result["program"]
+        raise RuntimeError(f"Streaming synthesis of {file_name} failed: {result['reason']}")
+
+    program = None
+    if incremental:
+        old_annotations, old_program = load_previous(paths["save_file_path"])
+        if old_annotations is not None:
+            program = resynthesize(synth, old_annotations, old_program)
+    if program is None:
+        program = synth.synthesize(max_attempts=max_attempts)
+
+    with span("write", chars=len(program)):
+        with open(paths["save_file_path"], 'w') as scenic_file:
             scenic_file.write(program)
-        print("Done generating Scenic program")
+        save_steps(paths["save_file_path"], synth.annotations, program)
+    print("Done generating Scenic program")
+    return program
 
 
-def generate_and_upload_report(json_id, save_file_name):
+def _load_synth(paths):
+    with open(paths["json_file_path"], 'r') as file:
+        annotations = json.load(file)
+    return Synth(annotations,
+                 paths["model_file_path"],
+                 paths["api_file_path"],
+                 paths["example_scenic_programs_path"])
+
+
+def _write_program(save_file_path, annotations, program):
+    with open(save_file_path, 'w') as scenic_file:
+        scenic_file.write(program)
+    save_steps(save_file_path, annotations, program)
+
+
+async def generate_scenic_programs(file_names, max_concurrency=4, deadline=None):
+    """
+    Synthesize Scenic programs for many exercise JSONs concurrently.
+
+    At most max_concurrency syntheses wait on the LLM at once. Each scenic_output/<name>.scenic
+    is written as soon as its own synthesis finishes, so one slow or failing exercise does not
+    hold back the rest of the batch.
+
+    Args:
+        file_names (list): exercise names, as in json/<name>.json
+        max_concurrency (int): maximum number of syntheses in flight
+        deadline (float): seconds each synthesis may take once it started (default $SYNTH_DEADLINE)
+
+    Returns:
+        list of dictionaries (one per file name, in input order) with keys
+        "name", "status" ("ok" or "error"), "seconds", "save_file_path" and "error"
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    if deadline is None:
+        deadline = default_deadline()
+
+    async def run_one(file_name):
+        paths = scenic_program_paths(file_name)
+        result = {"name": file_name, "status": "ok", "seconds": 0.0,
+                  "save_file_path": paths["save_file_path"], "error": None}
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                # Reading the exercise, setting up Synth (example and model files) and writing the
+                # program block, so they run in worker threads instead of on the event loop
+                synth = await asyncio.to_thread(_load_synth, paths)
+                program = await synth.synthesize_async(deadline=deadline)
+                await asyncio.to_thread(_write_program, paths["save_file_path"], synth.annotations, program)
+                print(f"Done generating Scenic program for {file_name}")
+            except Exception as e:
+                print(f"Error generating Scenic program for {file_name}: {e}")
+                result["status"] = "error"
+                result["error"] = str(e)
+            result["seconds"] = time.perf_counter() - start
+        return result
+
+    return await asyncio.gather(*(run_one(file_name) for file_name in file_names))
+
+
+def generate_and_upload_report(json_id, save_file_name, live_summary=None):
     """
     Generate a report using summarize.py functionality and upload it to Google Cloud.
     
     Args:
         json_id (str): The ID of the exercise (e.g., "exercise1")
+        live_summary (LiveSummarizer): summarizer started with watch_session_log(json_id) when the
+            session began; its summary is used instead of re-reading the log at the end (the log
+            is still read if the summarizer never saw a complete one)
     """
     try:
         # Generate the report using summarize.py functionality
         current_dir = os.getcwd()
         file_name = json_id
-        json_name = os.path.join(current_dir, "logs", f"{file_name}.json")
 
-        with open(json_name, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        summary_json = live_summary.finish() if live_summary is not None else None
+        if summary_json is None or not live_summary.reads:
+            json_name = os.path.join(current_dir, "logs", f"{file_name}.json")
+
+            with open(json_name, 'r', encoding='utf-8') as f:
+                data = json.load(f)
 
-        summary_json = summarize_logs(data)
+            summary_json = summarize_logs(data)
 
         # Save the summary locally first
         save_path = f"summaries/{file_name}.json"
@@ -186,17 +406,14 @@ def generate_and_upload_report(json_id, save_file_name):
 
         # Upload to Google Cloud
         # upload_url = "https://caduceus-test-754616842718.us-west1.run.app/upload/file/?upload_id=" + save_file_name
-        upload_url = "https://api.reia-rehab.com/upload/json/?upload_id=" + save_file_name
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        # Create payload with the summary data
+        # The report is queued on disk and uploaded by the outbox's background worker, which
+        # retries failed uploads, so a network error no longer loses the summary
         payload = summary_json
         print(f"payload: {payload}")
 
-        response = requests.post(upload_url, json=payload, headers=headers)
-        print(f"Response: {response.text}")
+        queued_path = get_outbox().enqueue(save_file_name, payload)
+        print(f"Queued report for upload: {queued_path}")
+        return True
     except Exception as e:
         print(f"Error during report generation and upload: {e}")
         return False
\ No newline at end of file
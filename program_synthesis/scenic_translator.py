@@ -1,55 +1,82 @@
-from api_key import client
 import json
 import openai
 import time
 import re
+from llm_cache import get_cache
+from llm_client import get_client
+from stage_graph import StageGraph
+from api_index import select_api_context, load_api_index
+from instruction_rules import plan_instruction_apis
+from prompt_library import library
+from telemetry import span, traced
+from token_estimator import estimate_tokens
+from json_repair import JSONRepairError, JSONSchema, complete_json, repair_json
+from model_routing import current_stage, get_router
+from model_index import load_model_index
+from wait_primitives import prelude, wait_until
+
+
+def queryLLM(system_prompt, user_prompt, temperature=0, model=None, json_bool=False, max_retries=3):
+    # Without an explicit model, the calling stage's route picks one (see model_routing)
+    router = get_router()
+    cache = get_cache()
+    primary = router.route("openai", current_stage(), model).primary
+    if cache is not None:
+        cache_key = cache.make_key(primary, temperature, json_bool, system_prompt, user_prompt)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached) if json_bool else cached
+
+    prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+
+    def attempt(served_by, timeout):
+        params = {
+            "model": served_by,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "temperature": temperature,
+            "timeout": timeout,
+        }
 
+        # Only include response_format for gpt-4o (and gpt-4o-mini)
+        if served_by.startswith("gpt-4o") and json_bool:
+            params["response_format"] = {"type": "json_object"}
 
-def queryLLM(system_prompt, user_prompt, temperature=0, model="gpt-4", json_bool=False, max_retries=3):
-    retries = 0
-    while retries < max_retries:
-        try:
-            params = {
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "temperature": temperature,
-                "timeout": 30,  # Increase timeout
-            }
-
-            # Only include response_format for gpt-4o
-            if model == "gpt-4o" and json_bool:
-                params["response_format"] = {"type": "json_object"}
-
-            chat = client.chat.completions.create(**params)
+        with span("llm_wait", model=served_by,
+                  prompt_chars=len(system_prompt) + len(user_prompt)) as llm_span:
+            chat = get_client("openai").chat.completions.create(**params)
             output = chat.choices[0].message.content
+            completion_tokens = estimate_tokens(output or "")
+            llm_span.set(completion_chars=len(output or ""), prompt_tokens=prompt_tokens,
+                         completion_tokens=completion_tokens)
 
-            if json_bool:
-                try:
-                    return json.loads(output)
-                except json.JSONDecodeError as e:
-                    print("scenic_translator.py")
-                    print("Error decoding JSON response:", e)
-                    # Print raw response for debugging
-                    print("Raw output:", output)
-                    return None
-            return output
-
-        except json.JSONDecodeError:
-            print("Warning: JSON decoding failed, retrying...")
-        except openai.OpenAIError as e:
-            print(f"OpenAI API error: {e}, retrying...")
-        except Exception as e:
-            print(f"Unexpected error: {e}, retrying...")
-
-        retries += 1
-        time.sleep(2 ** retries)  # Exponential backoff
-
-    raise RuntimeError("queryLLM failed after multiple retries")
-
-
+        if not json_bool:
+            return output, output
+        try:
+            result, repairs = repair_json(output)
+        except JSONRepairError as e:
+            print("scenic_translator.py")
+            print("Error decoding JSON response:", e)
+            print("Raw output:", output)
+            raise
+        if repairs:
+            print(f"Repaired JSON response locally ({', '.join(repairs)})")
+            output = json.dumps(result)
+        return result, output
+
+    # The translator has always given each request 30 seconds
+    result, output, served_by = router.call(
+        "openai", lambda served_by, timeout: attempt(served_by, min(30, timeout)), model=model,
+        max_attempts=max_retries, tokens=prompt_tokens)
+    # Answers of the fallback model are not cached under the primary's key
+    if cache is not None and served_by == primary:
+        cache.put(cache_key, output, model=served_by)
+    return result
+
+
+@traced()
 def obj_model_finder(obj_list, file_path):
     """ 
     To instantiate objects in Scenic program, we need to identify which Scenic objects to reference 
@@ -64,23 +91,34 @@ def obj_model_finder(obj_list, file_path):
     """
 
     # load in the scenic.model file as a string
-    with open(file_path, "r") as file:
-        scenic_models = file.read()
+    scenic_models = library.read(file_path)
+
+    # Names that match a class (or one of its aliases) in the parsed model.scenic are resolved
+    # locally; only the rest goes to the LLM
+    resolved, unresolved = load_model_index(scenic_models).resolve_all(obj_list)
+    print(f"obj_model_finder: resolved {len(resolved)} of {len(obj_list)} objects locally "
+          f"({len(unresolved)} left for the LLM)")
+    if not unresolved:
+        return resolved
 
     system_prompt = f'''You are given a library of Python objects which semantically represent physical objects (e.g. orange, basket). 
     You will be given a name of physical object. Your task is to reference the library here: {scenic_models} and 
     return the name of the Python object that represents it. Make sure your output is case-sensitive. '''
 
-    user_prompt = f'''Here is a list of object names: {obj_list}. Please output the corresponding python object name from the provided library.
+    user_prompt = f'''Here is a list of object names: {unresolved}. Please output the corresponding python object name from the provided library.
     Your output should be a json, which consists of a dictionary whose key is a string name of the object in the obj_list 
     and its value is the string name of the corresponding Python class object name defined in the given library. 
     For example, if the given list of objects is ['orange1', 'basket1'], and the names of the corresponding python class object 
     in the provided library are 'Orange' and 'Basket', then you should output a json, {{'orange1': 'Orange', 'basket1':'Basket'}}.
     '''
 
-    return queryLLM(system_prompt, user_prompt, json_bool=True)
+    # Every object needs a class; objects the answer leaves out are asked for again
+    answer = complete_json(queryLLM, system_prompt, user_prompt, JSONSchema("obj_model_finder", keys=unresolved))
+    answer.update(resolved)
+    return {name: answer[name] for name in obj_list if name in answer}
 
 
+@traced()
 def api_retriever(instruction_list, object_list, file_path):
     """ 
     Given a description of the metrics to monitor, return the corresponding APIs needed to monitor each metric.
@@ -95,9 +133,28 @@ def api_retriever(instruction_list, object_list, file_path):
         1) key (int): the index of the description in the given list of metrics descriptions
         2) val (str): corresponding API to monitor the metric with input args filled out (e.g. ObjectGrasped(sponge1))
     """
-    # load in the scenic.model file as a string
-    with open(file_path, "r") as file:
-        apis = file.read()
+    # Stereotyped steps are mapped to APIs by local rules; only the rest goes to the LLM
+    api_source = library.read(file_path)
+    index = load_api_index(api_source)
+    plan = plan_instruction_apis(instruction_list, object_list,
+                                 (index.names() | index.imported_names) or None)
+    print(f"api_retriever: resolved {plan.local_fraction:.0%} of steps locally "
+          f"({len(plan.unmatched)} of {len(plan.instruction_list)} left for the LLM)")
+    if plan.complete:
+        return plan.merge({})
+    if plan.needs_full_llm:
+        steps, steps_note = instruction_list, ""
+    else:
+        steps = {i: instruction_list[i] for i in plan.unmatched}
+        steps_note = """
+    The steps are given as a dictionary from step index to description. The other steps are already handled,
+    so return exactly one API call per given step and use the given step indices as the keys
+    (the keys do not need to be contiguous).
+    """
+
+    # load in the API library and keep only the APIs relevant to these instructions
+    apis, _ = select_api_context(api_source, list(steps.values()) if isinstance(steps, dict) else list(steps),
+                                 label="api_retriever")
 
     system_prompt = f'''
     You are a helpful coding assistant. 
@@ -108,7 +165,7 @@ def api_retriever(instruction_list, object_list, file_path):
     '''
 
     user_prompt = f'''
-    Here is the list of descriptions of steps of exercise: {instruction_list}. 
+    Here is the list of descriptions of steps of exercise: {steps}. {steps_note}
     Here are the list of objects that will be present in the scene: {object_list}.
     
     Each description may contain Python variable names corresponding to objects in the scene.  
@@ -167,9 +224,18 @@ def api_retriever(instruction_list, object_list, file_path):
 
     '''
 
-    return queryLLM(system_prompt, user_prompt, json_bool=True)
+    if plan.needs_full_llm:
+        # Repeats expand into extra steps, so only contiguity of the keys can be checked
+        schema = JSONSchema("api_retriever", contiguous=True)
+        api_dict = complete_json(queryLLM, system_prompt, user_prompt, schema)
+        return api_dict
+    schema = JSONSchema("api_retriever", keys=plan.unmatched)
+    api_dict = complete_json(queryLLM, system_prompt, user_prompt, schema,
+                             describe=lambda k: instruction_list[int(k)])
+    return plan.merge(api_dict)
 
 
+@traced()
 def instruction_generator(functions, instruction_list):
     """
     Given a dictionary where the key is an integer and the value is a function call, 
@@ -251,7 +317,10 @@ def instruction_generator(functions, instruction_list):
 
     Again, return just JSON without explanation or any text.
     '''
-    return queryLLM(system_prompt, user_prompt, json_bool=True)
+    # One spoken instruction per API call, keyed like functions
+    keys = list(functions.keys()) if isinstance(functions, dict) else None
+    schema = JSONSchema("instruction_generator", keys=keys, contiguous=True)
+    return complete_json(queryLLM, system_prompt, user_prompt, schema)
 
 
 def program_synthesis(annotations):
@@ -298,15 +367,28 @@ class Synth:
         self.log_file_path = log_file_path
         self.obj_list = list(self.obj_dict.keys())
         self.env_object_list = ["Shelf", "Box", "ego"]
+        self.stage_latencies = {}
 
     def synthesize(self):
-        obj_scenic_dict = obj_model_finder(self.obj_list, self.model_file_path)
+        # obj_model_finder is independent of api_retriever -> instruction_generator, so both
+        # branches query the LLM in parallel
+        graph = StageGraph()
+        graph.add_stage("obj_scenic_dict",
+                        lambda: obj_model_finder(self.obj_list, self.model_file_path))
+        graph.add_stage("metric_api_dict",
+                        lambda: api_retriever(self.instruction_list, self.obj_list, self.api_file_path))
+        graph.add_stage("instruction_dict",
+                        lambda metric_api_dict: instruction_generator(metric_api_dict, self.instruction_list),
+                        deps=["metric_api_dict"])
+        stage_results = graph.run()
+        graph.report()
+        self.stage_latencies = dict(graph.latencies)
+
+        obj_scenic_dict = stage_results["obj_scenic_dict"]
         print(f"obj_scenic_dict: {json.dumps(obj_scenic_dict, indent=4)}")
-        metric_api_dict = api_retriever(
-            self.instruction_list, self.obj_list, self.api_file_path)
+        metric_api_dict = stage_results["metric_api_dict"]
         print(f"metric_api_dict: {json.dumps(metric_api_dict, indent=4)}")
-        instruction_dict = instruction_generator(
-            metric_api_dict, self.instruction_list)
+        instruction_dict = stage_results["instruction_dict"]
         print(f"instruction_dict: {json.dumps(instruction_dict, indent=4)}")
 
         # Write log file
@@ -328,7 +410,8 @@ class Synth:
             file.write("from scenic.simulators.unity.actions import *\n")
             file.write("from scenic.simulators.unity.behaviors import *\n")
             file.write("model scenic.simulators.unity.model\n\n")
-            
+            file.write(prelude("\t") + "\n")
+
             file.write(f"log_file_path = r\"{self.log_file_path}\"\n\n")
 
             # Write the behavior for Instructions:
@@ -388,12 +471,10 @@ class Synth:
                 file.write(f"\ttake DoneAction()\n")
 
                 # Adding a 2 second time buffer
-                file.write(f"\tfor _ in range(30):\n")
-                file.write(f"\t\twait\n\n")
+                file.write(f"\tdo Pause(ticks=30)\n\n")
 
-                # write monitoring condition with while not.
-                file.write(f"\twhile not {api}:\n")
-                file.write(f"\t\twait\n\n")
+                # wait for the monitoring condition
+                file.write(f"\t{wait_until(api)}\n\n")
                 file.write(f"\tlog = LogAction(log, log_file_path)\n\n")
             file.write(f"\ttake DoneAction()\n")
 
@@ -1,25 +1,53 @@
 from api_key import client
+import asyncio
 import json
 import openai
 import time
 import requests
 import re
 import os
+import tempfile
 import api_key as key
 from openai import OpenAI
-
-
-def queryLLM(system_prompt, user_prompt, temperature=0, model="gpt-4", json_bool=False, max_retries=3):
-    retries = 0
-    while retries < max_retries:
-        try:
-            client = OpenAI(
-            api_key= key.GROK,
-            base_url="https://api.x.ai/v1",
-            )
-            
-            chat = client.chat.completions.create(
-            model="grok-3-beta",
+from llm_cache import get_cache
+from llm_client import get_client, get_async_client
+from stage_graph import StageGraph
+from api_index import select_api_context, load_api_index
+from instruction_rules import plan_instruction_apis
+from prompt_library import library
+from stream_guard import StreamGuard
+from scenic_checker import check_program, known_api_names
+from model_index import load_model_classes, load_model_index
+from http_cache import cached_get
+from telemetry import span, traced
+from token_estimator import estimate_tokens
+from json_repair import JSONRepairError, JSONSchema, complete_json, repair_json
+from llm_scheduler import DeadlineExceeded, get_scheduler, deadline as synthesis_deadline
+from model_routing import current_stage, get_router
+from example_selector import VALIDATED_DIRS, select_examples, validated_programs
+from wait_primitives import prelude, wait_until
+from condition_optimizer import optimize_program
+
+
+def queryLLM(system_prompt, user_prompt, temperature=0, model=None, json_bool=False, max_retries=3):
+    # Without an explicit model, the calling stage's route picks one (see model_routing);
+    # the cache is keyed on, and only keeps answers of, the stage's primary model
+    router = get_router()
+    cache = get_cache()
+    primary = router.route("grok", current_stage(), model).primary
+    if cache is not None:
+        cache_key = cache.make_key(primary, temperature, json_bool, system_prompt, user_prompt)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached) if json_bool else cached
+
+    prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+
+    def attempt(served_by, timeout):
+        with span("llm_wait", model=served_by,
+                  prompt_chars=len(system_prompt) + len(user_prompt)) as llm_span:
+            chat = get_client("grok").chat.completions.create(
+            model=served_by,
             messages= [ 
             {
                 "role": "system",
@@ -28,34 +56,141 @@ def queryLLM(system_prompt, user_prompt, temperature=0, model="gpt-4", json_bool
             {
                 "role": "user",
                 "content": user_prompt
-            }]
+            }],
+            temperature=temperature,
+            timeout=timeout,
             )
             output = chat.choices[0].message.content
+            completion_tokens = estimate_tokens(output or "")
+            llm_span.set(completion_chars=len(output or ""), prompt_tokens=prompt_tokens,
+                         completion_tokens=completion_tokens)
+        return _parse_output(output, json_bool)
+
+    # Retries, backoff, the synthesis deadline and the circuit breaker are handled by the scheduler
+    result, output, served_by = router.call("grok", attempt, model=model, max_attempts=max_retries,
+                                            tokens=prompt_tokens)
+    # Answers of the fallback model are not cached under the primary's key
+    if cache is not None and served_by == primary:
+        cache.put(cache_key, output, model=served_by)
+    return result
+
+
+def _parse_output(output, json_bool):
+    """Return (answer, text to cache). Raises JSONRepairError on irreparable JSON, which is retried."""
+    if not json_bool:
+        return output, output
+    try:
+        result, repairs = repair_json(output)
+    except JSONRepairError as e:
+        print("scenic_writer.py")
+        print("Error decoding JSON response:", e)
+        print("Raw output:", output)
+        raise
+    if repairs:
+        print(f"Repaired JSON response locally ({', '.join(repairs)})")
+        output = json.dumps(result)
+    return result, output
+
+
+async def queryLLM_async(system_prompt, user_prompt, temperature=0, model=None, json_bool=False, max_retries=3):
+    """
+    asyncio counterpart of queryLLM, so that many syntheses can wait on the provider concurrently.
+    Shares the response cache, the model routing and the scheduler (retries, deadline, hedging,
+    circuit breaker) of queryLLM.
+    """
+    router = get_router()
+    cache = get_cache()
+    primary = router.route("grok", current_stage(), model).primary
+    if cache is not None:
+        cache_key = cache.make_key(primary, temperature, json_bool, system_prompt, user_prompt)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached) if json_bool else cached
+
+    prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+
+    async def attempt(served_by, timeout):
+        with span("llm_wait", model=served_by,
+                  prompt_chars=len(system_prompt) + len(user_prompt)) as llm_span:
+            chat = await get_async_client("grok").chat.completions.create(
+            model=served_by,
+            messages= [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            {
+                "role": "user",
+                "content": user_prompt
+            }],
+            temperature=temperature,
+            timeout=timeout,
+            )
+            output = chat.choices[0].message.content
+            completion_tokens = estimate_tokens(output or "")
+            llm_span.set(completion_chars=len(output or ""), prompt_tokens=prompt_tokens,
+                         completion_tokens=completion_tokens)
+        return _parse_output(output, json_bool)
 
-            if json_bool:
-                try:
-                    return json.loads(output)
-                except json.JSONDecodeError as e:
-                    print("scenic_writer.py")
-                    print("Error decoding JSON response:", e)
-                    # Print raw response for debugging
-                    print("Raw output:", output)
-                    return None
-            return output
-
-        except json.JSONDecodeError:
-            print("Warning: JSON decoding failed, retrying...")
-        except openai.OpenAIError as e:
-            print(f"OpenAI API error: {e}, retrying...")
-        except Exception as e:
-            print(f"Unexpected error: {e}, retrying...")
-
-        retries += 1
-        time.sleep(2 ** retries)  # Exponential backoff
+    result, output, served_by = await router.call_async("grok", attempt, model=model,
+                                                        max_attempts=max_retries, tokens=prompt_tokens)
+    # Answers of the fallback model are not cached under the primary's key
+    if cache is not None and served_by == primary:
+        cache.put(cache_key, output, model=served_by)
+    return result
 
-    raise RuntimeError("queryLLM failed after multiple retries")
 
+def queryLLM_stream(system_prompt, user_prompt, on_text, temperature=0, model=None):
+    """
+    Streaming variant of queryLLM. on_text is called with every piece of text as it arrives;
+    if it returns a truthy value the request is cancelled and no more tokens are paid for.
 
+    Return:
+    tuple: (output received so far (str), cancelled (bool), time to first token in seconds or None)
+    """
+    start = time.perf_counter()
+    ttfb = None
+    pieces = []
+    cancelled = False
+    # A stream is not retried or failed over (the caller restarts it), so only the primary is used
+    model = get_router().route("grok", current_stage(), model).primary
+    prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+    get_scheduler().admit(f"grok.{model}", prompt_tokens)
+    with span("llm_wait", model=model, stream=True,
+              prompt_chars=len(system_prompt) + len(user_prompt)) as llm_span:
+        stream = get_client("grok").chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            stream=True,
+            temperature=temperature,
+            timeout=get_scheduler().timeout(),
+        )
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                text = chunk.choices[0].delta.content
+                if not text:
+                    continue
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                pieces.append(text)
+                if on_text(text):
+                    cancelled = True
+                    break
+        finally:
+            stream.close()  # closes the HTTP response, which cancels the generation
+            output = "".join(pieces)
+            llm_span.set(completion_chars=len(output), ttfb=ttfb, cancelled=cancelled,
+                         prompt_tokens=prompt_tokens, completion_tokens=estimate_tokens(output))
+    get_scheduler().charge(f"grok.{model}", llm_span.attrs["completion_tokens"])
+    return output, cancelled, ttfb
+
+
+@traced()
 def obj_model_finder(obj_list, file_path):
     """ 
     To instantiate objects in Scenic program, we need to identify which Scenic objects to reference 
@@ -70,23 +205,34 @@ def obj_model_finder(obj_list, file_path):
     """
 
     # load in the scenic.model file as a string
-    with open(file_path, "r") as file:
-        scenic_models = file.read()
+    scenic_models = library.read(file_path)
+
+    # Names that match a class (or one of its aliases) in the parsed model.scenic are resolved
+    # locally; only the rest goes to the LLM
+    resolved, unresolved = load_model_index(scenic_models).resolve_all(obj_list)
+    print(f"obj_model_finder: resolved {len(resolved)} of {len(obj_list)} objects locally "
+          f"({len(unresolved)} left for the LLM)")
+    if not unresolved:
+        return resolved
 
     system_prompt = f'''You are given a library of Python objects which semantically represent physical objects (e.g. orange, basket). 
     You will be given a name of physical object. Your task is to reference the library here: {scenic_models} and 
     return the name of the Python object that represents it. Make sure your output is case-sensitive. '''
 
-    user_prompt = f'''Here is a list of object names: {obj_list}. Please output the corresponding python object name from the provided library.
+    user_prompt = f'''Here is a list of object names: {unresolved}. Please output the corresponding python object name from the provided library.
     Your output should be a json, which consists of a dictionary whose key is a string name of the object in the obj_list 
     and its value is the string name of the corresponding Python class object name defined in the given library. 
     For example, if the given list of objects is ['orange1', 'basket1'], and the names of the corresponding python class object 
     in the provided library are 'Orange' and 'Basket', then you should output a json, {{'orange1': 'Orange', 'basket1':'Basket', 'ego': \"Scenicavatar\"}}.
     '''
 
-    return queryLLM(system_prompt, user_prompt, json_bool=True)
+    # Every object needs a class; objects the answer leaves out are asked for again
+    answer = complete_json(queryLLM, system_prompt, user_prompt, JSONSchema("obj_model_finder", keys=unresolved))
+    answer.update(resolved)
+    return {name: answer[name] for name in obj_list if name in answer}
 
 
+@traced()
 def api_retriever(instruction_list, object_list, file_path):
     """ 
     Given a description of the metrics to monitor, return the corresponding APIs needed to monitor each metric.
@@ -101,9 +247,28 @@ def api_retriever(instruction_list, object_list, file_path):
         1) key (int): the index of the description in the given list of metrics descriptions
         2) val (str): corresponding API to monitor the metric with input args filled out (e.g. ObjectGrasped(sponge1))
     """
-    # load in the scenic.model file as a string
-    with open(file_path, "r") as file:
-        apis = file.read()
+    # Stereotyped steps are mapped to APIs by local rules; only the rest goes to the LLM
+    api_source = library.read(file_path)
+    index = load_api_index(api_source)
+    plan = plan_instruction_apis(instruction_list, object_list,
+                                 (index.names() | index.imported_names) or None)
+    print(f"api_retriever: resolved {plan.local_fraction:.0%} of steps locally "
+          f"({len(plan.unmatched)} of {len(plan.instruction_list)} left for the LLM)")
+    if plan.complete:
+        return plan.merge({})
+    if plan.needs_full_llm:
+        steps, steps_note = instruction_list, ""
+    else:
+        steps = {i: instruction_list[i] for i in plan.unmatched}
+        steps_note = """
+    The steps are given as a dictionary from step index to description. The other steps are already handled,
+    so return exactly one API call per given step and use the given step indices as the keys
+    (the keys do not need to be contiguous).
+    """
+
+    # load in the API library and keep only the APIs relevant to these instructions
+    apis, _ = select_api_context(api_source, list(steps.values()) if isinstance(steps, dict) else list(steps),
+                                 label="api_retriever")
 
     system_prompt = f'''
     You are a helpful coding assistant. 
@@ -114,7 +279,7 @@ def api_retriever(instruction_list, object_list, file_path):
     '''
 
     user_prompt = f'''
-    Here is the list of descriptions of steps of exercise: {instruction_list}. 
+    Here is the list of descriptions of steps of exercise: {steps}. {steps_note}
     Here are the list of objects that will be present in the scene: {object_list}.
     
     Each description may contain Python variable names corresponding to objects in the scene.  
@@ -186,9 +351,18 @@ def api_retriever(instruction_list, object_list, file_path):
      The dictionary must contain all numbers in the range, starting from the first key to the last key, without skipping any numbers.
     '''
 
-    return queryLLM(system_prompt, user_prompt, json_bool=True)
+    if plan.needs_full_llm:
+        # Repeats expand into extra steps, so only contiguity of the keys can be checked
+        schema = JSONSchema("api_retriever", contiguous=True)
+        api_dict = complete_json(queryLLM, system_prompt, user_prompt, schema)
+        return api_dict
+    schema = JSONSchema("api_retriever", keys=plan.unmatched)
+    api_dict = complete_json(queryLLM, system_prompt, user_prompt, schema,
+                             describe=lambda k: instruction_list[int(k)])
+    return plan.merge(api_dict)
 
 
+@traced()
 def instruction_generator(instruction_list):
     """
     Given a dictionary where the key is an integer and the value is a function call, 
@@ -223,9 +397,12 @@ def instruction_generator(instruction_list):
 
     Again, return just JSON without explanation or any text.
     '''
-    return queryLLM(system_prompt, user_prompt, json_bool=True)
+    schema = JSONSchema("instruction_generator", keys=range(len(instruction_list)), contiguous=True)
+    return complete_json(queryLLM, system_prompt, user_prompt, schema,
+                         describe=lambda k: instruction_list[int(k)])
 
 
+@traced()
 def direct_scenic_generator(json_file, actions_path, scenic_example_files, model_file_path):
     """
     Prompts an LLM to generate a Scenic program from annotations and therapist's instructions. 
@@ -235,20 +412,148 @@ def direct_scenic_generator(json_file, actions_path, scenic_example_files, model
     2. actions_path (str): path to the python script with the library of APIs
     3. scenic_examples_path (str): path to the scenic examples
     """
+    system_prompt, user_prompt = direct_scenic_prompts(
+        json_file, actions_path, scenic_example_files, model_file_path)
+    return queryLLM(system_prompt, user_prompt)
+
+
+@traced()
+def direct_scenic_generator_stream(json_file, actions_path, scenic_example_files, model_file_path, save_file_path):
+    """
+    Streaming variant of direct_scenic_generator that writes the program to save_file_path as it is
+    generated and cancels the request as soon as the output is known to be unusable (see StreamGuard).
+
+    The program is streamed into a temporary file next to save_file_path which is atomically renamed
+    over save_file_path only if the whole program passed the stream checks and the static checks of
+    scenic_checker, so a rejected generation never replaces an existing program.
+
+    Return:
+    dictionary with keys
+        "ok" (bool), "reason" (str or None, why the output was rejected),
+        "program" (str), "ttfb" (seconds to the first token), "seconds" (total time),
+        "chars" (characters received), "cancelled" (bool, whether the request was cut short),
+        "check_result" (CheckResult of the static checks, None if the stream was rejected before)
+    """
+    system_prompt, user_prompt = direct_scenic_prompts(
+        json_file, actions_path, scenic_example_files, model_file_path)
+    guard = StreamGuard()
+    save_dir = os.path.dirname(os.path.abspath(save_file_path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".scenic.partial", dir=save_dir)
+    start = time.perf_counter()
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            def on_text(text):
+                tmp_file.write(text)
+                tmp_file.flush()
+                return guard.feed(text) is not None
+
+            program, cancelled, ttfb = queryLLM_stream(system_prompt, user_prompt, on_text)
+        reason = guard.reason if cancelled else guard.finish()
+        check_result = None
+        if reason is None:
+            program = optimize_program(program, label="direct_scenic_generator_stream")
+            check_result = check_program(program, known_api_names(actions_path),
+                                         load_model_classes(library.read(model_file_path)))
+            if not check_result.ok:
+                reason = f"static checks failed ({', '.join(sorted({d.code for d in check_result.errors()}))})"
+        if reason is None:
+            with open(tmp_path, "w") as tmp_file:
+                tmp_file.write(program)
+            os.replace(tmp_path, save_file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    result = {"ok": reason is None, "reason": reason, "program": program,
+              "ttfb": ttfb, "seconds": time.perf_counter() - start,
+              "chars": len(program), "cancelled": cancelled, "check_result": check_result}
+    if reason is None:
+        print(f"Streamed program to {save_file_path} (first token {ttfb:.2f}s, total {result['seconds']:.2f}s)")
+    else:
+        print(f"Rejected streamed program after {result['seconds']:.2f}s and {len(program)} chars: {reason}")
+        if check_result is not None and not check_result.ok:
+            print(check_result)
+    return result
 
-    with open(actions_path, "r") as file:
-        apis = file.read()
 
-    file_contents = []
+@traced()
+async def direct_scenic_generator_async(json_file, actions_path, scenic_example_files, model_file_path):
+    """
+    asyncio counterpart of direct_scenic_generator. Takes the same inputs.
+    """
+    # Building the prompt reads files and ranks the examples, so it runs off the event loop
+    system_prompt, user_prompt = await asyncio.to_thread(
+        direct_scenic_prompts, json_file, actions_path, scenic_example_files, model_file_path)
+    return await queryLLM_async(system_prompt, user_prompt)
 
-    for file_path in scenic_example_files:
-        with open(file_path, 'r') as file:
-            content = file.read()
-            file_contents.append(content)
 
-    models = None
-    with open(model_file_path, "r") as file:
-        models = file.read()
+@traced()
+def instruction_step_generator(instruction, marker, program, actions_path):
+    """
+    Prompts an LLM to write the code block of a single instruction step of an existing Scenic program.
+    Used to re-synthesize only the steps a therapist edited (see incremental.py).
+
+    Inputs:
+    1. instruction (str): the new or edited instruction step
+    2. marker (str): the section comment the block must start with, e.g. "    # ---------- Instruction 3 ----------"
+    3. program (str): the existing Scenic program, whose other steps the block must follow
+    4. actions_path (str): path to the python script with the library of APIs
+
+    Return:
+    the code block (str)
+    """
+    apis, _ = select_api_context(library.read(actions_path), [instruction], label="instruction_step_generator")
+
+    system_prompt = f'''
+    You are a helpful coding assistant with knowledge in physical and occupational therapy.
+    You are given an existing Scenic program that instructs, monitors, and logs a patient's rehabilitation exercise,
+    one instruction step at a time, in the body of `behavior Instruction()`. Each step is a section that starts with
+    a comment of the form "# ---------- Instruction n ----------".
+
+    A therapist has added or edited one instruction step. Your task is to write the code block of that step only.
+    The block must follow exactly the same structure as the other steps of the program: speak the instruction,
+    take DoneAction() after every action, wait for the speech to finish, monitor the step with the provided APIs,
+    take DoneAction() and DisposeQueriesAction() after visual queries, and update the logs with UpdateLogs.
+    Use the same indentation as the other steps.
+
+    Here are the APIs you may use: \n {apis} \n
+
+    Output only the code block, starting with the given section comment.
+    Do not output the rest of the program, explanations, or markdown fences.
+    '''
+
+    user_prompt = f'''
+    Existing program: \n {program} \n
+    Section comment to start the block with: \n{marker}\n
+    Instruction step: {instruction}
+    '''
+    return queryLLM(system_prompt, user_prompt)
+
+
+def direct_scenic_prompts(json_file, actions_path, scenic_example_files, model_file_path):
+    """
+    Builds the system and user prompts used by direct_scenic_generator.
+
+    Return:
+    tuple: (system_prompt (str), user_prompt (str))
+    """
+    with span("prompt_build", stage="direct_scenic_generator") as prompt_span:
+        system_prompt, user_prompt = _direct_scenic_prompts(
+            json_file, actions_path, scenic_example_files, model_file_path)
+        prompt_span.set(prompt_chars=len(system_prompt) + len(user_prompt))
+    return system_prompt, user_prompt
+
+
+def _direct_scenic_prompts(json_file, actions_path, scenic_example_files, model_file_path):
+
+    instruction_list = json_file.get("instruction", []) if isinstance(json_file, dict) else []
+    apis, _ = select_api_context(library.read(actions_path), instruction_list, label="direct_scenic_generator")
+
+    # Only the examples most similar to this exercise that fit the token budget are inlined,
+    # rendered into the prompt exactly as str(list of file contents)
+    example_files = select_examples(json_file, scenic_example_files, library.read(actions_path),
+                                    label="direct_scenic_generator")
+    file_contents = library.segment(("scenic_examples", tuple(example_files)), example_files, str)
 
     system_prompt = f'''
     You are a helpful coding assistant with knowledge in physical and occupational therapy. 
@@ -311,6 +616,9 @@ def direct_scenic_generator(json_file, actions_path, scenic_example_files, model
     2. It is very important that, whenever the therapist instructs the patient to 'repeat' certain steps, 
        you should identify the scope of 'which' steps are to be repeated and convert that instruction into a for-loop in the Scenic program. 
        And, within the for-loop, make sure you instruct each step again as shown in the example Scenic programs. \n
+    3. Wait for a condition with `do WaitUntil(lambda: <condition>, ...)` and for a fixed time with `do Pause(...)`
+       as shown in the example Scenic programs, never with `while ...: wait` loops. Do not define WaitUntil or Pause;
+       their definitions are added to your program afterwards.\n
     
     Please reference the provided examples of Scenic programs to understand how to instruct, monitor, and log the patient's performance.
     '''
@@ -331,20 +639,22 @@ def direct_scenic_generator(json_file, actions_path, scenic_example_files, model
     Just return the Scenic program as a string such that it can be directly written to a file and be executed.
     '''
 
-    return queryLLM(system_prompt, user_prompt)
+    return system_prompt, user_prompt
 
 
+@traced()
 def instruction_transcript_generator(exercise_title, example_json_path):
-    examples = [os.path.join(example_json_path, f)
-                for f in os.listdir(example_json_path)
-                if os.path.isfile(os.path.join(example_json_path, f))]
-    example_json_files = []
+    examples = library.list_files(example_json_path)
+    system_prompt = library.segment(("transcript_system_prompt", tuple(examples)),
+                                    examples, _transcript_system_prompt)
+
+    user_prompt = f'''
+    Here is the exercise title you will be generating instruction JSON with: {exercise_title}
+    '''
+    return queryLLM(system_prompt, user_prompt)
 
-    for file_name in examples:
-        with open(file_name, 'r') as file:
-            content = file.read()
-            example_json_files.append(content)
 
+def _transcript_system_prompt(example_json_files):
     patient_deficit = '''
     The patient presents with mild right upper extremity weakness.
     Active range of motion of right side is restricted due to the application of an elbow cast and a thumb spica splint.
@@ -373,11 +683,7 @@ def instruction_transcript_generator(exercise_title, example_json_path):
     Your output should follow the same JSON format given in the examples.
     Output only the JSON, WITHOUT any explaination or comments.
     '''
-
-    user_prompt = f'''
-    Here is the exercise title you will be generating instruction JSON with: {exercise_title}
-    '''
-    return queryLLM(system_prompt, user_prompt, model='o4-mini')
+    return system_prompt
 
 
 def escape_quotes(text):
@@ -404,9 +710,13 @@ class Synth:
     2. save_file_path (str): the path to save the synthesized Scenic program
     3. model_file_path (str): the path to model.scenic
     4. api_file_path (str): the path to python script with a library of APIs
+    5. example_scenic_programs_path (str): directory of the example Scenic programs
+    6. validated_examples (bool): also draw examples from earlier programs in VALIDATED_DIRS that
+       pass the static checks (default: $EXAMPLES_FROM_OUTPUTS == "1")
     """
 
-    def __init__(self, annotations, model_file_path, api_file_path, example_scenic_programs_path):
+    def __init__(self, annotations, model_file_path, api_file_path, example_scenic_programs_path,
+                 validated_examples=None):
         if "ego" not in annotations["setup"]:
             annotations["setup"]["ego"] = [[0, 0, 0], [0, 0, 0]]
         self.annotations = annotations
@@ -425,27 +735,104 @@ class Synth:
         # self.log_file_path = log_file_path
         self.obj_list = list(self.obj_dict.keys())
         self.env_object_list = ["Shelf", "Box", "ego"]
-        self.scenic_files = [
-            os.path.join(example_scenic_programs_path, f)
-            for f in os.listdir(example_scenic_programs_path)
-            if os.path.isfile(os.path.join(example_scenic_programs_path, f))
-        ]
+        self.stage_latencies = {}
+        self.check_result = None
+        # Candidate examples; each prompt inlines only the best-matching ones (see example_selector)
+        self.scenic_files = library.list_files(example_scenic_programs_path)
+        if validated_examples is None:
+            validated_examples = os.environ.get("EXAMPLES_FROM_OUTPUTS") == "1"
+        if validated_examples:
+            self.scenic_files += validated_programs(
+                VALIDATED_DIRS, known_api_names(api_file_path), load_model_classes(library.read(model_file_path)))
+
+    def _check_inputs(self):
+        """(API names of actions.py, class names of model.scenic) for check_program."""
+        return known_api_names(self.api_file_path), load_model_classes(library.read(self.model_file_path))
+
+    def _checked(self, candidate, attempt, max_attempts, api_names, model_classes):
+        """Optimize a generated program and check it; sets self.check_result. Return the program."""
+        # Polling loops become wait primitives (whose definitions are added to the program)
+        # and VLM queries wait for their BPE checks
+        program = optimize_program(candidate)
+        self.check_result = check_program(program, api_names, model_classes)
+        if not self.check_result.ok:
+            print(f"Generated program failed static checks (attempt {attempt}/{max_attempts}):")
+            print(self.check_result)
+        return program
 
-    def synthesize(self):
+    async def synthesize_async(self, max_attempts=2, deadline=None):
+        """
+        asyncio counterpart of synthesize (direct generation path only), with the same checks and
+        retries. File reads, prompt building and the checks run in worker threads, so the event loop
+        is only used to wait on the LLM.
+        """
+        api_names, model_classes = await asyncio.to_thread(self._check_inputs)
+        program = None
+        with synthesis_deadline(deadline):
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    candidate = await direct_scenic_generator_async(
+                        self.annotations, self.api_file_path, self.scenic_files, self.model_file_path)
+                except DeadlineExceeded:
+                    if program is None:
+                        raise
+                    print("Synthesis deadline reached; keeping the last generated program")
+                    break
+                program = await asyncio.to_thread(
+                    self._checked, candidate, attempt, max_attempts, api_names, model_classes)
+                if self.check_result.ok:
+                    break
+        return program
+
+    def synthesize(self, max_attempts=2, deadline=None):
         # # write scenic program
-        program = direct_scenic_generator(
-            self.annotations, self.api_file_path, self.scenic_files, self.model_file_path)
+        # Generated programs are checked offline before they reach the headset; a program
+        # with errors is regenerated right away (up to max_attempts times).
+        # deadline (seconds) bounds the whole synthesis, every LLM call and retry included.
+        api_names, model_classes = self._check_inputs()
+        program = None
+        with synthesis_deadline(deadline):
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    candidate = direct_scenic_generator(
+                        self.annotations, self.api_file_path, self.scenic_files, self.model_file_path)
+                except DeadlineExceeded:
+                    if program is None:
+                        raise
+                    print("Synthesis deadline reached; keeping the last generated program")
+                    break
+                program = self._checked(candidate, attempt, max_attempts, api_names, model_classes)
+                if self.check_result.ok:
+                    break
         # print(program)
         return program
-        obj_scenic_dict = obj_model_finder(self.obj_list, self.model_file_path)
+
+    def synthesize_legacy(self, save_file_path, log_file_path):
+        """
+        Template-based synthesis: three LLM stages fill in a fixed Scenic skeleton.
+        None of the stages depend on each other, so they all query the LLM in parallel.
+        """
+        self.save_file_path = save_file_path
+        self.log_file_path = log_file_path
+
+        graph = StageGraph()
+        graph.add_stage("obj_scenic_dict",
+                        lambda: obj_model_finder(self.obj_list, self.model_file_path))
+        graph.add_stage("metric_api_dict",
+                        lambda: api_retriever(self.instruction_list, self.obj_list, self.api_file_path))
+        graph.add_stage("instruction_dict",
+                        lambda: instruction_generator(self.instruction_list))
+        stage_results = graph.run()
+        graph.report()
+        self.stage_latencies = dict(graph.latencies)
+
+        obj_scenic_dict = stage_results["obj_scenic_dict"]
         print(f"obj_scenic_dict: {json.dumps(obj_scenic_dict, indent=4)}")
         if obj_scenic_dict is None:
             obj_scenic_dict = {}
-        metric_api_dict = api_retriever(
-            self.instruction_list, self.obj_list, self.api_file_path)
+        metric_api_dict = stage_results["metric_api_dict"]
         print(f"metric_api_dict: {json.dumps(metric_api_dict, indent=4)}")
-        instruction_dict = instruction_generator(
-            metric_api_dict, self.instruction_list)
+        instruction_dict = stage_results["instruction_dict"]
         print(f"instruction_dict: {json.dumps(instruction_dict, indent=4)}")
 
         # Write log file
@@ -481,6 +868,7 @@ class Synth:
             file.write("from scenic.simulators.unity.actions import *\n")
             file.write("from scenic.simulators.unity.behaviors import *\n")
             file.write("model scenic.simulators.unity.model\n\n")
+            file.write(prelude("\t") + "\n")
 
             file.write(f"log_file_path = r\"{self.log_file_path}\"\n\n")
 
@@ -499,8 +887,7 @@ class Synth:
             file.write(
                 f"\t\ttake SpeakAction('Environmental precaution is {escape_quotes(self.others['environmentalPrecaution'])}.')\n")
             file.write("\t\ttake DoneAction()\n\n")
-            file.write(f"\t\twhile not WaitForIntroduction(ego):\n")
-            file.write(f"\t\t\twait\n\n")
+            file.write(f"\t\t{wait_until('WaitForIntroduction(ego)')}\n\n")
 
             file.write(f"\t\tlog = 0\n\n")
 
@@ -551,8 +938,7 @@ class Synth:
                 file.write(f"\t\ttake DoneAction()\n")
 
                 # Adding a 4 second time buffer
-                file.write(f"\t\tfor _ in range(40):\n")
-                file.write(f"\t\t\twait\n\n")
+                file.write(f"\t\tdo Pause(ticks=40)\n\n")
 
                 # Recording time
                 file.write(f"\t\tstart_time = time.time()\n\n")
@@ -565,8 +951,7 @@ class Synth:
                     f"\t\ttake SendImageAndTextRequestAction(\"{escape_quotes(instruction_dict[key])}\")\n")
                 file.write(f"\t\ttake DoneAction()\n\n")
 
-                file.write(f"\t\twhile not TaskIsDone(ego):\n")
-                file.write(f"\t\t\twait\n")
+                file.write(f"\t\t{wait_until('TaskIsDone(ego)')}\n")
 
                 file.write(f"\t\tend_time = time.time()\n\n")
                 file.write(
@@ -579,8 +964,7 @@ class Synth:
             file.write(f"\t\ttake AskQuestionAction(\"Did you feel any physical pain or discomfort during or after the exercise? For example, things like pain, fatigue, dizziness, or anything unusual?\")\n")
             file.write(f"\t\ttake DoneAction()\n\n")
 
-            file.write(f"\t\twhile not PainRecorded(ego):\n")
-            file.write(f"\t\t\twait\n\n")
+            file.write(f"\t\t{wait_until('PainRecorded(ego)')}\n\n")
 
             file.write(f"\t\tLogPain(ego, log_file_path)\n")
             file.write(f"\t\ttake DoneAction()\n\n")
@@ -592,8 +976,7 @@ class Synth:
             file.write(f"\t\ttake AskQuestionAction(\"Did you feel any physical pain or discomfort during or after the exercise? For example, things like pain, fatigue, dizziness, or anything unusual?\")\n")
             file.write(f"\t\ttake DoneAction()\n\n")
 
-            file.write(f"\t\twhile not PainRecorded(ego):\n")
-            file.write(f"\t\t\twait\n\n")
+            file.write(f"\t\t{wait_until('PainRecorded(ego)')}\n\n")
 
             file.write(f"\t\tLogPain(ego, log_file_path)\n")
             file.write(f"\t\ttake DoneAction()\n\n")
@@ -621,7 +1004,7 @@ def download_and_print_json(json_id):
         "Accept": "application/json"
     }
 
-    response = requests.get(url, headers=headers)
+    response = cached_get(url, headers=headers, ttl=0)
     text = response.text
     text = text.replace("\"", "")
     
@@ -0,0 +1,98 @@
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class StageGraph:
+    """
+    A small DAG of pipeline stages (typically LLM calls) run on a thread pool.
+
+    Each stage is a callable that receives the results of its dependencies as keyword arguments
+    (named after the dependency stages). Stages whose dependencies are done are launched right away,
+    so independent LLM calls wait on the provider in parallel and the wall-clock time approaches the
+    critical path instead of the sum of all stages.
+
+    Example:
+        graph = StageGraph()
+        graph.add_stage("apis", lambda: api_retriever(...))
+        graph.add_stage("objects", lambda: obj_model_finder(...))
+        graph.add_stage("instructions", lambda apis: instruction_generator(apis, ...), deps=["apis"])
+        results = graph.run()
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.latencies = {}
+        self.wall_clock = 0.0
+
+    def add_stage(self, name, fn, deps=()):
+        if name in self.stages:
+            raise ValueError(f"Stage {name} is already defined")
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+        self.stages[name] = (fn, tuple(deps))
+
+    def run(self, max_workers=None):
+        """
+        Run every stage once its dependencies have finished.
+
+        Return:
+        dictionary: (key: stage name, value: the stage's return value)
+        """
+        results = {}
+        self.latencies = {}
+        pending = dict(self.stages)
+        running = {}
+
+        def timed(name, fn, kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(**kwargs)
+            finally:
+                self.latencies[name] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers or max(1, len(self.stages))) as pool:
+            while pending or running:
+                for name, (fn, deps) in list(pending.items()):
+                    if all(dep in results for dep in deps):
+                        kwargs = {dep: results[dep] for dep in deps}
+                        # Each stage runs in a copy of the caller's context, so the synthesis
+                        # deadline and the open telemetry spans carry over into the worker thread
+                        running[pool.submit(contextvars.copy_context().run, timed, name, fn, kwargs)] = name
+                        del pending[name]
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    # Re-raise the first stage failure; the stages still running finish on shutdown
+                    results[name] = future.result()
+        self.wall_clock = time.perf_counter() - start
+        return results
+
+    def critical_path(self):
+        """
+        Return (list of stage names, seconds) of the longest dependency chain measured in the last run.
+        """
+        finish = {}
+        best_prev = {}
+        for name, (_, deps) in self.stages.items():  # stages are added in topological order
+            prev = max(deps, key=lambda dep: finish[dep], default=None)
+            best_prev[name] = prev
+            finish[name] = self.latencies.get(name, 0.0) + (finish[prev] if prev else 0.0)
+        if not finish:
+            return [], 0.0
+        last = max(finish, key=finish.get)
+        path, node = [], last
+        while node is not None:
+            path.append(node)
+            node = best_prev[node]
+        return path[::-1], finish[last]
+
+    def report(self):
+        path, path_time = self.critical_path()
+        for name in self.stages:
+            print(f"stage {name}: {self.latencies.get(name, 0.0):.2f}s")
+        print(f"critical path ({' -> '.join(path)}): {path_time:.2f}s")
+        print(f"wall clock: {self.wall_clock:.2f}s "
+              f"(sequential would be {sum(self.latencies.values()):.2f}s)")
@@ -0,0 +1,64 @@
+import re
+
+
+_HEADER = re.compile(r"^(import|from|model)\b")
+
+
+class StreamGuard:
+    """
+    Watches a Scenic program while it streams in and reports fatal output as early as possible.
+
+    A program is rejected as soon as we see
+    1) a markdown fence (```), which the prompt forbids and which breaks the Scenic parser,
+    2) prose before the import header (anything but blank lines and comments), or
+    3) the ego instantiation, or the end of the stream, without a `behavior Instruction` definition.
+
+    feed() returns the rejection reason (str) or None; finish() does the end-of-stream checks.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.header_seen = False
+        self.behavior_seen = False
+        self.reason = None
+
+    def feed(self, chunk):
+        if self.reason is not None:
+            return self.reason
+        self.buffer += chunk
+        *lines, self.buffer = self.buffer.split("\n")
+        for line in lines:
+            self.reason = self._check_line(line)
+            if self.reason is not None:
+                return self.reason
+        # Catch an opening fence before its line is complete
+        if self.buffer.lstrip().startswith("```"):
+            self.reason = "markdown fence in output"
+        return self.reason
+
+    def finish(self):
+        if self.reason is None and self.buffer:
+            self.reason = self._check_line(self.buffer)
+            self.buffer = ""
+        if self.reason is None and not self.header_seen:
+            self.reason = "no import header in output"
+        if self.reason is None and not self.behavior_seen:
+            self.reason = "missing `behavior Instruction`"
+        return self.reason
+
+    def _check_line(self, line):
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            return "markdown fence in output"
+        if not self.header_seen:
+            if not stripped or stripped.startswith("#"):
+                return None
+            if _HEADER.match(stripped):
+                self.header_seen = True
+                return None
+            return "prose before the import header"
+        if stripped.startswith("behavior Instruction"):
+            self.behavior_seen = True
+        elif stripped.startswith("ego = new") and not self.behavior_seen:
+            return "missing `behavior Instruction`"
+        return None
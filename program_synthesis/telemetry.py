@@ -0,0 +1,258 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+# Numeric span attributes that are also summed per span name over the life of the process
+COUNTED_ATTRS = ["prompt_chars", "completion_chars", "prompt_tokens", "completion_tokens",
+                 "retries", "backoff_seconds", "hedges", "rate_wait_seconds", "bytes"]
+
+_QUANTILES = [0.5, 0.9, 0.95, 0.99]
+
+
+class Span:
+    """A timed section of the pipeline. attrs holds whatever the caller recorded (e.g. prompt_chars)."""
+
+    def __init__(self, name, parent, attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.start = time.time()
+        self.seconds = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {"name": self.name, "parent": self.parent, "start": self.start,
+                "seconds": self.seconds, **self.attrs}
+
+
+class JSONLSink:
+    """Appends every finished span to a JSON Lines file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, span):
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+class Tracer:
+    """
+    Collects timing spans from the synthesis pipeline.
+
+    Usage:
+        with tracer.span("llm_wait", stage="direct_scenic_generator") as s:
+            ...
+            s.set(completion_chars=len(output))
+
+    Spans nest per thread and per asyncio task (each span records the name of the span it was
+    opened in). tracer.add(retries=1) adds to a counter on every span that is currently open, so
+    a retry inside queryLLM is counted on the LLM stage and on the synthesis around it.
+
+    The most recent max_spans spans are kept in memory for summary() and the quantiles of the
+    Prometheus snapshot; counts, seconds and COUNTED_ATTRS are also totaled per span name for the
+    life of the process. Finished spans are passed to every sink (e.g. a JSONLSink).
+    """
+
+    def __init__(self, max_spans=10000):
+        self.spans = collections.deque(maxlen=max_spans)
+        self.sinks = []
+        self.totals = collections.defaultdict(lambda: collections.defaultdict(float))
+        self._stack = contextvars.ContextVar("telemetry_stack", default=())
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        stack = self._stack.get()
+        span = Span(name, stack[-1].name if stack else None, attrs)
+        token = self._stack.set(stack + (span,))
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            self._stack.reset(token)
+            self._finish(span)
+
+    def _finish(self, span):
+        with self._lock:
+            self.spans.append(span)
+            totals = self.totals[span.name]
+            totals["count"] += 1
+            totals["seconds"] += span.seconds
+            if "error" in span.attrs:
+                totals["errors"] += 1
+            for attr in COUNTED_ATTRS:
+                value = span.attrs.get(attr)
+                if isinstance(value, (int, float)):
+                    totals[attr] += value
+            sinks = list(self.sinks)
+        for sink in sinks:
+            try:
+                sink(span)
+            except Exception as e:
+                print(f"Telemetry sink error: {e}")
+
+    def current(self):
+        """The innermost open span, or None."""
+        stack = self._stack.get()
+        return stack[-1] if stack else None
+
+    def add(self, **counters):
+        """Add to numeric attributes of every open span."""
+        # Open spans are shared with the worker threads of a StageGraph, which add concurrently
+        with self._lock:
+            for span in self._stack.get():
+                for key, value in counters.items():
+                    span.attrs[key] = span.attrs.get(key, 0) + value
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def reset(self):
+        with self._lock:
+            self.spans.clear()
+            self.totals.clear()
+
+    def summary(self):
+        """
+        Return:
+        dictionary: (key: span name, value: {"count", "total", "mean", "p50", "p95", "max"} in seconds)
+        """
+        with self._lock:
+            by_name = collections.defaultdict(list)
+            for span in self.spans:
+                by_name[span.name].append(span.seconds)
+        out = {}
+        for name, seconds in by_name.items():
+            seconds.sort()
+            n = len(seconds)
+            out[name] = {"count": n, "total": sum(seconds), "mean": sum(seconds) / n,
+                         "p50": seconds[n // 2], "p95": seconds[min(n - 1, int(0.95 * n))],
+                         "max": seconds[-1]}
+        return out
+
+    def prometheus(self, prefix="synthesis"):
+        """
+        Return a Prometheus text-format snapshot:
+        <prefix>_span_seconds (summary: quantiles over the recent spans, _sum and _count over the
+        process lifetime), <prefix>_span_errors_total and <prefix>_<attr>_total per span name.
+        """
+        with self._lock:
+            totals = {name: dict(values) for name, values in self.totals.items()}
+            recent = collections.defaultdict(list)
+            for span in self.spans:
+                recent[span.name].append(span.seconds)
+        lines = [f"# HELP {prefix}_span_seconds Duration of pipeline spans.",
+                 f"# TYPE {prefix}_span_seconds summary"]
+        for name in sorted(totals):
+            seconds = sorted(recent.get(name, []))
+            for q in _QUANTILES:
+                if seconds:
+                    value = seconds[min(len(seconds) - 1, int(q * len(seconds)))]
+                    lines.append(f'{prefix}_span_seconds{{span="{name}",quantile="{q}"}} {value:.6f}')
+            lines.append(f'{prefix}_span_seconds_sum{{span="{name}"}} {totals[name]["seconds"]:.6f}')
+            lines.append(f'{prefix}_span_seconds_count{{span="{name}"}} {int(totals[name]["count"])}')
+        lines.append(f"# TYPE {prefix}_span_errors_total counter")
+        for name in sorted(totals):
+            lines.append(f'{prefix}_span_errors_total{{span="{name}"}} {int(totals[name].get("errors", 0))}')
+        for attr in COUNTED_ATTRS:
+            rows = [(name, values[attr]) for name, values in sorted(totals.items()) if attr in values]
+            if not rows:
+                continue
+            lines.append(f"# TYPE {prefix}_{attr}_total counter")
+            for name, value in rows:
+                lines.append(f'{prefix}_{attr}_total{{span="{name}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="synthesis"):
+        """Atomically write the Prometheus snapshot to path (e.g. for a node_exporter textfile collector)."""
+        text = self.prometheus(prefix)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".prom.tmp", dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+tracer = Tracer()
+span = tracer.span
+
+
+def traced(name=None):
+    """Decorator that runs a function (sync or async) inside a span named after it."""
+    def decorate(fn):
+        span_name = name or fn.__name__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(span_name, kind="stage"):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(span_name, kind="stage"):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+if os.environ.get("TELEMETRY_JSONL"):
+    tracer.add_sink(JSONLSink(os.environ["TELEMETRY_JSONL"]))
+
+
+def prometheus_from_jsonl(path, prefix="synthesis"):
+    """Build the Prometheus snapshot offline from a JSONL span file."""
+    offline = Tracer(max_spans=None)
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            span = Span(record.pop("name"), record.pop("parent", None), record)
+            span.start = record.pop("start", None)
+            span.seconds = record.pop("seconds", 0.0) or 0.0
+            offline._finish(span)
+    return offline.prometheus(prefix)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Prometheus text snapshot from a telemetry JSONL file")
+    parser.add_argument("jsonl")
+    parser.add_argument("--output", help="write the snapshot here instead of printing it")
+    args = parser.parse_args()
+
+    text = prometheus_from_jsonl(args.jsonl)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text, end="")
@@ -1,17 +1,17 @@
-import requests
+from upload_outbox import UploadOutbox
 
-url = "https://api.reia-rehab.com/upload/file/?upload_id=sample_upload"
+url = "https://api.reia-rehab.com/upload/file/?upload_id={upload_id}"
 
 payload = {
     "title": "Sample Title",
     "body": "This is a sample"
 }
 
-headers = {
-    "Content-Type": "application/json"
-}
-
-response = requests.post(url, json=payload, headers=headers)
+# Queue the upload on disk and wait (up to 60 s) for the outbox to deliver it;
+# anything not delivered stays queued and is sent on the next run
+outbox = UploadOutbox(url_template=url).start()
+print("Queued:", outbox.enqueue("sample_upload", payload))
+outbox.stop(drain_timeout=60)
 
-print("Status Code:", response.status_code)
-print("Response:", response.text)
\ No newline at end of file
+print("Stats:", outbox.stats)
+print("Still pending:", len(outbox.pending()), "Dead:", len(outbox.dead()))
@@ -0,0 +1,295 @@
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from backoff import decorrelated_jitter
+from telemetry import span
+
+
+UPLOAD_URL = "https://api.reia-rehab.com/upload/json/?upload_id={upload_id}"
+
+# Failures worth retrying; any other 4xx means the payload itself was rejected
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+def _write_atomic(path, entry):
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class UploadOutbox:
+    """
+    Durable outbox for report uploads.
+
+    enqueue() writes the payload and the URL it goes to to <outbox_dir>/pending/ with an atomic
+    rename and returns at once;
+    a background worker posts the pending reports over one pooled requests.Session and deletes each
+    file only after the server accepted it. Because the queue lives on disk, reports enqueued before
+    a crash or restart are sent by the next worker started on the same directory. Each report is
+    posted to the URL stored with it, so outboxes for different endpoints may share a directory.
+
+    Failed uploads are retried with decorrelated-jitter backoff. Connection errors and retryable
+    responses (408/425/429/5xx) keep the report pending, however long the outage lasts (or up to
+    max_age_hours). Only reports the server rejects outright (any other 4xx) are moved to
+    <outbox_dir>/dead/ for inspection instead of being dropped; nothing retries them.
+
+    Input Arguments:
+    1. outbox_dir (str): directory of the on-disk queue
+    2. url_template (str): upload URL with an {upload_id} field
+    3. batch_url (str): endpoint accepting a JSON list of {"upload_id", "payload"} objects; when set,
+       up to max_batch reports are sent per request. The production endpoint takes one report per
+       request, so this is None by default.
+    4. compress (bool): gzip request bodies (Content-Encoding: gzip). Off by default, since the
+       production endpoint is not known to accept them. Until a compressed body has been accepted,
+       a 415 or any other non-retryable 4xx turns compression off for this outbox and the report is
+       resent uncompressed.
+    5. max_age_hours (float): hours after which a report that still fails with retryable errors is
+       moved to dead/; None (the default) retries it for as long as the outbox runs
+    6. backoff_base (float), backoff_cap (float): retry backoff, in seconds
+    7. poll_interval (float): seconds the idle worker waits before looking for new reports
+    """
+
+    def __init__(self, outbox_dir="outbox", url_template=UPLOAD_URL, batch_url=None, max_batch=20,
+                 compress=False, max_age_hours=None, backoff_base=1.0, backoff_cap=300.0, timeout=30,
+                 pool_size=4, poll_interval=1.0):
+        self.outbox_dir = outbox_dir
+        self.pending_dir = os.path.join(outbox_dir, "pending")
+        self.dead_dir = os.path.join(outbox_dir, "dead")
+        os.makedirs(self.pending_dir, exist_ok=True)
+        os.makedirs(self.dead_dir, exist_ok=True)
+        self.url_template = url_template
+        self.batch_url = batch_url
+        self.max_batch = max_batch
+        self.compress = compress
+        self._gzip_accepted = False
+        self.max_age_hours = max_age_hours
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.stats = {"sent": 0, "requests": 0, "retries": 0, "dead": 0, "bytes_sent": 0, "bytes_raw": 0}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._flush_lock = threading.Lock()
+
+    # ---------- queue ----------
+
+    def enqueue(self, upload_id, payload):
+        """Durably queue a report for upload. Return the path of the queued entry."""
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json"
+        path = os.path.join(self.pending_dir, name)
+        _write_atomic(path, {"upload_id": upload_id, "url": self._url(upload_id), "payload": payload,
+                             "attempts": 0, "enqueued": time.time(), "next_attempt": 0.0, "backoff": 0.0,
+                             "last_error": None})
+        self._wake.set()
+        return path
+
+    def _url(self, upload_id):
+        return self.url_template.format(upload_id=upload_id)
+
+    def _entry_url(self, entry):
+        # Entries queued before the URL was stored go to this outbox's endpoint
+        return entry.get("url") or self._url(entry["upload_id"])
+
+    def pending(self):
+        """Paths of the queued entries, oldest first."""
+        return sorted(os.path.join(self.pending_dir, name) for name in os.listdir(self.pending_dir)
+                      if name.endswith(".json") and not name.startswith("."))
+
+    def dead(self):
+        return sorted(os.path.join(self.dead_dir, name) for name in os.listdir(self.dead_dir)
+                      if name.endswith(".json"))
+
+    def _load(self, path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Never written completely (enqueue renames only finished files), so move it aside
+            os.replace(path, os.path.join(self.dead_dir, os.path.basename(path)))
+            return None
+
+    # ---------- sending ----------
+
+    def _body(self, obj):
+        data = json.dumps(obj).encode("utf-8")
+        self.stats["bytes_raw"] += len(data)
+        if self.compress:
+            data = gzip.compress(data)
+            headers = {"Content-Encoding": "gzip"}
+        else:
+            headers = {}
+        self.stats["bytes_sent"] += len(data)
+        return data, headers
+
+    def _post(self, url, obj):
+        """POST obj as JSON. Return (ok, retryable, error)."""
+        data, headers = self._body(obj)
+        self.stats["requests"] += 1
+        try:
+            with span("http_post", url=url, bytes=len(data)) as http_span:
+                response = self.session.post(url, data=data, headers=headers, timeout=self.timeout)
+                http_span.set(status=response.status_code)
+        except requests.RequestException as e:
+            return False, True, str(e)
+        rejected = 400 <= response.status_code < 500 and response.status_code not in RETRY_STATUS
+        if self.compress and rejected and (response.status_code == 415 or not self._gzip_accepted):
+            print(f"Upload endpoint rejected a gzip body (HTTP {response.status_code}); sending uncompressed")
+            self.compress = False
+            return self._post(url, obj)
+        if response.ok:
+            self._gzip_accepted = self._gzip_accepted or self.compress
+            return True, False, None
+        return False, response.status_code in RETRY_STATUS, f"HTTP {response.status_code}: {response.text[:200]}"
+
+    def _fail(self, path, entry, retryable, error):
+        entry["attempts"] += 1
+        entry["last_error"] = error
+        # Entries queued before "enqueued" was recorded count from their first failure
+        entry.setdefault("enqueued", time.time())
+        expired = (self.max_age_hours is not None
+                   and time.time() - entry["enqueued"] >= self.max_age_hours * 3600)
+        if not retryable or expired:
+            _write_atomic(path, entry)
+            os.replace(path, os.path.join(self.dead_dir, os.path.basename(path)))
+            self.stats["dead"] += 1
+            print(f"Upload of {entry['upload_id']} moved to {self.dead_dir}: {error}")
+            return
+        entry["backoff"] = decorrelated_jitter(entry["backoff"] or self.backoff_base,
+                                               self.backoff_base, self.backoff_cap)
+        entry["next_attempt"] = time.time() + entry["backoff"]
+        _write_atomic(path, entry)
+        self.stats["retries"] += 1
+        print(f"Upload of {entry['upload_id']} failed ({error}); retrying in {entry['backoff']:.1f}s")
+
+    def _succeed(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self.stats["sent"] += 1
+
+    def flush(self):
+        """
+        Send every queued report that is due once.
+
+        Return:
+        float or None: seconds until the next queued report is due, None if the queue is empty
+        """
+        with self._flush_lock:
+            now = time.time()
+            due = []
+            for path in self.pending():
+                entry = self._load(path)
+                if entry is not None and entry["next_attempt"] <= now:
+                    due.append((path, entry))
+
+            single = due
+            if self.batch_url:
+                # Only reports queued for this outbox's endpoint go through its batch endpoint
+                own = [(path, e) for path, e in due if self._entry_url(e) == self._url(e["upload_id"])]
+                single = [(path, e) for path, e in due if self._entry_url(e) != self._url(e["upload_id"])]
+                for i in range(0, len(own), self.max_batch):
+                    batch = own[i:i + self.max_batch]
+                    ok, retryable, error = self._post(
+                        self.batch_url, [{"upload_id": e["upload_id"], "payload": e["payload"]} for _, e in batch])
+                    for path, entry in batch:
+                        if ok:
+                            self._succeed(path)
+                        else:
+                            self._fail(path, entry, retryable, error)
+            for path, entry in single:
+                ok, retryable, error = self._post(self._entry_url(entry), entry["payload"])
+                if ok:
+                    self._succeed(path)
+                else:
+                    self._fail(path, entry, retryable, error)
+
+            next_due = None
+            for path in self.pending():
+                entry = self._load(path)
+                if entry is not None:
+                    next_due = entry["next_attempt"] if next_due is None else min(next_due, entry["next_attempt"])
+            return None if next_due is None else max(0.0, next_due - time.time())
+
+    # ---------- worker ----------
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="UploadOutbox", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                wait = self.flush()
+            except OSError as e:
+                print(f"Upload outbox error: {e}")
+                wait = None
+            self._wake.wait(self.poll_interval if wait is None else min(wait, self.poll_interval))
+            self._wake.clear()
+
+    def stop(self, drain_timeout=0.0):
+        """
+        Stop the worker. With drain_timeout > 0, keep sending until the queue is empty or the
+        timeout expires; whatever is left stays on disk for the next start.
+        """
+        deadline = time.monotonic() + drain_timeout
+        while drain_timeout > 0 and self.pending() and time.monotonic() < deadline:
+            self._wake.set()
+            time.sleep(0.05)
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        self.session.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox(outbox_dir=None):
+    """Process-wide outbox (started on first use), in $UPLOAD_OUTBOX_DIR or ./outbox."""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = UploadOutbox(outbox_dir or os.environ.get("UPLOAD_OUTBOX_DIR", "outbox")).start()
+        return _outbox
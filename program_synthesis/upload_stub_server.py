@@ -0,0 +1,124 @@
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubUploadServer:
+    """
+    Local stand-in for the report upload endpoint (POST /upload/json/?upload_id=...), plus a
+    POST /upload/batch/ endpoint that takes a JSON list of {"upload_id", "payload"} objects.
+
+    Point an outbox at it with UploadOutbox(url_template=server.url_template, batch_url=server.batch_url).
+
+    Input Arguments:
+    1. fail_first (int): answer the first fail_first requests with fail_status
+    2. fail_status (int): status code of the injected failures
+    3. accept_gzip (bool): if False, gzip-encoded bodies are answered with 415
+    4. host (str), port (int): address to bind; port 0 picks a free port
+    """
+
+    def __init__(self, fail_first=0, fail_status=503, accept_gzip=True, host="127.0.0.1", port=0):
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.accept_gzip = accept_gzip
+        self.received = {}   # upload_id -> payload
+        self.requests = 0
+        self.connections = 0
+        self.gzip_requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def url_template(self):
+        return self.base_url + "/upload/json/?upload_id={upload_id}"
+
+    @property
+    def batch_url(self):
+        return self.base_url + "/upload/batch/"
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                data = self.rfile.read(length)
+                with stub._lock:
+                    stub.requests += 1
+                    failing = stub.requests <= stub.fail_first
+                if self.headers.get("Content-Encoding") == "gzip":
+                    if not stub.accept_gzip:
+                        return self._send_json(415, {"detail": "unsupported content encoding"})
+                    with stub._lock:
+                        stub.gzip_requests += 1
+                    data = gzip.decompress(data)
+                if failing:
+                    return self._send_json(stub.fail_status, {"detail": "injected failure"})
+                body = json.loads(data or b"null")
+                url = urlparse(self.path)
+                if url.path.rstrip("/") == "/upload/batch":
+                    items = [(item["upload_id"], item["payload"]) for item in body]
+                else:
+                    items = [(parse_qs(url.query).get("upload_id", [""])[0], body)]
+                with stub._lock:
+                    for upload_id, payload in items:
+                        stub.received[upload_id] = payload
+                self._send_json(200, {"received": len(items)})
+
+            def _send_json(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local stand-in report upload endpoint")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--fail-first", type=int, default=0)
+    args = parser.parse_args()
+
+    server = StubUploadServer(fail_first=args.fail_first, port=args.port)
+    print(f"Stub upload server listening on {server.url_template}")
+    server._server.serve_forever()
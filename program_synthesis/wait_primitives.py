@@ -0,0 +1,438 @@
+import re
+
+from scenic_checker import code_lines
+
+
+# Predicates that report the outcome of something happening asynchronously on the headset (a VLM
+# answer, the end of a spoken instruction, the patient's reply). They flip once, when the event
+# arrives, so they can be checked with growing gaps between checks without missing anything.
+# Pose predicates (BPE APIs, checkCompleted of the exercise trackers) may hold only for a moment
+# or count repetitions as they are called, so they are still checked on every tick.
+EVENT_PREDICATES = {"RequestActionResult", "WaitForSpeakAction", "WaitForIntroduction", "TaskIsDone",
+                    "PainRecorded"}
+
+DEFAULT_BACKOFF = 1.5   # growth of the gap between two checks of an event predicate
+DEFAULT_MAX_GAP = 5     # longest gap between two checks, in ticks
+
+PRIMITIVES = ("WaitUntil", "Pause")
+
+# Definitions added to every program that uses the primitives. The outcome of a WaitUntil is
+# written into the status dictionary passed to it, since `do` does not hand back the return
+# value of a sub-behavior.
+PRELUDE = '''# ---------- Wait primitives ----------
+import time
+
+behavior WaitUntil(predicate, max_ticks=None, timeout_s=None, poll_backoff=1.0, max_gap=5, status=None):
+    # Wait until predicate() holds. It is checked right away and then after gaps (in ticks) that grow
+    # by poll_backoff up to max_gap, and at most until max_ticks ticks or timeout_s seconds have passed.
+    # status (dict) receives "done" (whether predicate held), "ticks" and "seconds" waited and
+    # "checks" made.
+    status = status if status is not None else {}
+    status["done"], status["ticks"], status["seconds"], status["checks"] = False, 0, 0.0, 0
+    start, gap = time.time(), 1.0
+    while True:
+        status["checks"] += 1
+        if predicate():
+            status["done"] = True
+            break
+        if max_ticks is not None and status["ticks"] >= max_ticks:
+            break
+        if timeout_s is not None and time.time() - start >= timeout_s:
+            break
+        ticks = int(gap) if max_ticks is None else min(int(gap), max_ticks - status["ticks"])
+        for _ in range(ticks):
+            wait
+        status["ticks"] += ticks
+        gap = min(max_gap, gap * poll_backoff)
+    status["seconds"] = time.time() - start
+
+behavior Pause(seconds=None, ticks=None):
+    # Let the simulation run for ticks ticks or seconds of wall-clock time without checking anything
+    if ticks is not None:
+        for _ in range(ticks):
+            wait
+    else:
+        end = time.time() + seconds
+        while time.time() < end:
+            wait
+'''
+
+_WHILE = re.compile(r"^(\s*)while\s+(.+?):\s*$")
+_FOR_WAIT = re.compile(r"^(\s*)for\s+\w+\s+in\s+range\(\s*(\d+)\s*\)\s*:\s*$")
+_GUARD = re.compile(r"^if\s+(\w+)\s*>=?\s*(\d+)\s*:$")
+_DO = re.compile(r"^(\s*)do\s+(WaitUntil|Pause)\s*\((.*)\)\s*$")
+_REPEAT = re.compile(r"^(\s*)for\s+\w+\s+in\s+range\(\s*(\d+)\s*\)\s*:")
+_PREDICATE_CALL = re.compile(r"(?<![\w.])([A-Za-z_][\w.]*)\s*\(")
+_KEYWORD = re.compile(r"\b(max_ticks|poll_backoff|max_gap)\s*=\s*([\d.]+)")
+_HEADER = re.compile(r"^(?:import|from|model)\b")
+_PRIMITIVE_DEFINITION = re.compile(rf"^\s*behavior\s+(?:{'|'.join(PRIMITIVES)})\s*\(")
+
+
+def _indent_width(line):
+    return len(line[:len(line) - len(line.lstrip(" \t"))].expandtabs(4))
+
+
+def _block(code, start):
+    """Index of the line after the indented block that opens at line start, and its body lines."""
+    width = _indent_width(code[start])
+    end = start + 1
+    body = []
+    while end < len(code) and (not code[end].strip() or _indent_width(code[end]) > width):
+        if code[end].strip():
+            body.append(end)
+        end += 1
+    while body and end > body[-1] + 1:  # trailing blank lines belong to what follows
+        end -= 1
+    return end, body
+
+
+def indent_unit(program):
+    """Indentation of the body of the program's first behavior or function ("    " if there is none)."""
+    code = code_lines(program)
+    for i, line in enumerate(code):
+        if re.match(r"(?:behavior|def)\s", line):
+            for body in code[i + 1:]:
+                if body.strip():
+                    return body[:len(body) - len(body.lstrip(" \t"))] or "    "
+    return "    "
+
+
+def _calls(condition):
+    return [name for name in _PREDICATE_CALL.findall(condition) if name != "not"]
+
+
+def backoff_for(condition):
+    """poll_backoff for a condition: DEFAULT_BACKOFF if it only calls event predicates, else 1 (every tick)."""
+    calls = _calls(condition)
+    return DEFAULT_BACKOFF if calls and all(name in EVENT_PREDICATES for name in calls) else 1.0
+
+
+def wait_until(condition, negate=False, max_ticks=None, status=None):
+    """The `do WaitUntil(...)` statement that waits for condition (or for it to stop holding, if negate)."""
+    predicate = condition
+    if negate:
+        simple = re.fullmatch(r"[\w.]+\(.*\)", condition) and not re.search(r"\s(?:and|or)\s", condition)
+        predicate = f"not {condition}" if simple else f"not ({condition})"
+    args = [f"lambda: {predicate}"]
+    if max_ticks is not None:
+        args.append(f"max_ticks={max_ticks}")
+    backoff = backoff_for(condition)
+    if backoff != 1.0:
+        args.append(f"poll_backoff={backoff:g}")
+    if status is not None:
+        args.append(f"status={status}")
+    return f"do WaitUntil({', '.join(args)})"
+
+
+def _condition(raw):
+    """(condition to wait for, whether it is negated) from the condition of `while <raw>:`."""
+    raw = raw.strip()
+    if raw.startswith("not ") or raw.startswith("not("):
+        inner = raw[3:].strip()
+        if inner.startswith("(") and _closing(inner, 0) == len(inner) - 1:
+            inner = inner[1:-1].strip()
+        return inner, False
+    return raw, True
+
+
+def _closing(text, start):
+    """Index of the bracket that closes the one at text[start], or -1."""
+    depth = 0
+    for i in range(start, len(text)):
+        depth += {"(": 1, ")": -1}.get(text[i], 0)
+        if depth == 0:
+            return i
+    return -1
+
+
+def rewrite_polling_loops(program, status_name="waited"):
+    """
+    Replace the polling loops of a Scenic program by the wait primitives (see PRELUDE):
+
+        for _ in range(40):                 ->  do Pause(ticks=40)
+            wait
+        while WaitForSpeakAction(ego, i):   ->  do WaitUntil(lambda: not WaitForSpeakAction(ego, i), poll_backoff=1.5)
+            wait
+        while not RequestActionResult(ego): ->  waited = {}
+            if count > 175:                     do WaitUntil(lambda: RequestActionResult(ego), max_ticks=175,
+                break                                        poll_backoff=1.5, status=waited)
+            count += 1
+            wait
+
+    and later uses of `count < 175` by `waited["done"]`. Statements before the `break` of the
+    guard (e.g. take DisposeQueriesAction()) run under `if not waited["done"]:`. Loops of any other
+    shape, and the definitions of the primitives themselves, are left alone.
+
+    Return:
+    tuple: (rewritten program, number of loops replaced)
+    """
+    raw = program.split("\n")
+    code = code_lines(program)
+    unit = indent_unit(program)
+    out = []
+    replaced = 0
+    counters = {}   # counter variable -> tick limit of the loop it counted, while it is not reassigned
+    removed = set()
+    i = 0
+    while i < len(raw):
+        line = code[i]
+        stripped = line.strip()
+        for name in list(counters):
+            if re.search(rf"(?:^|[\s,(]){name}\s*(?:,[^=]*)?=(?!=)", line):
+                del counters[name]
+        if _PRIMITIVE_DEFINITION.match(line):
+            # The definitions of the primitives (added by an earlier pass) poll on purpose
+            end, _ = _block(code, i)
+            out += raw[i:end]
+            i = end
+            continue
+        indent = line[:len(line) - len(line.lstrip(" \t"))]
+        loop = _WHILE.match(line) or _FOR_WAIT.match(line)
+        if loop:
+            end, body = _block(code, i)
+            statements = [code[j].strip() for j in body]
+            text = raw[i][:len(line.rstrip())]
+            replacement = None
+            if _FOR_WAIT.match(line) and statements == ["wait"]:
+                replacement = [f"{indent}do Pause(ticks={loop.group(2)})"]
+            elif _WHILE.match(line):
+                condition, negate = _condition(_WHILE.match(text).group(2))
+                guard = _GUARD.match(statements[0]) if statements else None
+                if statements == ["wait"]:
+                    replacement = [indent + wait_until(condition, negate)]
+                elif (guard and len(statements) >= 4 and statements[-3:-1] == ["break", f"{guard.group(1)} += 1"]
+                        and statements[-1] == "wait"):
+                    counter, limit = guard.group(1), int(guard.group(2))
+                    replacement = [f"{indent}{status_name} = {{}}",
+                                   indent + wait_until(condition, negate, limit, status_name)]
+                    on_timeout = [raw[j][:len(code[j].rstrip())].strip() for j in body[1:-3]]
+                    if on_timeout:
+                        replacement.append(f"{indent}if not {status_name}[\"done\"]:")
+                        replacement += [f"{indent}{unit}{statement}" for statement in on_timeout]
+                    counters[counter] = limit
+                    removed.add(counter)
+            if replacement is not None:
+                out += replacement
+                replaced += 1
+                i = end
+                continue
+        if counters and stripped:
+            rewritten = raw[i]
+            for counter, limit in counters.items():
+                rewritten = re.sub(rf"\b{counter}\s*<\s*{limit}\b", f'{status_name}["done"]', rewritten)
+            out.append(rewritten)
+        else:
+            out.append(raw[i])
+        i += 1
+    return "\n".join(_drop_unused_counters(out, removed)), replaced
+
+
+def _drop_unused_counters(lines, counters):
+    """Remove the initializations (`count = 0`, `start_time, count = time.time(), 0`) of counters no longer used."""
+    code = code_lines("\n".join(lines))
+    for counter in counters:
+        init = re.compile(rf"^(\s*)(?:(\w+),\s*{counter}\s*=\s*(.+),\s*0|{counter}\s*=\s*0)\s*$")
+        uses = [i for i, line in enumerate(code) if re.search(rf"\b{counter}\b", line)]
+        if any(not init.match(code[i]) for i in uses):
+            continue
+        for i in reversed(uses):
+            match = init.match(code[i])
+            if match.group(2):
+                lines[i] = f"{match.group(1)}{match.group(2)} = {match.group(3)}"
+                code[i] = lines[i]
+            else:
+                del lines[i]
+                del code[i]
+    return lines
+
+
+def prelude(indent="    "):
+    """PRELUDE indented with indent (e.g. a tab) per level, to match the program it goes into."""
+    return "\n".join(indent * (_indent_width(line) // 4) + line.lstrip(" ") for line in PRELUDE.split("\n"))
+
+
+def add_prelude(program):
+    """Insert PRELUDE after the imports and `model` statement, in the program's indentation, unless it is there."""
+    code = code_lines(program)
+    defined = {m.group(1) for line in code for m in [re.match(r"behavior\s+(\w+)", line)] if m}
+    if all(name in defined for name in PRIMITIVES):
+        return program
+    lines = program.split("\n")
+    at = 0
+    for number, line in enumerate(code):
+        if _HEADER.match(line):
+            at = number + 1
+        elif line.strip() and not line[:1].isspace() and at:
+            break
+    return "\n".join(lines[:at] + ["", prelude(indent_unit(program)).rstrip("\n")] + lines[at:])
+
+
+def uses_primitives(program):
+    return any(re.match(rf"^\s*do\s+{name}\b", line) for line in code_lines(program) for name in PRIMITIVES)
+
+
+def use_wait_primitives(program, label="synthesize"):
+    """Rewrite the polling loops of a generated program and add the definitions of the primitives it uses."""
+    program, replaced = rewrite_polling_loops(program)
+    if replaced:
+        print(f"{label}: replaced {replaced} polling loops with wait primitives")
+    return add_prelude(program) if uses_primitives(program) else program
+
+
+# ---------- Estimating predicate calls ----------
+
+# Ticks until a wait's condition assumed to hold, per predicate (the slowest predicate of a
+# condition decides); conditions without any of these are assumed to hold after POSE_TICKS.
+# These are only rough figures for comparing programs, not measurements.
+EVENT_TICKS = {"RequestActionResult": 60, "WaitForSpeakAction": 40, "WaitForIntroduction": 150,
+               "TaskIsDone": 60, "PainRecorded": 100}
+POSE_TICKS = 30
+
+
+def predicate_checks(ticks, max_ticks=None, poll_backoff=1.0, max_gap=DEFAULT_MAX_GAP):
+    """
+    Number of times WaitUntil checks a condition that starts to hold after ticks ticks
+    (per-tick polling is poll_backoff=1 and max_gap=1).
+    """
+    limit = ticks if max_ticks is None else min(ticks, max_ticks)
+    waited, gap, checks = 0, 1.0, 1
+    while waited < limit:
+        step = int(gap) if max_ticks is None else min(int(gap), max_ticks - waited)
+        waited += step
+        checks += 1
+        gap = min(max_gap, gap * poll_backoff)
+    return checks
+
+
+class WaitSite:
+    """A place where a program waits: a polling loop or a `do WaitUntil`/`do Pause`."""
+
+    def __init__(self, line, condition, max_ticks=None, poll_backoff=1.0, max_gap=1, repeat=1):
+        self.line = line
+        self.condition = condition
+        self.calls = _calls(condition)
+        self.max_ticks = max_ticks
+        self.poll_backoff = poll_backoff
+        self.max_gap = max_gap
+        self.repeat = repeat   # times the enclosing for-loops run it
+
+    def predicate_calls(self, event_ticks=None, pose_ticks=POSE_TICKS):
+        """Predicate calls made over a session, under the assumed ticks until the condition holds."""
+        if not self.calls:
+            return 0
+        event_ticks = EVENT_TICKS if event_ticks is None else event_ticks
+        ticks = max(event_ticks.get(name.split(".")[-1], pose_ticks) for name in self.calls)
+        checks = predicate_checks(ticks, self.max_ticks, self.poll_backoff, self.max_gap)
+        return checks * len(self.calls) * self.repeat
+
+
+def loop_multipliers(code):
+    """
+    How many times each line runs per run of its behavior, from the enclosing `for ... in range(N)`
+    loops (other for-loops count once).
+
+    Input:
+    code (list): the program's lines, as returned by scenic_checker.code_lines
+    """
+    multipliers = []
+    repeats = []   # (indent width, count) of the enclosing for-loops
+    for i, line in enumerate(code):
+        if not line.strip():
+            multipliers.append(multipliers[-1] if multipliers else 1)
+            continue
+        width = _indent_width(line)
+        while repeats and repeats[-1][0] >= width:
+            repeats.pop()
+        repeat = 1
+        for _, count in repeats:
+            repeat *= count
+        multipliers.append(repeat)
+        match = _REPEAT.match(line)
+        if match:
+            _, body = _block(code, i)
+            if [code[j].strip() for j in body] != ["wait"]:
+                repeats.append((width, int(match.group(2))))
+        elif re.match(r"^\s*for\b", line):
+            repeats.append((width, 1))
+    return multipliers
+
+
+def wait_sites(program):
+    """Return the WaitSites of a program, in order."""
+    code = code_lines(program)
+    multipliers = loop_multipliers(code)
+    sites = []
+    skip = False   # inside the definitions of the primitives
+    for i, line in enumerate(code):
+        if not line.strip():
+            continue
+        if not line[:1].isspace():
+            skip = re.match(rf"behavior\s+(?:{'|'.join(PRIMITIVES)})\b", line) is not None
+        if skip:
+            continue
+        repeat = multipliers[i]
+        do = _DO.match(line)
+        loop = _WHILE.match(line)
+        if do:
+            if do.group(2) == "Pause":
+                sites.append(WaitSite(i + 1, "", repeat=repeat))
+                continue
+            settings = {name: float(value) for name, value in _KEYWORD.findall(do.group(3))}
+            condition = re.sub(r"^\s*lambda\s*:\s*", "", do.group(3))
+            condition = re.split(r",\s*(?:max_ticks|timeout_s|poll_backoff|max_gap|status)\s*=", condition)[0]
+            sites.append(WaitSite(i + 1, condition,
+                                  int(settings["max_ticks"]) if "max_ticks" in settings else None,
+                                  settings.get("poll_backoff", 1.0), int(settings.get("max_gap", DEFAULT_MAX_GAP)),
+                                  repeat))
+        elif loop:
+            _, body = _block(code, i)
+            statements = [code[j].strip() for j in body]
+            if statements and statements[-1] == "wait":
+                guard = _GUARD.match(statements[0])
+                sites.append(WaitSite(i + 1, loop.group(2), int(guard.group(2)) + 1 if guard else None,
+                                      repeat=repeat))
+    return sites
+
+
+def estimate_predicate_calls(program, event_ticks=None, pose_ticks=POSE_TICKS):
+    """
+    Estimate the predicate calls (each a round trip over the bridge to Unity) a program makes in
+    one session, under the assumed ticks until each wait's condition holds (see EVENT_TICKS).
+
+    Return:
+    dictionary with keys "waits" (number of wait sites) and "predicate_calls"
+    """
+    sites = wait_sites(program)
+    return {"waits": len(sites),
+            "predicate_calls": sum(site.predicate_calls(event_ticks, pose_ticks) for site in sites)}
+
+
+if __name__ == "__main__":
+    import argparse
+    import glob
+    import os
+
+    parser = argparse.ArgumentParser(
+        description="Estimate the predicate calls of Scenic programs before and after rewriting their polling loops")
+    parser.add_argument("programs", nargs="*", help="Scenic programs (default: the example programs)")
+    parser.add_argument("--write", action="store_true", help="write the rewritten programs back")
+    args = parser.parse_args()
+
+    paths = args.programs or sorted(glob.glob(os.path.join("scenic_output", "example_scenic_program", "*.scenic")))
+    total_before = total_after = 0
+    print(f"{'program':<28} {'loops':>5} {'calls before':>12} {'calls after':>11}")
+    for path in paths:
+        with open(path, "r") as f:
+            source = f.read()
+        rewritten, replaced = rewrite_polling_loops(source)
+        before = estimate_predicate_calls(source)["predicate_calls"]
+        after = estimate_predicate_calls(rewritten)["predicate_calls"]
+        total_before += before
+        total_after += after
+        print(f"{os.path.basename(path):<28} {replaced:5d} {before:12d} {after:11d}")
+        if args.write and replaced:
+            with open(path, "w") as f:
+                f.write(rewritten)
+    if total_before:
+        print(f"{'total':<28} {'':5} {total_before:12d} {total_after:11d} "
+              f"({1 - total_after / total_before:.0%} fewer)")